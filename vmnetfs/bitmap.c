@@ -241,6 +241,46 @@ bool _vmnetfs_bit_test(struct bitmap *map, uint64_t bit)
     return ret;
 }
 
+/* Copy the first @bits bits into @buf, which must hold (bits + 7) / 8
+   bytes.  Bits beyond the current size of the bitmap read as zero. */
+void _vmnetfs_bit_export(struct bitmap *map, void *buf, uint64_t bits)
+{
+    uint8_t *bytes = buf;
+    uint64_t n;
+
+    memset(bytes, 0, (bits + 7) / 8);
+    g_mutex_lock(map->mgrp->lock);
+    n = MIN(bits, map->mgrp->nbits);
+    memcpy(bytes, map->bits, n / 8);
+    for (n = n / 8 * 8; n < MIN(bits, map->mgrp->nbits); n++) {
+        if (test_bit(map, n)) {
+            bytes[n / 8] |= 1 << (n % 8);
+        }
+    }
+    g_mutex_unlock(map->mgrp->lock);
+}
+
+/* Set the bits which are set in the first @bits bits of @buf.  Out-of-range
+   bits are ignored.  Stream readers are not notified, so this must be
+   called before the bitmap's stream group is exposed. */
+void _vmnetfs_bit_import(struct bitmap *map, const void *buf, uint64_t bits)
+{
+    const uint8_t *bytes = buf;
+    uint64_t n;
+
+    g_mutex_lock(map->mgrp->lock);
+    bits = MIN(bits, map->mgrp->nbits);
+    for (n = 0; n < bits / 8; n++) {
+        map->bits[n] |= bytes[n];
+    }
+    for (n = bits / 8 * 8; n < bits; n++) {
+        if (bytes[n / 8] & (1 << (n % 8))) {
+            set_bit(map, n);
+        }
+    }
+    g_mutex_unlock(map->mgrp->lock);
+}
+
 struct vmnetfs_stream_group *_vmnetfs_bit_get_stream_group(struct bitmap *map)
 {
     return map->sgrp;
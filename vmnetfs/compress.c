@@ -0,0 +1,64 @@
+/*
+ * vmnetfs - virtual machine network execution virtual filesystem
+ *
+ * Copyright (C) 2006-2014 Carnegie Mellon University
+ *
+ * This program is free software; you can redistribute it and/or modify it
+ * under the terms of version 2 of the GNU General Public License as published
+ * by the Free Software Foundation.  A copy of the GNU General Public License
+ * should have been distributed along with this program in the file
+ * COPYING.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+ * for more details.
+ */
+
+#include <string.h>
+#include "vmnetfs-private.h"
+#ifdef HAVE_LZ4
+#include <lz4.h>
+#endif
+
+bool _vmnetfs_is_zero(const void *buf, uint64_t len)
+{
+    const char *cbuf = buf;
+
+    /* Compare each byte with the one before it */
+    return len == 0 || (cbuf[0] == 0 && !memcmp(cbuf, cbuf + 1, len - 1));
+}
+
+/* Returns the compressed length, or 0 if the data doesn't compress into
+   @out_len bytes or compression is not supported. */
+uint32_t _vmnetfs_compress(const void *in, uint32_t in_len, void *out,
+        uint32_t out_len)
+{
+#ifdef HAVE_LZ4
+    int ret;
+
+    ret = LZ4_compress_default(in, out, in_len, out_len);
+    return ret > 0 ? ret : 0;
+#else
+    (void) in;
+    (void) in_len;
+    (void) out;
+    (void) out_len;
+    return 0;
+#endif
+}
+
+/* Returns false if the data is corrupt or compression is not supported. */
+bool _vmnetfs_decompress(const void *in, uint32_t in_len, void *out,
+        uint32_t out_len)
+{
+#ifdef HAVE_LZ4
+    return LZ4_decompress_safe(in, out, in_len, out_len) == (int) out_len;
+#else
+    (void) in;
+    (void) in_len;
+    (void) out;
+    (void) out_len;
+    return false;
+#endif
+}
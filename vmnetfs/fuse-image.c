@@ -17,6 +17,7 @@
 
 #include <string.h>
 #include <inttypes.h>
+#include <fcntl.h>
 #include <errno.h>
 #include "vmnetfs-private.h"
 
@@ -67,6 +68,18 @@ static int image_read(struct vmnetfs_fuse_fh *fh, void *buf, uint64_t start,
 
     _vmnetfs_stream_group_write(img->io_stream, "read %"PRIu64"+%"PRIu64"\n",
             start, count);
+    if (!_vmnetfs_io_fetch_range(img, start, count, &err)) {
+        if (g_error_matches(err, VMNETFS_IO_ERROR,
+                VMNETFS_IO_ERROR_INTERRUPTED)) {
+            g_clear_error(&err);
+            return -EINTR;
+        } else {
+            g_warning("%s", err->message);
+            g_clear_error(&err);
+            _vmnetfs_u64_stat_increment(img->io_errors, 1);
+            return -EIO;
+        }
+    }
     for (_vmnetfs_cursor_start(img, &cur, start, count);
             _vmnetfs_cursor_chunk(&cur, read); ) {
         read = _vmnetfs_io_read_chunk(img, buf + cur.io_offset, cur.chunk,
@@ -123,12 +136,78 @@ static int image_write(struct vmnetfs_fuse_fh *fh, const void *buf,
     return cur.io_offset;
 }
 
+#ifndef FALLOC_FL_ZERO_RANGE
+#define FALLOC_FL_ZERO_RANGE 0x10
+#endif
+
+/* Punching a hole or zeroing a range records zeroes in the modified
+   cache, so the discarded data is never fetched. */
+static int image_fallocate(struct vmnetfs_fuse_fh *fh, int mode,
+        uint64_t start, uint64_t count)
+{
+    struct vmnetfs_image *img = fh->data;
+    struct vmnetfs_cursor cur;
+    GError *err = NULL;
+    uint64_t zeroed = 0;
+    uint64_t image_size;
+
+    if (mode & ~(FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE |
+            FALLOC_FL_ZERO_RANGE)) {
+        return -EOPNOTSUPP;
+    }
+    if ((mode & FALLOC_FL_PUNCH_HOLE) && (!(mode & FALLOC_FL_KEEP_SIZE) ||
+            (mode & FALLOC_FL_ZERO_RANGE))) {
+        return -EOPNOTSUPP;
+    }
+    if (!(mode & FALLOC_FL_KEEP_SIZE) &&
+            start + count > _vmnetfs_io_get_image_size(img, NULL)) {
+        /* Newly allocated space reads as zeroes */
+        if (!_vmnetfs_io_set_image_size(img, start + count, &err)) {
+            goto err;
+        }
+    }
+    if (!(mode & (FALLOC_FL_PUNCH_HOLE | FALLOC_FL_ZERO_RANGE))) {
+        return 0;
+    }
+
+    image_size = _vmnetfs_io_get_image_size(img, NULL);
+    if (start >= image_size) {
+        return 0;
+    }
+    count = MIN(count, image_size - start);
+    _vmnetfs_stream_group_write(img->io_stream, "zero %"PRIu64"+%"PRIu64"\n",
+            start, count);
+    for (_vmnetfs_cursor_start(img, &cur, start, count);
+            _vmnetfs_cursor_chunk(&cur, zeroed); ) {
+        zeroed = _vmnetfs_io_zero_chunk(img, cur.chunk, cur.offset,
+                cur.length, &err);
+        if (err) {
+            goto err;
+        }
+        _vmnetfs_u64_stat_increment(img->bytes_discarded, cur.length);
+    }
+    return 0;
+
+err:
+    if (g_error_matches(err, VMNETFS_IO_ERROR,
+            VMNETFS_IO_ERROR_INTERRUPTED)) {
+        g_clear_error(&err);
+        return -EINTR;
+    } else {
+        g_warning("%s", err->message);
+        g_clear_error(&err);
+        _vmnetfs_u64_stat_increment(img->io_errors, 1);
+        return -EIO;
+    }
+}
+
 static const struct vmnetfs_fuse_ops image_ops = {
     .getattr = image_getattr,
     .truncate = image_truncate,
     .open = image_open,
     .read = image_read,
     .write = image_write,
+    .fallocate = image_fallocate,
 };
 
 void _vmnetfs_fuse_image_populate(struct vmnetfs_fuse_dentry *dir,
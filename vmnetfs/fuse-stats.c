@@ -117,14 +117,24 @@ void _vmnetfs_fuse_stats_populate(struct vmnetfs_fuse_dentry *dir,
 #define add_stat(n) _vmnetfs_fuse_add_file(stats, #n, &u64_stat_ops, img->n)
     add_stat(bytes_read);
     add_stat(bytes_written);
+    add_stat(bytes_discarded);
     add_stat(chunk_fetch_skips);
     add_stat(chunk_fetches);
+    add_stat(chunk_prefetches);
+    add_stat(chunk_fills);
+    add_stat(chunk_store_hits);
+    add_stat(chunk_shared_hits);
+    add_stat(memcache_hits);
+    add_stat(memcache_misses);
+    add_stat(fill_position);
     add_stat(chunk_dirties);
     add_stat(io_errors);
 #undef add_stat
 
 #define add_fixed32(n) _vmnetfs_fuse_add_file(stats, #n, &u32_fixed_ops, &img->n)
     add_fixed32(chunk_size);
+    add_fixed32(modified_persisted);
+    add_fixed32(modified_resumed);
 #undef add_fixed
 
     _vmnetfs_fuse_add_file(stats, "chunks", &chunks_ops, img);
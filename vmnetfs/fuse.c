@@ -205,6 +205,20 @@ static int do_write(const char *path G_GNUC_UNUSED, const char *buf,
     }
 }
 
+#if FUSE_VERSION >= 29
+static int do_fallocate(const char *path G_GNUC_UNUSED, int mode,
+        off_t start, off_t length, struct fuse_file_info *fi)
+{
+    struct vmnetfs_fuse_fh *fh = (void *) (uintptr_t) fi->fh;
+
+    if (fh->ops->fallocate) {
+        return fh->ops->fallocate(fh, mode, start, length);
+    } else {
+        return -EOPNOTSUPP;
+    }
+}
+#endif
+
 static int do_poll(const char *path G_GNUC_UNUSED, struct fuse_file_info *fi,
         struct fuse_pollhandle *ph, unsigned *reventsp)
 {
@@ -321,6 +335,9 @@ static const struct fuse_operations fuse_ops = {
     .open = do_open,
     .read = do_read,
     .write = do_write,
+#if FUSE_VERSION >= 29
+    .fallocate = do_fallocate,
+#endif
     .poll = do_poll,
     .release = do_release,
     .opendir = do_opendir,
@@ -32,19 +32,50 @@ struct chunk_lock {
     struct vmnetfs_cond *available;
     bool busy;
     uint32_t waiters;
+    /* Streaming segment holding the lock, or NULL.  A reader may take
+       the lock away from the segment; see _chunk_trylock(). */
+    struct stream_segment *segment;
 };
 
-struct stream_state {
+/* Streaming will not split the image into segments smaller than this */
+#define STREAM_MIN_SEGMENT_CHUNKS 256
+/* How long a segment pauses while an earlier segment has waiters */
+#define STREAM_YIELD_USEC 10000
+/* A reader waits for the stream, rather than fetching the chunk itself,
+   if the chunk is less than this many chunks ahead of the stream */
+#define STREAM_STEAL_DISTANCE 16
+/* Delay before retrying a failed stream, in seconds; doubles after each
+   consecutive failure */
+#define STREAM_RETRY_DELAY 1
+#define STREAM_RETRY_MAX_DELAY 30
+/* Give up after this many consecutive failures without progress */
+#define STREAM_MAX_FAILURES 10
+/* Largest number of chunks fetched together to satisfy a single miss */
+#define DEMAND_FETCH_MAX_CHUNKS 64
+/* With a shared tier, a streaming request covers at most this many
+   chunks, so we don't check too far ahead for chunks the tier has */
+#define STREAM_SHARED_LOOKAHEAD 1024
+
+struct stream_segment {
+    struct vmnetfs_image *img;
     uint64_t start_chunk;
-    uint64_t chunks;
+    uint64_t end_chunk;     /* exclusive */
+    uint64_t next_chunk;    /* first chunk still locked; chunk_state lock */
+    bool retrying;          /* chunk_state lock */
     GThread *thread;
-    gint stop;  /* atomic operations only */
 
-    /* Private to stream thread */
+    /* Private to segment thread */
     char *buf;
     struct vmnetfs_cursor cur;
 };
 
+struct stream_state {
+    struct stream_segment *segments;
+    uint32_t nsegments;
+    gint stop;  /* atomic operations only */
+    gint running;  /* segments still streaming; atomic operations only */
+};
+
 static struct chunk_state *chunk_state_new(uint64_t initial_size)
 {
     struct chunk_state *cs;
@@ -87,6 +118,13 @@ static bool _set_image_size(struct vmnetfs_image *img, uint64_t new_size,
 static bool lock_and_copy_to_modified(struct vmnetfs_image *img,
         uint64_t chunk, GError **err);
 
+static bool chunk_is_wholly_modified(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    return _vmnetfs_bit_test(img->modified_map, chunk) &&
+            !_vmnetfs_ll_modified_is_incomplete(img, chunk);
+}
+
 /* chunk_state lock must be held, and may be dropped and reacquired by
    this function. */
 static bool expand_image(struct vmnetfs_image *img, uint64_t new_size,
@@ -99,9 +137,9 @@ static bool expand_image(struct vmnetfs_image *img, uint64_t new_size,
     g_assert(new_size > cs->image_size);
     last_chunk = (cs->image_size - 1) / img->chunk_size;
     if (cs->image_size % img->chunk_size != 0 &&
-            !_vmnetfs_bit_test(img->modified_map, last_chunk)) {
-        /* The current last chunk is a partial chunk and is not in the
-           modified cache.  Copy it there so that accesses to the tail
+            !chunk_is_wholly_modified(img, last_chunk)) {
+        /* The current last chunk is a partial chunk and is not wholly in
+           the modified cache.  Copy it there so that accesses to the tail
            of the chunk don't overrun the pristine cache. */
         g_mutex_unlock(cs->lock);
         ret = lock_and_copy_to_modified(img, last_chunk, err);
@@ -118,11 +156,23 @@ static bool expand_image(struct vmnetfs_image *img, uint64_t new_size,
     return ret;
 }
 
+/* chunk_state lock must be held.
+   Returns true if the chunk is held by a streaming segment which will not
+   reach it soon. */
+static bool _chunk_stream_can_release(struct chunk_lock *cl)
+{
+    return cl->segment != NULL && (cl->segment->retrying || cl->chunk >=
+            cl->segment->next_chunk + STREAM_STEAL_DISTANCE);
+}
+
 /* chunk_state lock must be held.
    Returns false if the lock was not acquired because the FUSE request
    was interrupted.  Optionally stores the current image size in
    *image_size; this will not be reduced to impinge on the specified chunk
-   while the chunk lock is held. */
+   while the chunk lock is held.
+   If the chunk is claimed by a streaming segment that is still far away,
+   the claim passes to the caller, which is expected to fetch the chunk
+   itself.  The segment will skip the chunk when it gets there. */
 static bool G_GNUC_WARN_UNUSED_RESULT _chunk_trylock(struct chunk_state *cs,
         uint64_t chunk, uint64_t *image_size, GError **err)
 {
@@ -130,7 +180,10 @@ static bool G_GNUC_WARN_UNUSED_RESULT _chunk_trylock(struct chunk_state *cs,
     bool ret = true;
 
     cl = g_hash_table_lookup(cs->chunk_locks, &chunk);
-    if (cl != NULL) {
+    if (cl != NULL && _chunk_stream_can_release(cl)) {
+        /* Take over the streamer's claim; the lock stays busy */
+        cl->segment = NULL;
+    } else if (cl != NULL) {
         cl->waiters++;
         while (cl->busy &&
                 !_vmnetfs_cond_wait(cl->available, cs->lock)) {}
@@ -158,6 +211,26 @@ static bool G_GNUC_WARN_UNUSED_RESULT _chunk_trylock(struct chunk_state *cs,
     return ret;
 }
 
+/* chunk_state lock must be held.
+   Acquires the chunk lock only if it is not currently held or awaited by
+   any other thread.  Never blocks, so it is safe to call from threads
+   other than FUSE request handlers. */
+static bool G_GNUC_WARN_UNUSED_RESULT _chunk_trylock_nowait(
+        struct chunk_state *cs, uint64_t chunk)
+{
+    struct chunk_lock *cl;
+
+    if (g_hash_table_lookup(cs->chunk_locks, &chunk) != NULL) {
+        return false;
+    }
+    cl = g_slice_new0(struct chunk_lock);
+    cl->chunk = chunk;
+    cl->available = _vmnetfs_cond_new();
+    cl->busy = true;
+    g_hash_table_replace(cs->chunk_locks, &cl->chunk, cl);
+    return true;
+}
+
 /* Returns false if the lock was not acquired because the FUSE request
    was interrupted.  Optionally stores the current image size in
    *image_size; this will not be reduced to impinge on the specified chunk
@@ -204,6 +277,7 @@ static void _chunk_unlock(struct chunk_state *cs, uint64_t chunk)
 
     cl = g_hash_table_lookup(cs->chunk_locks, &chunk);
     g_assert(cl != NULL);
+    cl->segment = NULL;
     if (cl->waiters > 0) {
         cl->busy = false;
         _vmnetfs_cond_signal(cl->available);
@@ -223,6 +297,23 @@ static void chunk_unlock(struct vmnetfs_image *img, uint64_t chunk)
     g_mutex_unlock(cs->lock);
 }
 
+/* chunk_state lock must be held.
+   Converts the streaming segment's claim on the chunk into an ordinary
+   chunk lock, so that readers can no longer take it away.  Returns false
+   if a reader has already taken over the chunk. */
+static bool _chunk_stream_reclaim(struct chunk_state *cs,
+        struct stream_segment *seg, uint64_t chunk)
+{
+    struct chunk_lock *cl;
+
+    cl = g_hash_table_lookup(cs->chunk_locks, &chunk);
+    if (cl == NULL || cl->segment != seg) {
+        return false;
+    }
+    cl->segment = NULL;
+    return true;
+}
+
 static bool io_interrupted(void *data G_GNUC_UNUSED)
 {
     return _vmnetfs_fuse_interrupted();
@@ -230,39 +321,310 @@ static bool io_interrupted(void *data G_GNUC_UNUSED)
 
 /* Fetch the specified byte range from the image. */
 static bool fetch_data(struct vmnetfs_image *img, void *buf, uint64_t start,
-        uint64_t count, GError **err)
+        uint64_t count, should_cancel_fn *should_cancel,
+        void *should_cancel_arg, GError **err)
 {
-    return _vmnetfs_transport_fetch(img->cpool, img->url, img->username,
-            img->password, img->etag, img->last_modified, buf,
-            start + img->fetch_offset, count, io_interrupted, NULL, err);
+    return _vmnetfs_transport_fetch(TRANSPORT_CLASS_DEMAND, img->url,
+            img->username, img->password, img->etag, img->last_modified,
+            buf, start + img->fetch_offset, count, should_cancel,
+            should_cancel_arg, err);
+}
+
+/* Returns true if a reader is waiting for the next chunk of a segment
+   earlier than @seg.  qemu restores memory sequentially, so the earliest
+   unfinished segment must not have to share bandwidth with later ones
+   while the guest is blocked on it. */
+static bool stream_earlier_segment_waited(struct stream_segment *seg)
+{
+    struct vmnetfs_image *img = seg->img;
+    struct chunk_state *cs = img->chunk_state;
+    struct stream_segment *cur;
+    struct chunk_lock *cl;
+    bool ret = false;
+
+    if (seg == img->stream->segments) {
+        return false;
+    }
+    g_mutex_lock(cs->lock);
+    for (cur = img->stream->segments; cur < seg; cur++) {
+        if (cur->next_chunk < cur->end_chunk) {
+            cl = g_hash_table_lookup(cs->chunk_locks, &cur->next_chunk);
+            if (cl != NULL && cl->waiters > 0) {
+                ret = true;
+                break;
+            }
+        }
+    }
+    g_mutex_unlock(cs->lock);
+    return ret;
+}
+
+/* Incomplete chunks in the modified cache count as missing, since their
+   pristine data is still needed. */
+static bool chunk_is_missing(struct vmnetfs_image *img, uint64_t chunk)
+{
+    return !_vmnetfs_bit_test(img->present_map, chunk) &&
+            (!_vmnetfs_bit_test(img->modified_map, chunk) ||
+            _vmnetfs_ll_modified_is_incomplete(img, chunk)) &&
+            !_vmnetfs_writeback_contains(img, chunk);
+}
+
+/* Like chunk_is_missing(), but also checks whether another vmnetfs
+   process has added the chunk to the pristine cache.  Chunk lock must be
+   held. */
+static bool chunk_is_missing_shared(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    return chunk_is_missing(img, chunk) &&
+            !_vmnetfs_ll_pristine_refresh_chunk(img, chunk);
+}
+
+/* Like chunk_is_missing_shared(), for callers not holding the chunk lock.
+   A chunk locked by another thread is left to the lock holder, and is
+   reported as not missing. */
+static bool chunk_is_missing_shared_unlocked(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    struct chunk_state *cs = img->chunk_state;
+    bool locked;
+    bool ret;
+
+    g_mutex_lock(cs->lock);
+    locked = _chunk_trylock_nowait(cs, chunk);
+    g_mutex_unlock(cs->lock);
+    if (!locked) {
+        return false;
+    }
+    ret = chunk_is_missing_shared(img, chunk);
+    chunk_unlock(img, chunk);
+    return ret;
+}
+
+static bool run_chunk_is_missing(struct vmnetfs_image *img, uint64_t chunk,
+        bool chunks_locked)
+{
+    if (chunks_locked) {
+        return chunk_is_missing_shared(img, chunk);
+    }
+    return chunk_is_missing_shared_unlocked(img, chunk);
+}
+
+/* Wait for other processes to finish fetching any of the specified
+   chunks, then narrow the run to exclude chunks at either end that are no
+   longer missing.  If @chunks_locked is false, the caller holds none of
+   the chunk locks of the run, and each chunk is locked while it is
+   checked.  The fetch locks of the remaining run are held on return.
+   Returns false only if @should_cancel reports that the operation was
+   cancelled. */
+static bool lock_fetch_run(struct vmnetfs_image *img, uint64_t *start_chunk,
+        uint64_t *count, bool chunks_locked, should_cancel_fn *should_cancel,
+        void *should_cancel_arg, GError **err)
+{
+    if (!_vmnetfs_ll_pristine_lock_fetch(img, *start_chunk, *count,
+            should_cancel, should_cancel_arg, err)) {
+        return false;
+    }
+    while (*count > 0 && !run_chunk_is_missing(img, *start_chunk,
+            chunks_locked)) {
+        _vmnetfs_ll_pristine_unlock_fetch(img, (*start_chunk)++, 1);
+        --*count;
+    }
+    while (*count > 0 && !run_chunk_is_missing(img,
+            *start_chunk + *count - 1, chunks_locked)) {
+        _vmnetfs_ll_pristine_unlock_fetch(img, *start_chunk + --*count, 1);
+    }
+    return true;
+}
+
+/* Queue a newly-obtained chunk for the pristine cache, and merge it into
+   the modified cache if the guest has partially overwritten it.  Chunk
+   lock and fetch lock must be held. */
+static void add_chunk(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t length, bool publish)
+{
+    GError *err = NULL;
+
+    _vmnetfs_writeback_add(img, data, chunk, length, publish);
+    if (_vmnetfs_ll_modified_is_incomplete(img, chunk) &&
+            !_vmnetfs_ll_modified_merge(img, data, chunk, &err)) {
+        /* We'll try again when the guest reads it */
+        g_warning("Couldn't merge chunk %"PRIu64": %s", chunk,
+                err->message);
+        g_clear_error(&err);
+    }
+}
+
+/* Copy a missing chunk from the shared tier into the pristine cache,
+   handing its fetch lock to the writeback thread.  Chunk lock and fetch
+   lock must be held.  Returns false if the shared tier doesn't have the
+   chunk. */
+static bool promote_shared_chunk(struct vmnetfs_image *img, uint64_t chunk)
+{
+    uint32_t length;
+    char *buf;
+    bool ret;
+
+    length = MIN(img->initial_size - chunk * img->chunk_size,
+            img->chunk_size);
+    buf = g_malloc(length);
+    ret = _vmnetfs_ll_pristine_read_shared(img, buf, chunk, length);
+    if (ret) {
+        add_chunk(img, buf, chunk, length, false);
+    }
+    g_free(buf);
+    return ret;
+}
+
+static void trim_chunk(struct vmnetfs_image *img, uint64_t chunk,
+        bool fetch_locked)
+{
+    /* Pending chunks' fetch locks belong to the writeback thread */
+    if (fetch_locked && !_vmnetfs_writeback_contains(img, chunk)) {
+        _vmnetfs_ll_pristine_unlock_fetch(img, chunk, 1);
+    }
+}
+
+/* Narrow a run of chunks to exclude chunks at either end that are no
+   longer missing.  If @fetch_locked is true, the fetch locks of the run
+   are held, and are released for excluded chunks. */
+static void trim_run(struct vmnetfs_image *img, uint64_t *start_chunk,
+        uint64_t *count, bool fetch_locked)
+{
+    while (*count > 0 && !chunk_is_missing(img, *start_chunk)) {
+        trim_chunk(img, (*start_chunk)++, fetch_locked);
+        --*count;
+    }
+    while (*count > 0 && !chunk_is_missing(img, *start_chunk + *count - 1)) {
+        trim_chunk(img, *start_chunk + --*count, fetch_locked);
+    }
+}
+
+/* Fetch a run of missing chunks from the origin with a single request and
+   queue them for writing to the pristine cache.  Chunk locks and fetch
+   locks must be held. */
+static bool fetch_run(struct vmnetfs_image *img, uint64_t start_chunk,
+        uint64_t count, should_cancel_fn *should_cancel,
+        void *should_cancel_arg, GError **err)
+{
+    uint64_t start;
+    uint64_t length;
+    uint64_t chunk;
+    char *buf;
+
+    start = start_chunk * img->chunk_size;
+    length = MIN(img->initial_size - start, count * img->chunk_size);
+    buf = g_malloc(length);
+    _vmnetfs_u64_stat_increment(img->chunk_fetches, count);
+    _vmnetfs_prefetch_demand(img);
+    if (!fetch_data(img, buf, start, length, should_cancel,
+            should_cancel_arg, err)) {
+        _vmnetfs_ll_pristine_unlock_fetch(img, start_chunk, count);
+        g_free(buf);
+        return false;
+    }
+    for (chunk = start_chunk; chunk < start_chunk + count; chunk++) {
+        if (_vmnetfs_ll_pristine_refresh_chunk(img, chunk)) {
+            _vmnetfs_ll_pristine_unlock_fetch(img, chunk, 1);
+            continue;
+        }
+        _vmnetfs_bit_set(img->fetched_map, chunk);
+        add_chunk(img, buf + (chunk - start_chunk) * img->chunk_size, chunk,
+                MIN(img->initial_size - chunk * img->chunk_size,
+                img->chunk_size), true);
+    }
+    g_free(buf);
+    return true;
+}
+
+/* Fetch a run of chunks and queue them for writing to the pristine cache.
+   Chunks found in the shared tier are taken from there instead, and the
+   remaining missing chunks are fetched from the origin with one request
+   per contiguous run.  Chunk locks must be held. */
+static bool fetch_chunks(struct vmnetfs_image *img, uint64_t start_chunk,
+        uint64_t count, should_cancel_fn *should_cancel,
+        void *should_cancel_arg, GError **err)
+{
+    uint64_t chunk;
+    uint64_t run;
+
+    if (!lock_fetch_run(img, &start_chunk, &count, true, should_cancel,
+            should_cancel_arg, err)) {
+        return false;
+    }
+    if (img->shared_path != NULL) {
+        for (chunk = start_chunk; chunk < start_chunk + count; chunk++) {
+            promote_shared_chunk(img, chunk);
+        }
+        trim_run(img, &start_chunk, &count, true);
+    }
+    while (count > 0) {
+        for (run = 1; run < count && chunk_is_missing(img,
+                start_chunk + run); run++) {}
+        if (!fetch_run(img, start_chunk, run, should_cancel,
+                should_cancel_arg, err)) {
+            for (chunk = start_chunk + run; chunk < start_chunk + count;
+                    chunk++) {
+                trim_chunk(img, chunk, true);
+            }
+            return false;
+        }
+        start_chunk += run;
+        count -= run;
+        trim_run(img, &start_chunk, &count, true);
+    }
+    return true;
 }
 
 static bool stream_callback(void *arg, const void *buf, uint64_t count,
-        GError **err)
+        GError **err G_GNUC_UNUSED)
 {
-    struct vmnetfs_image *img = arg;
-    struct stream_state *state = img->stream;
-    struct vmnetfs_cursor *cur = &state->cur;
+    struct stream_segment *seg = arg;
+    struct vmnetfs_image *img = seg->img;
+    struct chunk_state *cs = img->chunk_state;
+    struct vmnetfs_cursor *cur = &seg->cur;
     const char *data = buf;
     uint64_t cur_count = 0;
+    bool owned;
+
+    /* Stop reading from the socket, letting TCP flow control give our
+       share of the link to the segment the guest is waiting for. */
+    while (!g_atomic_int_get(&img->stream->stop) &&
+            stream_earlier_segment_waited(seg)) {
+        g_usleep(STREAM_YIELD_USEC);
+    }
 
     while (_vmnetfs_cursor_chunk(cur, cur_count) && count > 0) {
         cur_count = MIN(count, cur->length);
-        memcpy(state->buf + cur->offset, data, cur_count);
+        memcpy(seg->buf + cur->offset, data, cur_count);
         data += cur_count;
         count -= cur_count;
 
         if (cur_count == cur->length) {
-            /* End of chunk */
-            _vmnetfs_bit_set(img->fetched_map, cur->chunk);
-            if (!_vmnetfs_ll_pristine_write_chunk(img, state->buf,
-                    cur->chunk, cur->offset + cur->length, err)) {
-                return false;
+            /* End of chunk.  If a reader took the chunk away from us,
+               it has already been fetched out of order; skip it. */
+            g_mutex_lock(cs->lock);
+            owned = _chunk_stream_reclaim(cs, seg, cur->chunk);
+            g_mutex_unlock(cs->lock);
+            if (owned && !_vmnetfs_ll_pristine_refresh_chunk(img,
+                    cur->chunk)) {
+                _vmnetfs_bit_set(img->fetched_map, cur->chunk);
+                add_chunk(img, seg->buf, cur->chunk,
+                        cur->offset + cur->length, true);
+            } else {
+                _vmnetfs_ll_pristine_unlock_fetch(img, cur->chunk, 1);
             }
-            if (cur->offset + cur->length == img->chunk_size) {
-                /* We are advancing to the next chunk, so release lock */
-                chunk_unlock(img, cur->chunk);
+            /* Keep the fetch lock window moving */
+            if (cur->chunk + STREAM_STEAL_DISTANCE < seg->end_chunk) {
+                _vmnetfs_ll_pristine_trylock_fetch(img,
+                        cur->chunk + STREAM_STEAL_DISTANCE, 1);
             }
+            /* We are advancing to the next chunk, so release lock */
+            g_mutex_lock(cs->lock);
+            if (owned) {
+                _chunk_unlock(cs, cur->chunk);
+            }
+            seg->next_chunk = cur->chunk + 1;
+            g_mutex_unlock(cs->lock);
         }
     }
     /* transport should ensure we don't receive more data than requested */
@@ -278,39 +640,202 @@ static bool stream_should_stop(void *arg)
     return g_atomic_int_get(&img->stream->stop);
 }
 
-static bool do_stream(struct vmnetfs_image *img, GError **err)
+/* Wait before retrying a failed stream.  Readers may take over any of the
+   segment's chunks in the meantime, including those they are already
+   waiting for.  Returns false if streaming was stopped. */
+static bool stream_backoff(struct stream_segment *seg, unsigned delay)
 {
-    struct stream_state *state = img->stream;
+    struct vmnetfs_image *img = seg->img;
     struct chunk_state *cs = img->chunk_state;
-    uint64_t offset = state->start_chunk * img->chunk_size;
+    struct chunk_lock *cl;
     uint64_t chunk;
-    GError *my_err = NULL;
+    unsigned i;
+
+    /* Don't make other processes wait for us either */
+    g_mutex_lock(cs->lock);
+    _vmnetfs_ll_pristine_unlock_fetch(img, seg->next_chunk,
+            seg->end_chunk - seg->next_chunk);
+    seg->retrying = true;
+    for (chunk = seg->next_chunk; chunk < seg->end_chunk; chunk++) {
+        cl = g_hash_table_lookup(cs->chunk_locks, &chunk);
+        if (cl != NULL && cl->segment == seg && cl->waiters > 0) {
+            _chunk_unlock(cs, chunk);
+        }
+    }
+    g_mutex_unlock(cs->lock);
 
-    /* Set up */
-    _vmnetfs_cursor_start(img, &state->cur, offset,
-            img->initial_size - offset);
+    for (i = 0; i < delay * 10 && !stream_should_stop(img); i++) {
+        g_usleep(G_USEC_PER_SEC / 10);
+    }
 
-    /* Fetch data */
-    state->buf = g_malloc(img->chunk_size);
-    _vmnetfs_transport_fetch_stream_once(img->cpool, img->url,
-            img->username, img->password, img->etag, img->last_modified,
-            stream_callback, img, img->fetch_offset + offset,
-            img->initial_size - offset, stream_should_stop, img, &my_err);
-    g_free(state->buf);
-    /* transport will report short reads */
+    g_mutex_lock(cs->lock);
+    seg->retrying = false;
+    g_mutex_unlock(cs->lock);
+    return !stream_should_stop(img);
+}
+
+/* Whether the segment still needs to fetch the chunk from the origin. */
+static bool stream_chunk_wanted(struct stream_segment *seg, uint64_t chunk)
+{
+    struct vmnetfs_image *img = seg->img;
+    struct chunk_state *cs = img->chunk_state;
+    struct chunk_lock *cl;
+    bool owned;
 
-    /* Release remaining chunk locks */
     g_mutex_lock(cs->lock);
-    for (chunk = state->cur.chunk; chunk < state->chunks; chunk++) {
+    cl = g_hash_table_lookup(cs->chunk_locks, &chunk);
+    owned = cl != NULL && cl->segment == seg;
+    g_mutex_unlock(cs->lock);
+    return owned && chunk_is_missing(img, chunk) &&
+            !_vmnetfs_ll_pristine_shared_contains(img, chunk);
+}
+
+/* Move the segment past a chunk without streaming it.  A missing chunk
+   is copied from the shared tier, or fetched on its own if that
+   fails. */
+static void stream_skip_chunk(struct stream_segment *seg, uint64_t chunk)
+{
+    struct vmnetfs_image *img = seg->img;
+    struct chunk_state *cs = img->chunk_state;
+    GError *err = NULL;
+    bool owned;
+
+    g_mutex_lock(cs->lock);
+    owned = _chunk_stream_reclaim(cs, seg, chunk);
+    g_mutex_unlock(cs->lock);
+    if (owned && chunk_is_missing(img, chunk)) {
+        if (!fetch_chunks(img, chunk, 1, stream_should_stop, img, &err)) {
+            /* Readers will fetch it when they need it */
+            if (!g_error_matches(err, VMNETFS_IO_ERROR,
+                    VMNETFS_IO_ERROR_INTERRUPTED)) {
+                g_warning("Couldn't fetch chunk %"PRIu64": %s", chunk,
+                        err->message);
+            }
+            g_clear_error(&err);
+        }
+    } else {
+        _vmnetfs_ll_pristine_unlock_fetch(img, chunk, 1);
+    }
+    g_mutex_lock(cs->lock);
+    if (owned) {
         _chunk_unlock(cs, chunk);
     }
+    seg->next_chunk = chunk + 1;
+    g_mutex_unlock(cs->lock);
+}
+
+/* Skip chunks at the start of the rest of the segment that don't need to
+   be streamed, and return the end of the run of chunks that do. */
+static uint64_t stream_next_run(struct stream_segment *seg)
+{
+    struct vmnetfs_image *img = seg->img;
+    uint64_t limit;
+    uint64_t end;
+
+    while (seg->next_chunk < seg->end_chunk && !stream_should_stop(img) &&
+            !stream_chunk_wanted(seg, seg->next_chunk)) {
+        stream_skip_chunk(seg, seg->next_chunk);
+    }
+    if (seg->next_chunk == seg->end_chunk) {
+        return seg->end_chunk;
+    }
+    limit = seg->end_chunk;
+    if (img->shared_path != NULL) {
+        limit = MIN(limit, seg->next_chunk + STREAM_SHARED_LOOKAHEAD);
+    }
+    for (end = seg->next_chunk + 1; end < limit &&
+            stream_chunk_wanted(seg, end); end++) {}
+    /* We may have skipped past the fetch lock window */
+    _vmnetfs_ll_pristine_trylock_fetch(img, seg->next_chunk,
+            MIN(end - seg->next_chunk, STREAM_STEAL_DISTANCE));
+    return end;
+}
+
+/* Stream the segment, one request per run of chunks that need streaming,
+   resuming from the first incomplete chunk after network errors until
+   the segment is complete or streaming is stopped. */
+static bool do_stream(struct stream_segment *seg, GError **err)
+{
+    struct vmnetfs_image *img = seg->img;
+    struct chunk_state *cs = img->chunk_state;
+    uint64_t offset = seg->next_chunk * img->chunk_size;
+    uint64_t end;
+    uint64_t resume_chunk;
+    uint64_t chunk;
+    unsigned delay = STREAM_RETRY_DELAY;
+    unsigned failures = 0;
+    GError *my_err = NULL;
+
+    seg->buf = g_malloc(img->chunk_size);
+    while (true) {
+        /* Set up */
+        end = stream_next_run(seg);
+        if (stream_should_stop(img)) {
+            g_set_error(&my_err, VMNETFS_IO_ERROR,
+                    VMNETFS_IO_ERROR_INTERRUPTED, "Operation interrupted");
+            break;
+        }
+        if (seg->next_chunk == seg->end_chunk) {
+            break;
+        }
+        resume_chunk = seg->next_chunk;
+        offset = resume_chunk * img->chunk_size;
+        end = MIN(end * img->chunk_size, img->initial_size);
+        _vmnetfs_cursor_start(img, &seg->cur, offset, end - offset);
+
+        /* Fetch data */
+        if (_vmnetfs_transport_fetch_stream_once(TRANSPORT_CLASS_STREAM,
+                img->url, img->username, img->password, img->etag,
+                img->last_modified, stream_callback, seg,
+                img->fetch_offset + offset, end - offset,
+                stream_should_stop, img, &my_err)) {
+            failures = 0;
+            delay = STREAM_RETRY_DELAY;
+            continue;
+        }
+        /* transport will report short reads */
+
+        if (!g_error_matches(my_err, VMNETFS_TRANSPORT_ERROR,
+                VMNETFS_TRANSPORT_ERROR_NETWORK)) {
+            break;
+        }
+        if (seg->next_chunk > resume_chunk) {
+            failures = 0;
+            delay = STREAM_RETRY_DELAY;
+        }
+        if (++failures >= STREAM_MAX_FAILURES) {
+            break;
+        }
+        g_warning("Image streaming interrupted after %"PRIu64" bytes, "
+                "retrying in %u s: %s", offset + seg->cur.io_offset, delay,
+                my_err->message);
+        g_clear_error(&my_err);
+        if (!stream_backoff(seg, delay)) {
+            g_set_error(&my_err, VMNETFS_IO_ERROR,
+                    VMNETFS_IO_ERROR_INTERRUPTED, "Operation interrupted");
+            break;
+        }
+        delay = MIN(delay * 2, STREAM_RETRY_MAX_DELAY);
+    }
+    g_free(seg->buf);
+
+    /* Release remaining chunk locks, except those taken over by readers */
+    g_mutex_lock(cs->lock);
+    _vmnetfs_ll_pristine_unlock_fetch(img, seg->next_chunk,
+            seg->end_chunk - seg->next_chunk);
+    for (chunk = seg->next_chunk; chunk < seg->end_chunk; chunk++) {
+        if (_chunk_stream_reclaim(cs, seg, chunk)) {
+            _chunk_unlock(cs, chunk);
+        }
+    }
+    seg->next_chunk = seg->end_chunk;
     g_mutex_unlock(cs->lock);
 
     /* Handle fetch errors */
     if (my_err) {
         g_propagate_prefixed_error(err, my_err,
                 "Image streaming failed after %"PRIu64" bytes: ",
-                state->cur.io_offset);
+                offset + seg->cur.io_offset);
         return false;
     }
 
@@ -319,76 +844,162 @@ static bool do_stream(struct vmnetfs_image *img, GError **err)
 
 static void *stream_thread(void *data)
 {
-    struct vmnetfs_image *img = data;
+    struct stream_segment *seg = data;
     GError *my_err = NULL;
 
-    if (!do_stream(img, &my_err)) {
+    if (!do_stream(seg, &my_err)) {
         if (!g_error_matches(my_err, VMNETFS_IO_ERROR,
                 VMNETFS_IO_ERROR_INTERRUPTED)) {
             g_warning("%s", my_err->message);
         }
         g_clear_error(&my_err);
     }
+    if (g_atomic_int_dec_and_test(&seg->img->stream->running)) {
+        /* Streaming is over.  Other processes don't retry the claim, so
+           this only lets a later vmnetfs stream what we didn't fetch. */
+        _vmnetfs_ll_pristine_release_stream(seg->img);
+    }
     return NULL;
 }
 
+static void stream_free(struct vmnetfs_image *img)
+{
+    g_free(img->stream->segments);
+    g_slice_free(struct stream_state, img->stream);
+    img->stream = NULL;
+}
+
 /* Must run before FUSE starts serving requests. */
 static bool stream_start(struct vmnetfs_image *img, GError **err)
 {
     struct chunk_state *cs = img->chunk_state;
+    struct stream_segment *seg;
+    struct chunk_lock *cl;
     uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
             img->chunk_size;
     uint64_t start_chunk;
     uint64_t chunk;
+    uint64_t missing = 0;
+    uint64_t per_segment;
+    uint64_t count;
+    uint32_t nsegments;
+    uint32_t i;
 
     g_assert(!img->stream);
 
-    /* If we already have the last chunk, we don't need to stream */
-    if (_vmnetfs_bit_test(img->present_map, chunks - 1)) {
+    /* Count missing chunks.  Zero chunks are present, so they are never
+       streamed.  If nothing is missing, we don't need to stream. */
+    start_chunk = chunks;
+    for (chunk = chunks; chunk > 0; chunk--) {
+        if (chunk_is_missing(img, chunk - 1)) {
+            start_chunk = chunk - 1;
+            missing++;
+        }
+    }
+    if (missing == 0) {
         return true;
     }
 
-    /* Find first missing chunk */
-    for (start_chunk = 0; start_chunk < chunks; start_chunk++) {
-        if (!_vmnetfs_bit_test(img->present_map, start_chunk)) {
-            break;
-        }
+    /* If another vmnetfs process is streaming the image, readers will
+       wait for its fetches instead */
+    if (!_vmnetfs_ll_pristine_claim_stream(img)) {
+        return true;
     }
 
     /* Lock chunks to be streamed */
     g_mutex_lock(cs->lock);
     for (chunk = start_chunk; chunk < chunks; chunk++) {
-        if (!_chunk_trylock(cs, chunk, NULL, err)) {
+        if (chunk_is_missing(img, chunk) &&
+                !_chunk_trylock(cs, chunk, NULL, err)) {
             goto bad_locked;
         }
     }
     g_mutex_unlock(cs->lock);
 
-    /* Allocate state */
+    /* Divide the missing chunks into segments, one per connection.
+       Segments skip the present chunks between them. */
+    nsegments = MAX(img->stream_connections, 1);
+    nsegments = MIN(nsegments, (missing + STREAM_MIN_SEGMENT_CHUNKS - 1) /
+            STREAM_MIN_SEGMENT_CHUNKS);
+    per_segment = (missing + nsegments - 1) / nsegments;
     img->stream = g_slice_new0(struct stream_state);
-    img->stream->start_chunk = start_chunk;
-    img->stream->chunks = chunks;
+    img->stream->segments = g_new0(struct stream_segment, nsegments);
+    img->stream->nsegments = nsegments;
+    chunk = start_chunk;
+    for (i = 0; i < nsegments; i++) {
+        seg = &img->stream->segments[i];
+        seg->img = img;
+        while (chunk < chunks && !chunk_is_missing(img, chunk)) {
+            chunk++;
+        }
+        seg->start_chunk = chunk;
+        for (count = 0; chunk < chunks && (count < per_segment ||
+                i == nsegments - 1); chunk++) {
+            if (chunk_is_missing(img, chunk)) {
+                count++;
+            }
+        }
+        seg->end_chunk = chunk;
+        seg->next_chunk = seg->start_chunk;
+    }
 
-    /* Start streamer */
-    img->stream->thread = g_thread_create(stream_thread, img, TRUE, err);
-    if (!img->stream->thread) {
-        goto bad;
+    /* Hand each segment its chunk locks, so that readers can take them
+       over.  Other processes wait only for chunks the segment will reach
+       soon. */
+    g_mutex_lock(cs->lock);
+    for (i = 0; i < nsegments; i++) {
+        seg = &img->stream->segments[i];
+        for (chunk = seg->start_chunk; chunk < seg->end_chunk; chunk++) {
+            cl = g_hash_table_lookup(cs->chunk_locks, &chunk);
+            if (cl != NULL) {
+                cl->segment = seg;
+            }
+        }
+        _vmnetfs_ll_pristine_trylock_fetch(img, seg->start_chunk,
+                MIN(seg->end_chunk - seg->start_chunk,
+                STREAM_STEAL_DISTANCE));
+    }
+    g_mutex_unlock(cs->lock);
+
+    /* Start streamers */
+    img->stream->running = nsegments;
+    for (i = 0; i < nsegments; i++) {
+        seg = &img->stream->segments[i];
+        seg->thread = g_thread_create(stream_thread, seg, TRUE, err);
+        if (!seg->thread) {
+            goto bad_threads;
+        }
     }
 
     return true;
 
-bad:
+bad_threads:
+    /* Running streamers release their own chunks */
+    g_atomic_int_set(&img->stream->stop, 1);
+    chunk = seg->start_chunk;
+    for (seg = img->stream->segments; seg->thread != NULL; seg++) {
+        g_thread_join(seg->thread);
+    }
     g_mutex_lock(cs->lock);
-bad_locked:
-    do {
-        _chunk_unlock(cs, --chunk);
-    } while (chunk > start_chunk);
+    _vmnetfs_ll_pristine_unlock_fetch(img, chunk, chunks - chunk);
+    for (; chunk < chunks; chunk++) {
+        if (g_hash_table_lookup(cs->chunk_locks, &chunk) != NULL) {
+            _chunk_unlock(cs, chunk);
+        }
+    }
     g_mutex_unlock(cs->lock);
+    _vmnetfs_ll_pristine_release_stream(img);
+    stream_free(img);
+    return false;
 
-    if (img->stream) {
-        g_slice_free(struct stream_state, img->stream);
-        img->stream = NULL;
+bad_locked:
+    while (chunk > start_chunk) {
+        if (chunk_is_missing(img, --chunk)) {
+            _chunk_unlock(cs, chunk);
+        }
     }
+    g_mutex_unlock(cs->lock);
+    _vmnetfs_ll_pristine_release_stream(img);
     return false;
 }
 
@@ -399,9 +1010,23 @@ static void stream_stop(struct vmnetfs_image *img)
     }
 }
 
+static void stream_destroy(struct vmnetfs_image *img)
+{
+    uint32_t i;
+
+    if (img->stream) {
+        stream_stop(img);
+        for (i = 0; i < img->stream->nsegments; i++) {
+            g_thread_join(img->stream->segments[i].thread);
+        }
+        stream_free(img);
+    }
+}
+
 bool _vmnetfs_io_init(struct vmnetfs_image *img, GError **err)
 {
     GList *cur;
+    uint64_t image_size;
 
     img->bitmaps = _vmnetfs_bit_group_new((img->initial_size +
             img->chunk_size - 1) / img->chunk_size);
@@ -409,21 +1034,13 @@ bool _vmnetfs_io_init(struct vmnetfs_image *img, GError **err)
         _vmnetfs_bit_group_free(img->bitmaps);
         return false;
     }
-    if (!_vmnetfs_ll_modified_init(img, err)) {
-        _vmnetfs_ll_pristine_destroy(img);
-        _vmnetfs_bit_group_free(img->bitmaps);
-        return false;
-    }
-    img->cpool = _vmnetfs_transport_pool_new(err);
-    if (img->cpool == NULL) {
-        _vmnetfs_ll_modified_destroy(img);
+    if (!_vmnetfs_ll_modified_init(img, &image_size, err)) {
         _vmnetfs_ll_pristine_destroy(img);
         _vmnetfs_bit_group_free(img->bitmaps);
         return false;
     }
     for (cur = img->cookies; cur != NULL; cur = cur->next) {
-        if (!_vmnetfs_transport_pool_set_cookie(img->cpool, cur->data, err)) {
-            _vmnetfs_transport_pool_free(img->cpool);
+        if (!_vmnetfs_transport_set_cookie(cur->data, err)) {
             _vmnetfs_ll_modified_destroy(img);
             _vmnetfs_ll_pristine_destroy(img);
             _vmnetfs_bit_group_free(img->bitmaps);
@@ -432,7 +1049,18 @@ bool _vmnetfs_io_init(struct vmnetfs_image *img, GError **err)
     }
     img->accessed_map = _vmnetfs_bit_new(img->bitmaps, false);
     img->fetched_map = _vmnetfs_bit_new(img->bitmaps, false);
-    img->chunk_state = chunk_state_new(img->initial_size);
+    if (!_vmnetfs_writeback_init(img, err)) {
+        _vmnetfs_bit_free(img->fetched_map);
+        _vmnetfs_bit_free(img->accessed_map);
+        _vmnetfs_ll_modified_destroy(img);
+        _vmnetfs_ll_pristine_destroy(img);
+        _vmnetfs_bit_group_free(img->bitmaps);
+        return false;
+    }
+    img->chunk_state = chunk_state_new(image_size);
+    _vmnetfs_profile_init(img);
+    _vmnetfs_predict_init(img);
+    _vmnetfs_memcache_init(img);
     return true;
 }
 
@@ -447,6 +1075,10 @@ void _vmnetfs_io_open(struct vmnetfs_image *img)
             g_clear_error(&my_err);
         }
     }
+    if (!_vmnetfs_prefetch_start(img, &my_err)) {
+        g_warning("Couldn't start prefetching: %s", my_err->message);
+        g_clear_error(&my_err);
+    }
 }
 
 void _vmnetfs_io_close(struct vmnetfs_image *img)
@@ -454,6 +1086,9 @@ void _vmnetfs_io_close(struct vmnetfs_image *img)
     struct chunk_state *cs = img->chunk_state;
 
     stream_stop(img);
+    _vmnetfs_prefetch_stop(img);
+    _vmnetfs_profile_save(img);
+    _vmnetfs_predict_save(img);
     _vmnetfs_bit_group_close(img->bitmaps);
 
     g_mutex_lock(cs->lock);
@@ -478,18 +1113,150 @@ void _vmnetfs_io_destroy(struct vmnetfs_image *img)
     if (img == NULL) {
         return;
     }
-    if (img->stream) {
-        stream_stop(img);
-        g_thread_join(img->stream->thread);
-        g_slice_free(struct stream_state, img->stream);
+    stream_destroy(img);
+    _vmnetfs_prefetch_destroy(img);
+    _vmnetfs_writeback_destroy(img);
+    if (img->chunk_state->image_closed) {
+        _vmnetfs_ll_modified_close(img, img->chunk_state->image_size);
+        _vmnetfs_ll_pristine_close(img);
     }
+    _vmnetfs_profile_destroy(img);
+    _vmnetfs_predict_destroy(img);
+    _vmnetfs_memcache_destroy(img);
     _vmnetfs_ll_modified_destroy(img);
     _vmnetfs_ll_pristine_destroy(img);
     chunk_state_free(img->chunk_state);
     _vmnetfs_bit_free(img->accessed_map);
     _vmnetfs_bit_free(img->fetched_map);
     _vmnetfs_bit_group_free(img->bitmaps);
-    _vmnetfs_transport_pool_free(img->cpool);
+}
+
+/* Chunk lock must be held. */
+static void mark_accessed(struct vmnetfs_image *img, uint64_t chunk)
+{
+    if (!_vmnetfs_bit_test(img->accessed_map, chunk)) {
+        _vmnetfs_bit_set(img->accessed_map, chunk);
+        _vmnetfs_profile_record(img, chunk);
+    }
+}
+
+/* Returns the number of chunks worth fetching together to satisfy a miss:
+   the largest power of two whose size is within the bandwidth-delay
+   product of the link, so that the extra data costs no more than one
+   additional round trip. */
+static uint64_t demand_fetch_chunks(struct vmnetfs_image *img)
+{
+    uint64_t bdp_chunks;
+    uint64_t count = 1;
+
+    bdp_chunks = _vmnetfs_transport_estimate_bdp(img->url) / img->chunk_size;
+    while (count * 2 <= MIN(bdp_chunks, DEMAND_FETCH_MAX_CHUNKS)) {
+        count *= 2;
+    }
+    return count;
+}
+
+/* Fetch a missing chunk into the pristine cache, along with any of its
+   missing neighbors in the surrounding aligned run of chunks if the link
+   makes that cheap.  Neighbors are only fetched if their locks can be
+   taken without waiting.  Chunk lock must be held. */
+static bool fetch_chunk_neighborhood(struct vmnetfs_image *img,
+        uint64_t chunk, GError **err)
+{
+    struct chunk_state *cs = img->chunk_state;
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t count = demand_fetch_chunks(img);
+    uint64_t window_start = chunk - chunk % count;
+    uint64_t window_end = MIN(window_start + count, chunks);
+    uint64_t start;
+    uint64_t end;
+    uint64_t cur;
+    bool ret;
+
+    g_mutex_lock(cs->lock);
+    for (start = chunk; start > window_start &&
+            chunk_is_missing(img, start - 1) &&
+            _chunk_trylock_nowait(cs, start - 1); start--) {}
+    for (end = chunk + 1; end < window_end && chunk_is_missing(img, end) &&
+            _chunk_trylock_nowait(cs, end); end++) {}
+    g_mutex_unlock(cs->lock);
+
+    /* Another thread may have fetched a neighbor before we locked it */
+    while (start < chunk && !chunk_is_missing(img, start)) {
+        chunk_unlock(img, start++);
+    }
+    while (end > chunk + 1 && !chunk_is_missing(img, end - 1)) {
+        chunk_unlock(img, --end);
+    }
+
+    ret = fetch_chunks(img, start, end - start, io_interrupted, NULL, err);
+
+    g_mutex_lock(cs->lock);
+    for (cur = start; cur < end; cur++) {
+        if (cur != chunk) {
+            _chunk_unlock(cs, cur);
+        }
+    }
+    g_mutex_unlock(cs->lock);
+    return ret;
+}
+
+/* Chunk lock must be held.  Misses read the whole chunk, so it can be
+   added to the memory cache.  Zero chunks are cheap to read and are kept
+   out of it. */
+static bool read_pristine(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length, GError **err)
+{
+    uint32_t chunk_len;
+    char *buf;
+
+    if (img->memcache == NULL || _vmnetfs_bit_test(img->zero_map, chunk)) {
+        return _vmnetfs_ll_pristine_read_chunk(img, data, chunk, offset,
+                length, err);
+    }
+    if (_vmnetfs_memcache_read(img, data, chunk, offset, length)) {
+        return true;
+    }
+    chunk_len = MIN(img->initial_size - chunk * img->chunk_size,
+            img->chunk_size);
+    buf = g_malloc(chunk_len);
+    if (!_vmnetfs_ll_pristine_read_chunk(img, buf, chunk, 0, chunk_len,
+            err)) {
+        g_free(buf);
+        return false;
+    }
+    memcpy(data, buf + offset, length);
+    _vmnetfs_memcache_insert(img, buf, chunk, chunk_len);
+    g_free(buf);
+    return true;
+}
+
+/* Fill in the clean sectors of an incomplete chunk from its pristine data,
+   fetching it if necessary.  Chunk lock must be held. */
+static bool merge_incomplete(struct vmnetfs_image *img, uint64_t chunk,
+        GError **err)
+{
+    uint32_t length;
+    char *buf;
+    bool ret;
+
+    if (chunk_is_missing(img, chunk) &&
+            !fetch_chunk_neighborhood(img, chunk, err)) {
+        return false;
+    }
+    /* A fetched chunk is merged as it arrives */
+    if (!_vmnetfs_ll_modified_is_incomplete(img, chunk)) {
+        return true;
+    }
+    length = MIN(img->initial_size - chunk * img->chunk_size,
+            img->chunk_size);
+    buf = g_malloc(length);
+    ret = (_vmnetfs_writeback_read(img, buf, chunk, 0, length) ||
+            read_pristine(img, buf, chunk, 0, length, err)) &&
+            _vmnetfs_ll_modified_merge(img, buf, chunk, err);
+    g_free(buf);
+    return ret;
 }
 
 static uint64_t read_chunk_unlocked(struct vmnetfs_image *img,
@@ -505,36 +1272,31 @@ static uint64_t read_chunk_unlocked(struct vmnetfs_image *img,
         return false;
     }
     length = MIN(image_size - chunk * img->chunk_size - offset, length);
-    _vmnetfs_bit_set(img->accessed_map, chunk);
+    mark_accessed(img, chunk);
     if (_vmnetfs_bit_test(img->modified_map, chunk)) {
+        if (!_vmnetfs_ll_modified_range_is_dirty(img, chunk, offset,
+                length) && !merge_incomplete(img, chunk, err)) {
+            return 0;
+        }
         if (!_vmnetfs_ll_modified_read_chunk(img, image_size, data, chunk,
                 offset, length, err)) {
             return 0;
         }
     } else {
-        /* If two vmnetfs instances are working out of the same pristine
-           cache, they will redundantly fetch chunks due to our failure to
-           keep the present map up to date. */
-        if (!_vmnetfs_bit_test(img->present_map, chunk)) {
-            uint64_t start = chunk * img->chunk_size;
-            uint64_t count = MIN(img->initial_size - start, img->chunk_size);
-            void *buf = g_malloc(count);
-
-            _vmnetfs_u64_stat_increment(img->chunk_fetches, 1);
-            if (!fetch_data(img, buf, start, count, err)) {
-                g_free(buf);
-                return 0;
-            }
-            _vmnetfs_bit_set(img->fetched_map, chunk);
-            bool ok = _vmnetfs_ll_pristine_write_chunk(img, buf, chunk,
-                    count, err);
-            g_free(buf);
-            if (!ok) {
+        /* If another vmnetfs instance sharing the pristine cache is
+           fetching the chunk, fetch_chunks() waits on its fetch lock and
+           then finds the chunk in the cache instead of fetching it
+           again. */
+        if (!_vmnetfs_bit_test(img->present_map, chunk) &&
+                !_vmnetfs_writeback_contains(img, chunk)) {
+            if (!fetch_chunk_neighborhood(img, chunk, err)) {
                 return 0;
             }
         }
-        if (!_vmnetfs_ll_pristine_read_chunk(img, data, chunk, offset,
-                length, err)) {
+        /* A newly-fetched chunk is served from memory until it has been
+           written to the pristine cache */
+        if (!_vmnetfs_writeback_read(img, data, chunk, offset, length) &&
+                !read_pristine(img, data, chunk, offset, length, err)) {
             return 0;
         }
     }
@@ -547,6 +1309,7 @@ uint64_t _vmnetfs_io_read_chunk(struct vmnetfs_image *img, void *data,
     uint64_t image_size;
     uint64_t ret;
 
+    _vmnetfs_prefetch_access(img, chunk);
     if (!chunk_trylock(img, chunk, &image_size, err)) {
         return false;
     }
@@ -556,6 +1319,144 @@ uint64_t _vmnetfs_io_read_chunk(struct vmnetfs_image *img, void *data,
     return ret;
 }
 
+/* Ensure that every chunk overlapping the specified byte range is in the
+   pristine or modified cache.  The missing chunks are locked as a group,
+   in ascending order, and each contiguous run of them is fetched with a
+   single request.  Must be called from a FUSE request handler. */
+bool _vmnetfs_io_fetch_range(struct vmnetfs_image *img, uint64_t start,
+        uint64_t count, GError **err)
+{
+    GArray *locked;
+    uint64_t end;
+    uint64_t chunk;
+    uint64_t run;
+    guint i;
+    bool ret = true;
+
+    end = MIN(start + count, MIN(img->initial_size,
+            _vmnetfs_io_get_image_size(img, NULL)));
+    if (start >= end) {
+        return true;
+    }
+
+    locked = g_array_new(FALSE, FALSE, sizeof(uint64_t));
+    for (chunk = start / img->chunk_size;
+            chunk <= (end - 1) / img->chunk_size; chunk++) {
+        if (chunk_is_missing(img, chunk)) {
+            if (!chunk_trylock(img, chunk, NULL, err)) {
+                ret = false;
+                break;
+            }
+            g_array_append_val(locked, chunk);
+        }
+    }
+
+    /* Another thread may have fetched some chunks while we were waiting
+       for their locks */
+    for (i = 0; ret && i < locked->len; i += MAX(run, 1)) {
+        chunk = g_array_index(locked, uint64_t, i);
+        for (run = 0; i + run < locked->len &&
+                g_array_index(locked, uint64_t, i + run) == chunk + run &&
+                chunk_is_missing(img, chunk + run); run++) {}
+        if (run > 0) {
+            ret = fetch_chunks(img, chunk, run, io_interrupted, NULL, err);
+        }
+    }
+
+    for (i = 0; i < locked->len; i++) {
+        chunk_unlock(img, g_array_index(locked, uint64_t, i));
+    }
+    g_array_free(locked, TRUE);
+    return ret;
+}
+
+/* Fetch a run of chunks into the pristine cache on behalf of a background
+   thread.  No chunk locks are held while waiting for the network, so
+   demand readers are never blocked behind a prefetch; if a demand reader
+   holds a chunk's lock when the data arrives, that chunk is skipped.
+   Chunks found in the shared tier are not fetched.  Returns the number of
+   chunks queued for the pristine cache. */
+uint64_t _vmnetfs_io_prefetch(struct vmnetfs_image *img, uint64_t start_chunk,
+        uint64_t count, enum transport_class cls,
+        should_cancel_fn *should_cancel, void *should_cancel_arg,
+        GError **err)
+{
+    struct chunk_state *cs = img->chunk_state;
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t chunk;
+    uint64_t start;
+    uint64_t length;
+    uint64_t fetched = 0;
+    uint64_t promoted = 0;
+    char *buf;
+    bool locked;
+
+    /* Trim chunks that have already been fetched or modified */
+    count = MIN(count, chunks - MIN(start_chunk, chunks));
+    trim_run(img, &start_chunk, &count, false);
+    if (count == 0) {
+        return 0;
+    }
+    if (!lock_fetch_run(img, &start_chunk, &count, false, should_cancel,
+            should_cancel_arg, err)) {
+        return 0;
+    }
+    if (img->shared_path != NULL) {
+        for (chunk = start_chunk; chunk < start_chunk + count; chunk++) {
+            g_mutex_lock(cs->lock);
+            locked = _chunk_trylock_nowait(cs, chunk);
+            g_mutex_unlock(cs->lock);
+            if (locked) {
+                if (chunk_is_missing(img, chunk) &&
+                        promote_shared_chunk(img, chunk)) {
+                    promoted++;
+                }
+                chunk_unlock(img, chunk);
+            }
+        }
+        trim_run(img, &start_chunk, &count, true);
+    }
+    if (count == 0) {
+        return promoted;
+    }
+
+    start = start_chunk * img->chunk_size;
+    length = MIN(img->initial_size - start, count * img->chunk_size);
+    buf = g_malloc(length);
+    if (!_vmnetfs_transport_fetch(cls, img->url, img->username,
+            img->password, img->etag, img->last_modified, buf,
+            start + img->fetch_offset, length, should_cancel,
+            should_cancel_arg, err)) {
+        _vmnetfs_ll_pristine_unlock_fetch(img, start_chunk, count);
+        g_free(buf);
+        return promoted;
+    }
+
+    for (chunk = start_chunk; chunk < start_chunk + count; chunk++) {
+        g_mutex_lock(cs->lock);
+        locked = _chunk_trylock_nowait(cs, chunk);
+        g_mutex_unlock(cs->lock);
+        if (!locked) {
+            _vmnetfs_ll_pristine_unlock_fetch(img, chunk, 1);
+            continue;
+        }
+        if (chunk_is_missing_shared(img, chunk)) {
+            _vmnetfs_bit_set(img->fetched_map, chunk);
+            add_chunk(img, buf + (chunk - start_chunk) * img->chunk_size,
+                    chunk, MIN(img->initial_size - chunk * img->chunk_size,
+                    img->chunk_size), true);
+            fetched++;
+        } else {
+            _vmnetfs_ll_pristine_unlock_fetch(img, chunk, 1);
+        }
+        chunk_unlock(img, chunk);
+    }
+    g_free(buf);
+    _vmnetfs_u64_stat_increment(img->chunk_prefetches, fetched);
+    return fetched + promoted;
+}
+
 /* chunk lock must be held. */
 static bool copy_to_modified(struct vmnetfs_image *img, uint64_t image_size,
         uint64_t chunk, GError **err)
@@ -597,16 +1498,52 @@ static bool lock_and_copy_to_modified(struct vmnetfs_image *img,
     if (!chunk_trylock(img, chunk, &image_size, err)) {
         return false;
     }
-    /* If the chunk is still unmodified, and has not been truncated away
-       while we had the lock released, copy it to the modified cache. */
-    if (chunk * img->chunk_size < image_size &&
-            !_vmnetfs_bit_test(img->modified_map, chunk)) {
-        ret = copy_to_modified(img, image_size, chunk, err);
+    /* If the chunk is still unmodified or incomplete, and has not been
+       truncated away while we had the lock released, copy it to the
+       modified cache. */
+    if (chunk * img->chunk_size < image_size) {
+        if (!_vmnetfs_bit_test(img->modified_map, chunk)) {
+            ret = copy_to_modified(img, image_size, chunk, err);
+        } else if (_vmnetfs_ll_modified_is_incomplete(img, chunk)) {
+            ret = merge_incomplete(img, chunk, err);
+        }
     }
     chunk_unlock(img, chunk);
     return ret;
 }
 
+/* Chunk lock must be held.  Make the chunk ready for the range to be
+   overwritten: fetch and copy it to the modified cache, or merge an
+   incomplete chunk, unless the range can be written without doing so. */
+static bool prepare_write(struct vmnetfs_image *img, uint64_t image_size,
+        uint64_t chunk, uint32_t offset, uint32_t length, GError **err)
+{
+    if (!_vmnetfs_bit_test(img->modified_map, chunk)) {
+        if ((offset == 0 && length == MIN(img->chunk_size,
+                image_size - chunk * img->chunk_size)) ||
+                _vmnetfs_ll_modified_write_is_aligned(img, chunk, offset,
+                length)) {
+            /* Writing the whole chunk, or whole sectors whose neighbors
+               can be merged in later; skip fetch. */
+            _vmnetfs_u64_stat_increment(img->chunk_dirties, 1);
+            _vmnetfs_u64_stat_increment(img->chunk_fetch_skips, 1);
+        } else {
+            if (!copy_to_modified(img, image_size, chunk, err)) {
+                return false;
+            }
+        }
+    } else if (!_vmnetfs_ll_modified_range_is_dirty(img, chunk, offset,
+            length) && !_vmnetfs_ll_modified_write_is_aligned(img, chunk,
+            offset, length)) {
+        /* Dirty sectors of an incomplete chunk are tracked whole, so merge
+           before writing part of a clean one */
+        if (!merge_incomplete(img, chunk, err)) {
+            return false;
+        }
+    }
+    return true;
+}
+
 uint64_t _vmnetfs_io_write_chunk(struct vmnetfs_image *img, const void *data,
         uint64_t chunk, uint32_t offset, uint32_t length, GError **err)
 {
@@ -620,23 +1557,44 @@ uint64_t _vmnetfs_io_write_chunk(struct vmnetfs_image *img, const void *data,
             chunk * img->chunk_size + offset + length, &image_size, err)) {
         return 0;
     }
-    _vmnetfs_bit_set(img->accessed_map, chunk);
-    if (!_vmnetfs_bit_test(img->modified_map, chunk)) {
-        if (offset == 0 && length == MIN(img->chunk_size,
-                image_size - chunk * img->chunk_size)) {
-            /* Writing the whole chunk; skip fetch. */
-            _vmnetfs_u64_stat_increment(img->chunk_dirties, 1);
-            _vmnetfs_u64_stat_increment(img->chunk_fetch_skips, 1);
-        } else {
-            if (!copy_to_modified(img, image_size, chunk, err)) {
-                goto out;
-            }
-        }
-    }
-    if (_vmnetfs_ll_modified_write_chunk(img, image_size, data, chunk,
+    mark_accessed(img, chunk);
+    if (prepare_write(img, image_size, chunk, offset, length, err) &&
+            _vmnetfs_ll_modified_write_chunk(img, image_size, data, chunk,
             offset, length, err)) {
         ret = length;
     }
+    chunk_unlock(img, chunk);
+    return ret;
+}
+
+/* Zero part of a chunk, as for a discard.  Unlike a write, this never
+   extends the image; any part of the range past the end of the image is
+   ignored. */
+uint64_t _vmnetfs_io_zero_chunk(struct vmnetfs_image *img, uint64_t chunk,
+        uint32_t offset, uint32_t length, GError **err)
+{
+    uint64_t image_size;
+    uint64_t ret = 0;
+    uint32_t zero_length;
+
+    g_assert(offset < img->chunk_size);
+    g_assert(offset + length <= img->chunk_size);
+
+    if (!chunk_trylock(img, chunk, &image_size, err)) {
+        return 0;
+    }
+    if (chunk * img->chunk_size + offset >= image_size) {
+        ret = length;
+        goto out;
+    }
+    zero_length = MIN(length, image_size - chunk * img->chunk_size -
+            offset);
+    mark_accessed(img, chunk);
+    if (prepare_write(img, image_size, chunk, offset, zero_length, err) &&
+            _vmnetfs_ll_modified_zero_chunk(img, image_size, chunk, offset,
+            zero_length, err)) {
+        ret = length;
+    }
 out:
     chunk_unlock(img, chunk);
     return ret;
@@ -675,10 +1633,10 @@ bool _vmnetfs_io_set_image_size(struct vmnetfs_image *img, uint64_t size,
         /* Reduce image. */
 
         if (size % img->chunk_size > 0 && size < img->initial_size &&
-                !_vmnetfs_bit_test(img->modified_map,
+                !chunk_is_wholly_modified(img,
                 (size - 1) / img->chunk_size)) {
             /* The new last chunk will be a partial chunk within the
-               boundaries of the pristine cache, and it is not in the
+               boundaries of the pristine cache, and it is not wholly in the
                modified cache.  Copy it there so that subsequent expansions
                don't reveal the truncated part of the chunk. */
             g_mutex_unlock(cs->lock);
@@ -16,17 +16,318 @@
  */
 
 #include <sys/types.h>
+#include <sys/stat.h>
+#include <sys/file.h>
 #include <stdlib.h>
 #include <string.h>
 #include <unistd.h>
+#include <fcntl.h>
 #include <errno.h>
 #include "vmnetfs-private.h"
 
-bool _vmnetfs_ll_modified_init(struct vmnetfs_image *img, GError **err)
+/* A chunk in the modified cache may be incomplete: the guest has written
+   some of its sectors without the rest of the chunk having been copied
+   from the pristine cache, so that the write didn't have to wait for a
+   fetch.  For each incomplete chunk we keep a bitmap of dirty sectors.
+   Reads of dirty sectors are served directly; before clean sectors can be
+   read, the caller must merge in the pristine chunk, which makes the chunk
+   an ordinary modified chunk.  Only whole sectors can be written to an
+   incomplete chunk, unless the sectors are already dirty.  The bitmap of
+   a chunk is protected by the chunk lock; the table of bitmaps by its own
+   lock. */
+
+/* Modified chunks can also be kept in a bounded amount of memory, so
+   that guest writes don't have to wait for the host filesystem.  A chunk
+   in memory holds its entire contents, and the copy in the backing file
+   is stale.  When the budget is exceeded, the least recently written
+   chunks are spilled to the backing file.  Chunk contents are protected
+   by the chunk lock; the table and LRU list by the memory lock, which is
+   also held while spilling. */
+
+/* Optionally, the modified cache is kept in the pristine cache directory
+   so that a later session can resume from it.  The modified map, the
+   image size, and the dirty maps of incomplete chunks are then saved in
+   a state file at clean shutdown.  As with the present map, the state is
+   consumed when it is loaded, so after a crash the backing file is
+   discarded rather than trusted. */
+
+#define SECTOR_SIZE 512
+#define MODIFIED_FILENAME "modified"
+#define STATE_FILENAME "modified-state"
+#define STATE_MAGIC "VMNFSMS1"
+#define HASH_LEN 32
+
+/* All fields little-endian.  Followed by the modified map, then for each
+   incomplete chunk its number (uint64_t) and dirty map, then a SHA-256 of
+   everything before it. */
+struct state_header {
+    char magic[8];
+    uint64_t initial_size;
+    uint64_t image_size;
+    uint32_t chunk_size;
+    uint32_t incomplete;
+};
+
+struct modified_chunk {
+    uint64_t chunk;
+    char *data;
+    GList *link;            /* in LRU list, most recently written first */
+};
+
+struct modified_mem {
+    GMutex *lock;
+    GHashTable *chunks;     /* uint64_t -> struct modified_chunk */
+    GQueue lru;
+    uint64_t size;
+    uint64_t image_size;
+};
+
+static uint32_t get_pristine_length(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    return MIN(img->chunk_size, img->initial_size - chunk * img->chunk_size);
+}
+
+static uint32_t get_dirty_map_length(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    return ((get_pristine_length(img, chunk) + SECTOR_SIZE - 1) /
+            SECTOR_SIZE + 7) / 8;
+}
+
+static uint8_t *get_dirty_map(struct vmnetfs_image *img, uint64_t chunk)
+{
+    uint8_t *map;
+
+    g_mutex_lock(img->incomplete_lock);
+    map = g_hash_table_lookup(img->incomplete_chunks, &chunk);
+    g_mutex_unlock(img->incomplete_lock);
+    return map;
+}
+
+static void remove_dirty_map(struct vmnetfs_image *img, uint64_t chunk)
+{
+    g_mutex_lock(img->incomplete_lock);
+    g_hash_table_remove(img->incomplete_chunks, &chunk);
+    g_mutex_unlock(img->incomplete_lock);
+}
+
+static bool sector_is_dirty(const uint8_t *map, uint32_t sector)
+{
+    return map[sector / 8] & (1 << (sector % 8));
+}
+
+static void incomplete_chunk_free(void *data)
+{
+    g_slice_free(uint64_t, data);
+}
+
+static void modified_chunk_free(void *data)
+{
+    struct modified_chunk *mc = data;
+
+    g_free(mc->data);
+    g_slice_free(struct modified_chunk, mc);
+}
+
+/* Memory lock must be held. */
+static bool spill_chunk(struct vmnetfs_image *img, struct modified_chunk *mc,
+        GError **err)
+{
+    struct modified_mem *mem = img->modified_mem;
+
+    if (!_vmnetfs_safe_pwrite("image", img->write_fd, mc->data,
+            MIN(img->chunk_size, mem->image_size -
+            mc->chunk * img->chunk_size), mc->chunk * img->chunk_size,
+            err)) {
+        return false;
+    }
+    g_queue_unlink(&mem->lru, mc->link);
+    g_list_free_1(mc->link);
+    mem->size -= img->chunk_size;
+    g_hash_table_remove(mem->chunks, &mc->chunk);
+    return true;
+}
+
+/* Memory lock must be held.  The backing file may not extend to the end
+   of the chunk; the rest reads as zeroes. */
+static bool load_chunk(struct vmnetfs_image *img, char *data, uint64_t chunk,
+        GError **err)
+{
+    uint64_t start = chunk * img->chunk_size;
+    struct stat st;
+
+    if (fstat(img->write_fd, &st)) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Couldn't stat image: %s", strerror(errno));
+        return false;
+    }
+    if ((uint64_t) st.st_size <= start) {
+        return true;
+    }
+    return _vmnetfs_safe_pread("image", img->write_fd, data,
+            MIN(img->chunk_size, st.st_size - start), start, err);
+}
+
+/* Returns false if the chunk is not in memory. */
+static bool memory_read(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length)
+{
+    struct modified_mem *mem = img->modified_mem;
+    struct modified_chunk *mc;
+
+    if (mem == NULL) {
+        return false;
+    }
+    g_mutex_lock(mem->lock);
+    mc = g_hash_table_lookup(mem->chunks, &chunk);
+    if (mc != NULL) {
+        memcpy(data, mc->data + offset, length);
+    }
+    g_mutex_unlock(mem->lock);
+    return mc != NULL;
+}
+
+/* Returns false if the chunk is not in memory. */
+static bool memory_zero(struct vmnetfs_image *img, uint64_t chunk,
+        uint32_t offset, uint32_t length)
+{
+    struct modified_mem *mem = img->modified_mem;
+    struct modified_chunk *mc;
+
+    if (mem == NULL) {
+        return false;
+    }
+    g_mutex_lock(mem->lock);
+    mc = g_hash_table_lookup(mem->chunks, &chunk);
+    if (mc != NULL) {
+        memset(mc->data + offset, 0, length);
+        g_queue_unlink(&mem->lru, mc->link);
+        g_queue_push_head_link(&mem->lru, mc->link);
+    }
+    g_mutex_unlock(mem->lock);
+    return mc != NULL;
+}
+
+static bool store_read(struct vmnetfs_image *img, void *data, uint64_t chunk,
+        uint32_t offset, uint32_t length, GError **err)
+{
+    if (memory_read(img, data, chunk, offset, length)) {
+        return true;
+    }
+    return _vmnetfs_safe_pread("image", img->write_fd, data, length,
+            chunk * img->chunk_size + offset, err);
+}
+
+/* Write to the chunk in memory, bringing it into memory and spilling
+   other chunks to make room if necessary. */
+static bool store_write(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length, GError **err)
+{
+    struct modified_mem *mem = img->modified_mem;
+    struct modified_chunk *mc;
+
+    if (mem == NULL || img->chunk_size > img->modified_mem_size) {
+        return _vmnetfs_safe_pwrite("image", img->write_fd, data, length,
+                chunk * img->chunk_size + offset, err);
+    }
+    g_mutex_lock(mem->lock);
+    mc = g_hash_table_lookup(mem->chunks, &chunk);
+    if (mc == NULL) {
+        while (mem->size + img->chunk_size > img->modified_mem_size) {
+            if (!spill_chunk(img, g_queue_peek_tail(&mem->lru), err)) {
+                g_mutex_unlock(mem->lock);
+                return false;
+            }
+        }
+        mc = g_slice_new0(struct modified_chunk);
+        mc->chunk = chunk;
+        mc->data = g_malloc0(img->chunk_size);
+        /* A newly modified chunk has no data in the backing file */
+        if (_vmnetfs_bit_test(img->modified_map, chunk) &&
+                !load_chunk(img, mc->data, chunk, err)) {
+            modified_chunk_free(mc);
+            g_mutex_unlock(mem->lock);
+            return false;
+        }
+        g_queue_push_head(&mem->lru, mc);
+        mc->link = mem->lru.head;
+        g_hash_table_replace(mem->chunks, &mc->chunk, mc);
+        mem->size += img->chunk_size;
+    } else {
+        g_queue_unlink(&mem->lru, mc->link);
+        g_queue_push_head_link(&mem->lru, mc->link);
+    }
+    memcpy(mc->data + offset, data, length);
+    g_mutex_unlock(mem->lock);
+    return true;
+}
+
+/* Memory lock must be held. */
+static gboolean memory_truncated(void *key G_GNUC_UNUSED, void *value,
+        void *data)
+{
+    struct vmnetfs_image *img = data;
+    struct modified_mem *mem = img->modified_mem;
+    struct modified_chunk *mc = value;
+
+    if (mc->chunk * img->chunk_size < mem->image_size) {
+        return false;
+    }
+    g_queue_unlink(&mem->lru, mc->link);
+    g_list_free_1(mc->link);
+    mem->size -= img->chunk_size;
+    return true;
+}
+
+static void memory_set_size(struct vmnetfs_image *img, uint64_t new_size)
+{
+    struct modified_mem *mem = img->modified_mem;
+    struct modified_chunk *mc;
+    uint64_t chunk = new_size / img->chunk_size;
+    uint32_t offset = new_size % img->chunk_size;
+
+    if (mem == NULL) {
+        return;
+    }
+    g_mutex_lock(mem->lock);
+    if (new_size < mem->image_size) {
+        mem->image_size = new_size;
+        g_hash_table_foreach_remove(mem->chunks, memory_truncated, img);
+        /* The truncated part of the last chunk must read as zeroes if the
+           image is extended again */
+        mc = g_hash_table_lookup(mem->chunks, &chunk);
+        if (mc != NULL) {
+            memset(mc->data + offset, 0, img->chunk_size - offset);
+        }
+    }
+    mem->image_size = new_size;
+    g_mutex_unlock(mem->lock);
+}
+
+static char *get_state_file(struct vmnetfs_image *img)
+{
+    return g_strdup_printf("%s/%s", img->read_base, STATE_FILENAME);
+}
+
+static bool get_digest(const void *data, gsize len, uint8_t *digest)
+{
+    GChecksum *sum;
+    gsize digest_len = HASH_LEN;
+
+    sum = g_checksum_new(G_CHECKSUM_SHA256);
+    g_checksum_update(sum, data, len);
+    g_checksum_get_digest(sum, digest, &digest_len);
+    g_checksum_free(sum);
+    return digest_len == HASH_LEN;
+}
+
+static bool open_temporary(struct vmnetfs_image *img, GError **err)
 {
     char *file;
 
-    file = g_strdup_printf("%s/vmnetfs-XXXXXX", g_get_tmp_dir());
+    file = g_strdup_printf("%s/vmnetfs-XXXXXX", img->modified_path ?:
+            g_get_tmp_dir());
     img->write_fd = mkstemp(file);
     if (img->write_fd == -1) {
         g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
@@ -36,66 +337,491 @@ bool _vmnetfs_ll_modified_init(struct vmnetfs_image *img, GError **err)
     }
     unlink(file);
     g_free(file);
+    return true;
+}
+
+/* Sets write_fd to -1 if another process is using the file. */
+static bool open_persistent(struct vmnetfs_image *img, GError **err)
+{
+    char *file;
+
+    file = g_strdup_printf("%s/%s", img->read_base, MODIFIED_FILENAME);
+    img->write_fd = open(file, O_RDWR | O_CREAT, 0600);
+    if (img->write_fd == -1) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Couldn't open %s: %s", file, strerror(errno));
+        g_free(file);
+        return false;
+    }
+    g_free(file);
+    if (flock(img->write_fd, LOCK_EX | LOCK_NB)) {
+        close(img->write_fd);
+        img->write_fd = -1;
+    }
+    return true;
+}
+
+/* Returns false if there is no usable state. */
+static bool load_state(struct vmnetfs_image *img, uint64_t *image_size)
+{
+    struct state_header *hdr;
+    uint64_t pristine_chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t chunks;
+    uint64_t map_len;
+    uint64_t size;
+    uint64_t entries_len;
+    uint64_t chunk;
+    uint64_t *key;
+    uint32_t incomplete;
+    uint32_t i;
+    uint8_t digest[HASH_LEN];
+    const char *entry;
+    char *file;
+    char *data;
+    gsize len;
+    bool ret = false;
+
+    file = get_state_file(img);
+    if (!g_file_get_contents(file, &data, &len, NULL)) {
+        g_free(file);
+        return false;
+    }
+    /* Consume the state, so that it can't become stale */
+    if (unlink(file) && errno != ENOENT) {
+        g_warning("Couldn't remove %s: %s", file, strerror(errno));
+        goto out;
+    }
+    hdr = (struct state_header *) data;
+    if (len < sizeof(*hdr) + HASH_LEN ||
+            memcmp(hdr->magic, STATE_MAGIC, sizeof(hdr->magic)) ||
+            GUINT64_FROM_LE(hdr->initial_size) != img->initial_size ||
+            GUINT32_FROM_LE(hdr->chunk_size) != img->chunk_size) {
+        goto out;
+    }
+    size = GUINT64_FROM_LE(hdr->image_size);
+    chunks = (size + img->chunk_size - 1) / img->chunk_size;
+    map_len = (chunks + 7) / 8;
+    incomplete = GUINT32_FROM_LE(hdr->incomplete);
+    if (len < sizeof(*hdr) + map_len + HASH_LEN) {
+        goto out;
+    }
+    entries_len = len - sizeof(*hdr) - map_len - HASH_LEN;
+    if (!get_digest(data, len - HASH_LEN, digest) ||
+            memcmp(digest, data + len - HASH_LEN, sizeof(digest))) {
+        goto out;
+    }
+
+    /* Validate incomplete chunks before committing to anything */
+    entry = data + sizeof(*hdr) + map_len;
+    for (i = 0; i < incomplete; i++) {
+        if (entries_len < sizeof(chunk)) {
+            goto out;
+        }
+        memcpy(&chunk, entry, sizeof(chunk));
+        chunk = GUINT64_FROM_LE(chunk);
+        if (chunk >= pristine_chunks || chunk >= chunks ||
+                entries_len < sizeof(chunk) +
+                get_dirty_map_length(img, chunk)) {
+            goto out;
+        }
+        entry += sizeof(chunk) + get_dirty_map_length(img, chunk);
+        entries_len -= sizeof(chunk) + get_dirty_map_length(img, chunk);
+    }
+    if (entries_len != 0) {
+        goto out;
+    }
+
+    _vmnetfs_bit_group_resize(img->bitmaps, chunks);
+    _vmnetfs_bit_import(img->modified_map, data + sizeof(*hdr), chunks);
+    entry = data + sizeof(*hdr) + map_len;
+    for (i = 0; i < incomplete; i++) {
+        key = g_slice_new(uint64_t);
+        memcpy(key, entry, sizeof(*key));
+        *key = GUINT64_FROM_LE(*key);
+        entry += sizeof(*key);
+        g_hash_table_replace(img->incomplete_chunks, key,
+                g_memdup(entry, get_dirty_map_length(img, *key)));
+        entry += get_dirty_map_length(img, *key);
+    }
+    *image_size = size;
+    ret = true;
+
+out:
+    g_free(data);
+    g_free(file);
+    return ret;
+}
+
+static void save_state(struct vmnetfs_image *img, uint64_t image_size)
+{
+    struct state_header hdr;
+    uint64_t chunks = (image_size + img->chunk_size - 1) / img->chunk_size;
+    uint64_t map_len = (chunks + 7) / 8;
+    uint8_t digest[HASH_LEN];
+    GHashTableIter iter;
+    GString *data;
+    uint64_t *key;
+    uint64_t chunk;
+    uint8_t *map;
+    char *file;
+    GError *err = NULL;
+
+    memset(&hdr, 0, sizeof(hdr));
+    memcpy(hdr.magic, STATE_MAGIC, sizeof(hdr.magic));
+    hdr.initial_size = GUINT64_TO_LE(img->initial_size);
+    hdr.image_size = GUINT64_TO_LE(image_size);
+    hdr.chunk_size = GUINT32_TO_LE(img->chunk_size);
+    hdr.incomplete = GUINT32_TO_LE(g_hash_table_size(img->incomplete_chunks));
+    data = g_string_new_len((const char *) &hdr, sizeof(hdr));
+    g_string_set_size(data, sizeof(hdr) + map_len);
+    _vmnetfs_bit_export(img->modified_map, data->str + sizeof(hdr), chunks);
+    g_hash_table_iter_init(&iter, img->incomplete_chunks);
+    while (g_hash_table_iter_next(&iter, (void **) &key, (void **) &map)) {
+        chunk = GUINT64_TO_LE(*key);
+        g_string_append_len(data, (const char *) &chunk, sizeof(chunk));
+        g_string_append_len(data, (const char *) map,
+                get_dirty_map_length(img, *key));
+    }
+    if (!get_digest(data->str, data->len, digest)) {
+        g_string_free(data, TRUE);
+        return;
+    }
+    g_string_append_len(data, (const char *) digest, sizeof(digest));
+
+    file = get_state_file(img);
+    if (!g_file_set_contents(file, data->str, data->len, &err)) {
+        g_warning("Couldn't save modified state: %s", err->message);
+        g_clear_error(&err);
+    }
+    g_free(file);
+    g_string_free(data, TRUE);
+}
+
+/* Stores the size of the image in @image_size, which differs from the
+   initial size if a saved session was resumed. */
+bool _vmnetfs_ll_modified_init(struct vmnetfs_image *img,
+        uint64_t *image_size, GError **err)
+{
+    *image_size = img->initial_size;
+    if (img->persist_modified) {
+        if (!open_persistent(img, err)) {
+            return false;
+        }
+        if (img->write_fd == -1) {
+            g_warning("Modified cache in %s is in use; changes won't be "
+                    "saved", img->read_base);
+            img->persist_modified = false;
+        } else {
+            img->modified_persisted = 1;
+        }
+    }
+    if (!img->persist_modified && !open_temporary(img, err)) {
+        return false;
+    }
     /* set_on_extend ensures that chunks that are truncated away are not
        retrieved from the pristine cache if the image is extended again. */
     img->modified_map = _vmnetfs_bit_new(img->bitmaps, true);
+    img->incomplete_lock = g_mutex_new();
+    img->incomplete_chunks = g_hash_table_new_full(g_int64_hash, g_int64_equal,
+            incomplete_chunk_free, g_free);
+    if (img->persist_modified) {
+        if (load_state(img, image_size)) {
+            img->modified_resumed = 1;
+        } else if (ftruncate(img->write_fd, 0)) {
+            /* Stale data would only be read from chunks marked modified,
+               so this is not fatal */
+            g_warning("Couldn't discard stale modified cache: %s",
+                    strerror(errno));
+        }
+    }
+    if (img->modified_mem_size > 0) {
+        img->modified_mem = g_slice_new0(struct modified_mem);
+        img->modified_mem->lock = g_mutex_new();
+        img->modified_mem->chunks = g_hash_table_new_full(g_int64_hash,
+                g_int64_equal, NULL, modified_chunk_free);
+        g_queue_init(&img->modified_mem->lru);
+        img->modified_mem->image_size = *image_size;
+    }
     return true;
 }
 
+/* Called at clean shutdown, once nothing else can write to the modified
+   cache.  Saves the state for the next session, if requested. */
+void _vmnetfs_ll_modified_close(struct vmnetfs_image *img,
+        uint64_t image_size)
+{
+    struct modified_mem *mem = img->modified_mem;
+    GError *err = NULL;
+
+    if (!img->persist_modified) {
+        return;
+    }
+    if (mem != NULL) {
+        g_mutex_lock(mem->lock);
+        while (!g_queue_is_empty(&mem->lru)) {
+            if (!spill_chunk(img, g_queue_peek_tail(&mem->lru), &err)) {
+                g_mutex_unlock(mem->lock);
+                g_warning("Couldn't save modified cache: %s", err->message);
+                g_clear_error(&err);
+                return;
+            }
+        }
+        g_mutex_unlock(mem->lock);
+    }
+    if (fdatasync(img->write_fd)) {
+        g_warning("Couldn't save modified cache: %s", strerror(errno));
+        return;
+    }
+    save_state(img, image_size);
+}
+
 void _vmnetfs_ll_modified_destroy(struct vmnetfs_image *img)
 {
+    struct modified_mem *mem = img->modified_mem;
+
+    if (mem != NULL) {
+        g_queue_clear(&mem->lru);
+        g_hash_table_destroy(mem->chunks);
+        g_mutex_free(mem->lock);
+        g_slice_free(struct modified_mem, mem);
+        img->modified_mem = NULL;
+    }
+    g_hash_table_destroy(img->incomplete_chunks);
+    g_mutex_free(img->incomplete_lock);
     _vmnetfs_bit_free(img->modified_map);
     close(img->write_fd);
 }
 
+/* Returns true if the write can be applied to an unmodified or incomplete
+   chunk without merging: it covers whole sectors, the last of which may
+   be cut short by the end of the pristine image. */
+bool _vmnetfs_ll_modified_write_is_aligned(struct vmnetfs_image *img,
+        uint64_t chunk, uint32_t offset, uint32_t length)
+{
+    uint32_t end = offset + length;
+
+    return offset % SECTOR_SIZE == 0 && (end % SECTOR_SIZE == 0 ||
+            chunk * img->chunk_size + end == img->initial_size);
+}
+
+/* The result can only be relied on while the chunk lock is held. */
+bool _vmnetfs_ll_modified_is_incomplete(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    return get_dirty_map(img, chunk) != NULL;
+}
+
+/* Returns true unless the chunk is incomplete and the range includes clean
+   sectors.  Chunk lock must be held. */
+bool _vmnetfs_ll_modified_range_is_dirty(struct vmnetfs_image *img,
+        uint64_t chunk, uint32_t offset, uint32_t length)
+{
+    uint8_t *map;
+    uint32_t sector;
+
+    map = get_dirty_map(img, chunk);
+    if (map == NULL) {
+        return true;
+    }
+    for (sector = offset / SECTOR_SIZE;
+            sector * SECTOR_SIZE < offset + length; sector++) {
+        if (!sector_is_dirty(map, sector)) {
+            return false;
+        }
+    }
+    return true;
+}
+
+/* Copy the clean sectors of an incomplete chunk from @pristine, the complete
+   pristine chunk, making the chunk an ordinary modified chunk.  Chunk lock
+   must be held. */
+bool _vmnetfs_ll_modified_merge(struct vmnetfs_image *img,
+        const void *pristine, uint64_t chunk, GError **err)
+{
+    uint32_t length = get_pristine_length(img, chunk);
+    uint32_t sectors = (length + SECTOR_SIZE - 1) / SECTOR_SIZE;
+    uint32_t start;
+    uint32_t end;
+    uint8_t *map;
+
+    map = get_dirty_map(img, chunk);
+    g_assert(map != NULL);
+    for (start = 0; start < sectors; start = end) {
+        if (sector_is_dirty(map, start)) {
+            end = start + 1;
+            continue;
+        }
+        for (end = start + 1; end < sectors && !sector_is_dirty(map, end);
+                end++) {}
+        if (!store_write(img, (const char *) pristine + start * SECTOR_SIZE,
+                chunk, start * SECTOR_SIZE,
+                MIN(end * SECTOR_SIZE, length) - start * SECTOR_SIZE,
+                err)) {
+            return false;
+        }
+    }
+    remove_dirty_map(img, chunk);
+    return true;
+}
+
 bool _vmnetfs_ll_modified_read_chunk(struct vmnetfs_image *img,
         uint64_t image_size, void *data, uint64_t chunk, uint32_t offset,
         uint32_t length, GError **err)
 {
     g_assert(_vmnetfs_bit_test(img->modified_map, chunk));
+    g_assert(_vmnetfs_ll_modified_range_is_dirty(img, chunk, offset,
+            length));
     g_assert(offset < img->chunk_size);
     g_assert(offset + length <= img->chunk_size);
     g_assert(chunk * img->chunk_size + offset + length <= image_size);
 
-    return _vmnetfs_safe_pread("image", img->write_fd, data, length,
-            chunk * img->chunk_size + offset, err);
+    return store_read(img, data, chunk, offset, length, err);
 }
 
-bool _vmnetfs_ll_modified_write_chunk(struct vmnetfs_image *img,
-        uint64_t image_size, const void *data, uint64_t chunk,
-        uint32_t offset, uint32_t length, GError **err)
+/* Record that the range has been written.  Writing part of an unmodified
+   chunk makes it incomplete. */
+static void mark_written(struct vmnetfs_image *img, uint64_t chunk,
+        uint32_t offset, uint32_t length)
 {
-    g_assert(_vmnetfs_bit_test(img->modified_map, chunk) ||
-            (offset == 0 && length == MIN(img->chunk_size,
-            img->initial_size - chunk * img->chunk_size)));
+    bool whole = offset == 0 && length == get_pristine_length(img, chunk);
+    uint32_t sector;
+    uint8_t *map;
+    uint64_t *key;
+
+    map = get_dirty_map(img, chunk);
+    if (map == NULL && !whole &&
+            !_vmnetfs_bit_test(img->modified_map, chunk)) {
+        map = g_malloc0(get_dirty_map_length(img, chunk));
+        key = g_slice_new(uint64_t);
+        *key = chunk;
+        g_mutex_lock(img->incomplete_lock);
+        g_hash_table_replace(img->incomplete_chunks, key, map);
+        g_mutex_unlock(img->incomplete_lock);
+    }
+    if (map != NULL) {
+        for (sector = offset / SECTOR_SIZE;
+                sector * SECTOR_SIZE < offset + length; sector++) {
+            map[sector / 8] |= 1 << (sector % 8);
+        }
+        if (_vmnetfs_ll_modified_range_is_dirty(img, chunk, 0,
+                get_pristine_length(img, chunk))) {
+            remove_dirty_map(img, chunk);
+        }
+    }
+    _vmnetfs_bit_set(img->modified_map, chunk);
+}
+
+static void assert_writable(struct vmnetfs_image *img, uint64_t image_size,
+        uint64_t chunk, uint32_t offset, uint32_t length)
+{
+    bool whole = offset == 0 && length == get_pristine_length(img, chunk);
+
+    g_assert(_vmnetfs_bit_test(img->modified_map, chunk) || whole ||
+            _vmnetfs_ll_modified_write_is_aligned(img, chunk, offset,
+            length));
+    g_assert(_vmnetfs_ll_modified_range_is_dirty(img, chunk, offset,
+            length) || _vmnetfs_ll_modified_write_is_aligned(img, chunk,
+            offset, length));
     g_assert(offset < img->chunk_size);
     g_assert(offset + length <= img->chunk_size);
     g_assert(chunk * img->chunk_size + offset + length <= image_size);
+}
+
+/* The write must cover whole sectors unless the chunk is modified and
+   the affected sectors are dirty. */
+bool _vmnetfs_ll_modified_write_chunk(struct vmnetfs_image *img,
+        uint64_t image_size, const void *data, uint64_t chunk,
+        uint32_t offset, uint32_t length, GError **err)
+{
+    assert_writable(img, image_size, chunk, offset, length);
+    if (!store_write(img, data, chunk, offset, length, err)) {
+        return false;
+    }
+    mark_written(img, chunk, offset, length);
+    return true;
+}
+
+/* Like _vmnetfs_ll_modified_write_chunk(), but writes zeroes.  Where the
+   host filesystem allows, the range is deallocated rather than written,
+   so discarded parts of the image don't take up space. */
+bool _vmnetfs_ll_modified_zero_chunk(struct vmnetfs_image *img,
+        uint64_t image_size, uint64_t chunk, uint32_t offset,
+        uint32_t length, GError **err)
+{
+    uint64_t start = chunk * img->chunk_size + offset;
+    void *buf;
+    bool ret;
 
-    if (_vmnetfs_safe_pwrite("image", img->write_fd, data, length,
-            chunk * img->chunk_size + offset, err)) {
-        _vmnetfs_bit_set(img->modified_map, chunk);
+    assert_writable(img, image_size, chunk, offset, length);
+    if (length == 0) {
         return true;
-    } else {
+    }
+    if (memory_zero(img, chunk, offset, length)) {
+        mark_written(img, chunk, offset, length);
+        return true;
+    }
+    /* The file may not extend this far yet, and punching a hole past
+       EOF doesn't extend it */
+    if (!_vmnetfs_safe_pwrite("image", img->write_fd, "", 1,
+            start + length - 1, err)) {
         return false;
     }
+    if (fallocate(img->write_fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+            start, length)) {
+        if (errno != EOPNOTSUPP && errno != ENOSYS) {
+            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                    "Couldn't deallocate image range: %s",
+                    strerror(errno));
+            return false;
+        }
+        buf = g_malloc0(length);
+        ret = _vmnetfs_safe_pwrite("image", img->write_fd, buf, length,
+                start, err);
+        g_free(buf);
+        if (!ret) {
+            return false;
+        }
+    }
+    mark_written(img, chunk, offset, length);
+    return true;
+}
+
+static gboolean incomplete_truncated(void *key, void *value G_GNUC_UNUSED,
+        void *data)
+{
+    return *(uint64_t *) key >= *(uint64_t *) data;
 }
 
 bool _vmnetfs_ll_modified_set_size(struct vmnetfs_image *img,
         uint64_t current_size, uint64_t new_size, GError **err)
 {
-    /* If we're truncating the new last chunk, it must be in the modified
-       cache to ensure that subsequent expansions don't reveal the truncated
-       part. */
+    uint64_t last_chunk = new_size / img->chunk_size;
+    uint64_t first_truncated;
+
+    /* If we're truncating the new last chunk, it must be wholly in the
+       modified cache to ensure that subsequent expansions don't reveal the
+       truncated part. */
     g_assert(new_size > current_size ||
             new_size % img->chunk_size == 0 ||
-            _vmnetfs_bit_test(img->modified_map, new_size / img->chunk_size));
+            (_vmnetfs_bit_test(img->modified_map, last_chunk) &&
+            !_vmnetfs_ll_modified_is_incomplete(img, last_chunk)));
 
     if (ftruncate(img->write_fd, new_size)) {
         g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
                 "Couldn't truncate image: %s", strerror(errno));
         return false;
     }
+    memory_set_size(img, new_size);
 
+    /* Chunks truncated away must read as zeroes if the image is extended
+       again, so forget that they have pristine data */
+    if (new_size < current_size) {
+        first_truncated = (new_size + img->chunk_size - 1) / img->chunk_size;
+        g_mutex_lock(img->incomplete_lock);
+        g_hash_table_foreach_remove(img->incomplete_chunks, incomplete_truncated,
+                &first_truncated);
+        g_mutex_unlock(img->incomplete_lock);
+    }
     return true;
 }
@@ -17,6 +17,7 @@
 
 #include <sys/types.h>
 #include <sys/stat.h>
+#include <sys/file.h>
 #include <fcntl.h>
 #include <string.h>
 #include <unistd.h>
@@ -24,11 +25,126 @@
 #include <errno.h>
 #include "vmnetfs-private.h"
 
+/* The pristine cache has two layouts.  In the chunks layout, each chunk
+   is stored in its own file, grouped into numbered directories.  In the
+   pack layout, chunks are stored at their natural offsets in a single
+   sparse file the size of the image, and the pack index contains one
+   byte per chunk giving the chunk's encoding, or 0 if it is absent.  Both
+   files stay open for the life of the image.
+
+   If compression is enabled, all-zero chunks are stored without data and
+   other chunks are compressed if that makes them smaller.  In the chunks
+   layout, the encoding follows from the file size: a full-size file is
+   uncompressed, an empty file is a zero chunk, and anything in between
+   is compressed.  In the pack layout, a compressed chunk is stored at the
+   start of its slot, preceded by its compressed length, and the rest of
+   the slot is left sparse.  Chunks are decoded on read whether or not
+   compression is enabled, so the setting can change between sessions.
+
+   In the pack layout, the index byte is written after the chunk data, so
+   a crashed vmnetfs process never leaves a chunk marked present without
+   its data.  Multiple vmnetfs processes may share the pack: they write
+   identical data, and the index is updated a byte at a time, so they
+   never undo each other's updates.  This requires them to use the same
+   compression setting.
+
+   All-zero chunks are never stored as chunk files.  They are recorded
+   in the zero map, count as present, and are read back as zeroes.  The
+   zero map starts from the image's own zero map, if the package has one,
+   so those chunks are never fetched; chunks found to be zero when
+   fetched are added to it.  In the pack layout, fetched zero chunks are
+   marked as such in the pack index regardless of the compression
+   setting.  In the chunks layout, they are remembered only through the
+   snapshot described below, and are fetched again if it is lost.
+
+   Scanning the chunks layout at startup is slow for a large cache, so at
+   clean shutdown we save a snapshot of the present and zero maps,
+   protected by a checksum.  The snapshot is deleted when it is loaded,
+   so if vmnetfs does not shut down cleanly, the next launch falls back to
+   scanning.
+   A snapshot can only be missing chunks that were added by another
+   vmnetfs process sharing the cache, and those are just fetched again.
+
+   The cache may be trimmed by an external cache manager.  While the image
+   is open we hold a shared lock on the lock file in the cache directory,
+   and the manager does not evict from a cache it can't lock exclusively.
+   At clean shutdown we record, for each chunk used in this session, the
+   time it was last used, so the manager can evict the least recently
+   used chunks first.
+
+   If the image has a list of chunk hashes, the chunks layout can share
+   chunks with other images through a content-addressed store, in which
+   each chunk is named by its SHA-256 hash.  Chunk files are hard-linked
+   between the store and the cache, so a chunk common to many images is
+   stored once.  At startup we link in every missing chunk that is already
+   in the store, so it is never fetched; after fetching a chunk, we verify
+   it against its hash and link it into the store.  Hashes are of the
+   uncompressed chunk.  The cache manager removes store entries no longer
+   linked from any cache.
+
+   vmnetfs processes sharing a cache, such as several instances of the same
+   package on one server, coordinate their fetches through POSIX record
+   locks on the fetch lock file, one byte per chunk.  A process locks a
+   chunk's byte before fetching it and unlocks it once the chunk is in the
+   cache, so other processes wait for the fetch to finish rather than
+   duplicating it.  Before fetching, a process rechecks the cache for
+   chunks another process has added since startup.  The byte after the
+   last chunk is held by the one process streaming the image; the streamer
+   only locks chunks it will reach soon, so other processes don't wait
+   long.  A lock failure only costs a redundant fetch, so it is never
+   fatal.
+
+   An image may also have a shared tier: a directory in the chunks layout,
+   typically on a network filesystem, that is filled by every host using
+   the image.  Before fetching a chunk from the origin we look for it in
+   the shared tier, and if it is there we copy it into the local cache.
+   Chunks we fetch from the origin are added to the shared tier.  Shared
+   chunks are checked against the chunk hashes when we have them.  The
+   shared tier is never locked or trimmed by us; files appear in it
+   atomically, and directories are created according to the umask so
+   other users can share them. */
+
 #define CHUNKS_PER_DIR 4096
+#define PACK_FILENAME "pack"
+#define PACK_INDEX_FILENAME "pack.index"
+#define SNAPSHOT_FILENAME "present"
+#define LOCK_FILENAME "lock"
+#define FETCH_LOCK_FILENAME "fetch-lock"
+/* Array of little-endian uint32_t, seconds since the epoch */
+#define ACCESS_TIMES_FILENAME "access-times"
+#define SNAPSHOT_MAGIC "VMNFSPM2"
+#define HASH_LEN 32
+
+/* All fields little-endian.  Followed by the present map, the zero map,
+   and a SHA-256 of everything before it. */
+struct snapshot_header {
+    char magic[8];
+    uint64_t chunks;
+    uint32_t chunk_size;
+    uint32_t reserved;
+};
+
+/* Values of pack index entries */
+enum chunk_encoding {
+    CHUNK_ABSENT = 0,
+    CHUNK_RAW = 1,
+    CHUNK_ZERO = 2,
+    CHUNK_LZ4 = 3,
+};
 
-static bool mkdir_with_parents(const char *dir, GError **err)
+struct pack_state {
+    char *file;
+    int fd;
+    char *index_file;
+    int index_fd;
+    /* Copy of the pack index.  An entry is only written by the thread
+       adding the chunk, before the chunk is marked present. */
+    uint8_t *index;
+};
+
+static bool mkdir_with_parents(const char *dir, int mode, GError **err)
 {
-    if (g_mkdir_with_parents(dir, 0700)) {
+    if (g_mkdir_with_parents(dir, mode)) {
         g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
                 "Couldn't create %s: %s", dir, strerror(errno));
         return false;
@@ -41,15 +157,69 @@ static uint64_t get_dir_num(uint64_t chunk)
     return chunk / CHUNKS_PER_DIR * CHUNKS_PER_DIR;
 }
 
-static char *get_dir(struct vmnetfs_image *img, uint64_t chunk)
+static char *get_dir(const char *base, uint64_t chunk)
+{
+    return g_strdup_printf("%s/%"PRIu64, base, get_dir_num(chunk));
+}
+
+static char *get_file(const char *base, uint64_t chunk)
+{
+    return g_strdup_printf("%s/%"PRIu64"/%"PRIu64, base, get_dir_num(chunk),
+            chunk);
+}
+
+static uint32_t get_chunk_length(struct vmnetfs_image *img, uint64_t chunk)
+{
+    return MIN(img->chunk_size, img->initial_size - chunk * img->chunk_size);
+}
+
+/* Decide how to store a chunk.  For CHUNK_LZ4, *buf is set to a new
+   buffer containing @reserve bytes for the caller followed by the
+   *stored_len bytes of compressed data.  Compression only counts if it
+   saves space after the reserved bytes. */
+static enum chunk_encoding encode_chunk(struct vmnetfs_image *img,
+        const void *data, uint32_t length, uint32_t reserve, char **buf,
+        uint32_t *stored_len)
 {
-    return g_strdup_printf("%s/%"PRIu64, img->read_base, get_dir_num(chunk));
+    if (!img->compress_cache) {
+        return CHUNK_RAW;
+    }
+    if (_vmnetfs_is_zero(data, length)) {
+        return CHUNK_ZERO;
+    }
+    if (length <= reserve + 1) {
+        return CHUNK_RAW;
+    }
+    *buf = g_malloc(length - 1);
+    *stored_len = _vmnetfs_compress(data, length, *buf + reserve,
+            length - reserve - 1);
+    if (*stored_len == 0) {
+        g_free(*buf);
+        *buf = NULL;
+        return CHUNK_RAW;
+    }
+    return CHUNK_LZ4;
 }
 
-static char *get_file(struct vmnetfs_image *img, uint64_t chunk)
+/* Decompress @in and copy the specified range of the chunk into @data. */
+static bool decode_chunk(struct vmnetfs_image *img, const char *file,
+        const void *in, uint32_t in_len, void *data, uint64_t chunk,
+        uint32_t offset, uint32_t length, GError **err)
 {
-    return g_strdup_printf("%s/%"PRIu64"/%"PRIu64, img->read_base,
-            get_dir_num(chunk), chunk);
+    uint32_t chunk_len = get_chunk_length(img, chunk);
+    char *buf;
+
+    buf = g_malloc(chunk_len);
+    if (!_vmnetfs_decompress(in, in_len, buf, chunk_len)) {
+        g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INVALID_CACHE,
+                "Couldn't decompress chunk %"PRIu64" from %s", chunk,
+                file);
+        g_free(buf);
+        return false;
+    }
+    memcpy(data, buf + offset, length);
+    g_free(buf);
+    return true;
 }
 
 static bool set_present_from_directory(struct vmnetfs_image *img,
@@ -86,7 +256,113 @@ static bool set_present_from_directory(struct vmnetfs_image *img,
     return true;
 }
 
-bool _vmnetfs_ll_pristine_init(struct vmnetfs_image *img, GError **err)
+static char *get_snapshot_file(struct vmnetfs_image *img)
+{
+    return g_strdup_printf("%s/%s", img->read_base, SNAPSHOT_FILENAME);
+}
+
+static bool get_digest(const void *data, gsize len, uint8_t *digest)
+{
+    GChecksum *sum;
+    gsize digest_len = HASH_LEN;
+
+    sum = g_checksum_new(G_CHECKSUM_SHA256);
+    g_checksum_update(sum, data, len);
+    g_checksum_get_digest(sum, digest, &digest_len);
+    g_checksum_free(sum);
+    return digest_len == HASH_LEN;
+}
+
+/* Requires chunk hashes. */
+static bool chunk_matches_hash(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t length)
+{
+    uint8_t digest[HASH_LEN];
+
+    return get_digest(data, length, digest) &&
+            !memcmp(digest, img->chunk_hashes + chunk * HASH_LEN, HASH_LEN);
+}
+
+/* Returns false if there is no usable snapshot. */
+static bool load_snapshot(struct vmnetfs_image *img)
+{
+    struct snapshot_header *hdr;
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t map_len = (chunks + 7) / 8;
+    uint8_t digest[HASH_LEN];
+    char *file;
+    char *data;
+    gsize len;
+    bool ret = false;
+
+    file = get_snapshot_file(img);
+    if (!g_file_get_contents(file, &data, &len, NULL)) {
+        g_free(file);
+        return false;
+    }
+    /* Consume the snapshot, so that it can't become stale */
+    if (unlink(file) && errno != ENOENT) {
+        g_warning("Couldn't remove %s: %s", file, strerror(errno));
+        goto out;
+    }
+    hdr = (struct snapshot_header *) data;
+    if (len != sizeof(*hdr) + 2 * map_len + sizeof(digest) ||
+            memcmp(hdr->magic, SNAPSHOT_MAGIC, sizeof(hdr->magic)) ||
+            GUINT64_FROM_LE(hdr->chunks) != chunks ||
+            GUINT32_FROM_LE(hdr->chunk_size) != img->chunk_size) {
+        goto out;
+    }
+    if (!get_digest(data, sizeof(*hdr) + 2 * map_len, digest) ||
+            memcmp(digest, data + sizeof(*hdr) + 2 * map_len,
+            sizeof(digest))) {
+        goto out;
+    }
+    _vmnetfs_bit_import(img->present_map, data + sizeof(*hdr), chunks);
+    _vmnetfs_bit_import(img->zero_map, data + sizeof(*hdr) + map_len,
+            chunks);
+    ret = true;
+
+out:
+    g_free(data);
+    g_free(file);
+    return ret;
+}
+
+static void save_snapshot(struct vmnetfs_image *img)
+{
+    struct snapshot_header *hdr;
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t map_len = (chunks + 7) / 8;
+    uint64_t len = sizeof(*hdr) + 2 * map_len + HASH_LEN;
+    char *file;
+    char *data;
+    GError *err = NULL;
+
+    data = g_malloc0(len);
+    hdr = (struct snapshot_header *) data;
+    memcpy(hdr->magic, SNAPSHOT_MAGIC, sizeof(hdr->magic));
+    hdr->chunks = GUINT64_TO_LE(chunks);
+    hdr->chunk_size = GUINT32_TO_LE(img->chunk_size);
+    _vmnetfs_bit_export(img->present_map, data + sizeof(*hdr), chunks);
+    _vmnetfs_bit_export(img->zero_map, data + sizeof(*hdr) + map_len,
+            chunks);
+    if (!get_digest(data, sizeof(*hdr) + 2 * map_len,
+            (uint8_t *) data + sizeof(*hdr) + 2 * map_len)) {
+        g_free(data);
+        return;
+    }
+    file = get_snapshot_file(img);
+    if (!g_file_set_contents(file, data, len, &err)) {
+        g_warning("Couldn't save present map: %s", err->message);
+        g_clear_error(&err);
+    }
+    g_free(file);
+    g_free(data);
+}
+
+static bool chunks_init(struct vmnetfs_image *img, GError **err)
 {
     GDir *dir;
     const char *name;
@@ -94,15 +370,16 @@ bool _vmnetfs_ll_pristine_init(struct vmnetfs_image *img, GError **err)
     char *endptr;
     uint64_t dir_num;
 
-    if (!mkdir_with_parents(img->read_base, err)) {
-        return false;
+    img->present_map = _vmnetfs_bit_new(img->bitmaps, false);
+    if (load_snapshot(img)) {
+        return true;
     }
 
     dir = g_dir_open(img->read_base, 0, err);
     if (dir == NULL) {
+        _vmnetfs_bit_free(img->present_map);
         return false;
     }
-    img->present_map = _vmnetfs_bit_new(img->bitmaps, false);
     while ((name = g_dir_read_name(dir)) != NULL) {
         path = g_strdup_printf("%s/%s", img->read_base, name);
         dir_num = g_ascii_strtoull(name, &endptr, 10);
@@ -121,33 +398,703 @@ bool _vmnetfs_ll_pristine_init(struct vmnetfs_image *img, GError **err)
     return true;
 }
 
+static char *get_store_file(struct vmnetfs_image *img, uint64_t chunk)
+{
+    static const char digits[] = "0123456789abcdef";
+    const uint8_t *hash = img->chunk_hashes + chunk * HASH_LEN;
+    char hex[2 * HASH_LEN + 1];
+    int i;
+
+    for (i = 0; i < HASH_LEN; i++) {
+        hex[2 * i] = digits[hash[i] >> 4];
+        hex[2 * i + 1] = digits[hash[i] & 0xf];
+    }
+    hex[2 * HASH_LEN] = 0;
+    return g_strdup_printf("%s/%.2s/%s", img->store_path, hex, hex);
+}
+
+/* Returns true if the chunk was linked into the cache from the store. */
+static bool store_import(struct vmnetfs_image *img, uint64_t chunk)
+{
+    char *store_file;
+    char *dir;
+    char *file;
+    int ret;
+
+    store_file = get_store_file(img, chunk);
+    file = get_file(img->read_base, chunk);
+    ret = link(store_file, file);
+    if (ret && errno == ENOENT && g_file_test(store_file,
+            G_FILE_TEST_EXISTS)) {
+        /* The chunk directory doesn't exist yet */
+        dir = get_dir(img->read_base, chunk);
+        if (!g_mkdir_with_parents(dir, 0700)) {
+            ret = link(store_file, file);
+        }
+        g_free(dir);
+    }
+    if (ret == 0 || errno == EEXIST) {
+        _vmnetfs_bit_set(img->present_map, chunk);
+        _vmnetfs_u64_stat_increment(img->chunk_store_hits, 1);
+    }
+    g_free(file);
+    g_free(store_file);
+    return _vmnetfs_bit_test(img->present_map, chunk);
+}
+
+/* Add a newly-fetched chunk to the store.  Errors are logged. */
+static void store_export(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t length, const char *file)
+{
+    char *store_file;
+    char *dir;
+
+    if (!chunk_matches_hash(img, data, chunk, length)) {
+        g_warning("Chunk %"PRIu64" doesn't match its hash; not adding it "
+                "to the store", chunk);
+        return;
+    }
+    store_file = get_store_file(img, chunk);
+    dir = g_path_get_dirname(store_file);
+    if (g_mkdir_with_parents(dir, 0700)) {
+        g_warning("Couldn't create %s: %s", dir, strerror(errno));
+    } else if (link(file, store_file) && errno != EEXIST) {
+        g_warning("Couldn't link %s to %s: %s", file, store_file,
+                strerror(errno));
+    }
+    g_free(dir);
+    g_free(store_file);
+}
+
+static bool store_init(struct vmnetfs_image *img, GError **err)
+{
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t chunk;
+    char *data;
+    gsize len;
+
+    if (img->store_path == NULL) {
+        return true;
+    }
+    if (img->cache_layout != CACHE_LAYOUT_CHUNKS) {
+        g_set_error(err, VMNETFS_CONFIG_ERROR,
+                VMNETFS_CONFIG_ERROR_INVALID_CONFIG,
+                "Chunk store requires chunks cache layout");
+        return false;
+    }
+    if (!g_file_get_contents(img->hashes_file, &data, &len, err)) {
+        return false;
+    }
+    if (len != chunks * HASH_LEN) {
+        g_set_error(err, VMNETFS_CONFIG_ERROR,
+                VMNETFS_CONFIG_ERROR_INVALID_CONFIG,
+                "%s has size %"PRIu64", expected %"PRIu64,
+                img->hashes_file, (uint64_t) len, chunks * HASH_LEN);
+        g_free(data);
+        return false;
+    }
+    img->chunk_hashes = (uint8_t *) data;
+
+    for (chunk = 0; chunk < chunks; chunk++) {
+        if (!_vmnetfs_bit_test(img->present_map, chunk)) {
+            store_import(img, chunk);
+        }
+    }
+    return true;
+}
+
+/* Open the file, creating it with the specified size if it is empty.
+   Returns -1 on error. */
+static int open_sized_file(const char *file, uint64_t size, GError **err)
+{
+    struct stat st;
+    int fd;
+
+    fd = open(file, O_RDWR | O_CREAT, 0600);
+    if (fd == -1) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Couldn't open %s: %s", file, strerror(errno));
+        return -1;
+    }
+    if (fstat(fd, &st)) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Couldn't stat %s: %s", file, strerror(errno));
+        close(fd);
+        return -1;
+    }
+    if (st.st_size == 0 && size > 0) {
+        /* New file; allocate it sparsely */
+        if (ftruncate(fd, size)) {
+            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                    "Couldn't extend %s: %s", file, strerror(errno));
+            close(fd);
+            return -1;
+        }
+    } else if ((uint64_t) st.st_size != size) {
+        g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INVALID_CACHE,
+                "%s has size %"PRIu64", expected %"PRIu64, file,
+                (uint64_t) st.st_size, size);
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+static void pack_free(struct pack_state *pack)
+{
+    if (pack->index_fd != -1) {
+        close(pack->index_fd);
+    }
+    if (pack->fd != -1) {
+        close(pack->fd);
+    }
+    g_free(pack->index);
+    g_free(pack->index_file);
+    g_free(pack->file);
+    g_slice_free(struct pack_state, pack);
+}
+
+static bool pack_init(struct vmnetfs_image *img, GError **err)
+{
+    struct pack_state *pack;
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t chunk;
+
+    pack = g_slice_new0(struct pack_state);
+    pack->file = g_strdup_printf("%s/%s", img->read_base, PACK_FILENAME);
+    pack->index_file = g_strdup_printf("%s/%s", img->read_base,
+            PACK_INDEX_FILENAME);
+    pack->fd = open_sized_file(pack->file, img->initial_size, err);
+    pack->index_fd = -1;
+    if (pack->fd == -1) {
+        pack_free(pack);
+        return false;
+    }
+    pack->index_fd = open_sized_file(pack->index_file, chunks, err);
+    if (pack->index_fd == -1) {
+        pack_free(pack);
+        return false;
+    }
+
+    pack->index = g_malloc(chunks);
+    if (!_vmnetfs_safe_pread(pack->index_file, pack->index_fd, pack->index,
+            chunks, 0, err)) {
+        pack_free(pack);
+        return false;
+    }
+    img->present_map = _vmnetfs_bit_new(img->bitmaps, false);
+    for (chunk = 0; chunk < chunks; chunk++) {
+        switch (pack->index[chunk]) {
+        case CHUNK_ABSENT:
+            break;
+        case CHUNK_ZERO:
+            _vmnetfs_bit_set(img->zero_map, chunk);
+            _vmnetfs_bit_set(img->present_map, chunk);
+            break;
+        case CHUNK_RAW:
+        case CHUNK_LZ4:
+            _vmnetfs_bit_set(img->present_map, chunk);
+            break;
+        default:
+            g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INVALID_CACHE,
+                    "Invalid entry for chunk %"PRIu64" in %s", chunk,
+                    pack->index_file);
+            _vmnetfs_bit_free(img->present_map);
+            pack_free(pack);
+            return false;
+        }
+    }
+    img->pack = pack;
+    return true;
+}
+
+/* Returns false with errno set on failure. */
+static bool set_fetch_lock(struct vmnetfs_image *img, int cmd, short type,
+        uint64_t start, uint64_t count)
+{
+    struct flock fl = {
+        .l_type = type,
+        .l_whence = SEEK_SET,
+        .l_start = start,
+        .l_len = count,
+    };
+
+    return fcntl(img->fetch_lock_fd, cmd, &fl) == 0;
+}
+
+/* Wait until no other process is fetching any of the specified chunks, then
+   claim them.  Returns false only if @should_cancel reports that the
+   operation was cancelled. */
+bool _vmnetfs_ll_pristine_lock_fetch(struct vmnetfs_image *img,
+        uint64_t start_chunk, uint64_t count,
+        should_cancel_fn *should_cancel, void *should_cancel_arg,
+        GError **err)
+{
+    while (!set_fetch_lock(img, F_SETLKW, F_WRLCK, start_chunk, count)) {
+        if (errno != EINTR) {
+            /* Probably EDEADLK, which can be spurious since record locks
+               are per-process.  Fetch without the lock. */
+            break;
+        }
+        if (should_cancel && should_cancel(should_cancel_arg)) {
+            g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INTERRUPTED,
+                    "Operation interrupted");
+            return false;
+        }
+    }
+    return true;
+}
+
+/* Claim the specified chunks if no other process is fetching them.
+   Chunks held by another process are skipped. */
+void _vmnetfs_ll_pristine_trylock_fetch(struct vmnetfs_image *img,
+        uint64_t start_chunk, uint64_t count)
+{
+    uint64_t chunk;
+
+    if (set_fetch_lock(img, F_SETLK, F_WRLCK, start_chunk, count)) {
+        return;
+    }
+    for (chunk = start_chunk; chunk < start_chunk + count; chunk++) {
+        set_fetch_lock(img, F_SETLK, F_WRLCK, chunk, 1);
+    }
+}
+
+/* Unlocking a chunk we don't hold is harmless. */
+void _vmnetfs_ll_pristine_unlock_fetch(struct vmnetfs_image *img,
+        uint64_t start_chunk, uint64_t count)
+{
+    set_fetch_lock(img, F_SETLK, F_UNLCK, start_chunk, count);
+}
+
+/* Returns false if another process is streaming the image. */
+bool _vmnetfs_ll_pristine_claim_stream(struct vmnetfs_image *img)
+{
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+
+    return set_fetch_lock(img, F_SETLK, F_WRLCK, chunks, 1) ||
+            (errno != EACCES && errno != EAGAIN);
+}
+
+void _vmnetfs_ll_pristine_release_stream(struct vmnetfs_image *img)
+{
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+
+    set_fetch_lock(img, F_SETLK, F_UNLCK, chunks, 1);
+}
+
+/* Check whether another process has added the chunk to the cache since we
+   last looked.  Chunk lock must be held.  Returns true if the chunk is
+   present. */
+bool _vmnetfs_ll_pristine_refresh_chunk(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    struct pack_state *pack = img->pack;
+    uint8_t entry;
+    char *file;
+    bool present;
+
+    if (_vmnetfs_bit_test(img->present_map, chunk)) {
+        return true;
+    }
+    if (pack) {
+        present = pread(pack->index_fd, &entry, 1, chunk) == 1 &&
+                entry >= CHUNK_RAW && entry <= CHUNK_LZ4;
+        if (present) {
+            pack->index[chunk] = entry;
+            if (entry == CHUNK_ZERO) {
+                _vmnetfs_bit_set(img->zero_map, chunk);
+            }
+        }
+    } else {
+        file = get_file(img->read_base, chunk);
+        present = g_file_test(file, G_FILE_TEST_IS_REGULAR);
+        g_free(file);
+    }
+    if (present) {
+        _vmnetfs_bit_set(img->present_map, chunk);
+    }
+    return present;
+}
+
+static bool open_fetch_lock(struct vmnetfs_image *img, GError **err)
+{
+    char *file;
+
+    file = g_strdup_printf("%s/%s", img->read_base, FETCH_LOCK_FILENAME);
+    img->fetch_lock_fd = open(file, O_RDWR | O_CREAT, 0600);
+    if (img->fetch_lock_fd == -1) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Couldn't open %s: %s", file, strerror(errno));
+        g_free(file);
+        return false;
+    }
+    g_free(file);
+    return true;
+}
+
+/* Blocks while the cache manager is evicting from this cache. */
+static bool lock_cache(struct vmnetfs_image *img, GError **err)
+{
+    char *file;
+
+    file = g_strdup_printf("%s/%s", img->read_base, LOCK_FILENAME);
+    img->cache_lock_fd = open(file, O_RDWR | O_CREAT, 0600);
+    if (img->cache_lock_fd == -1) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Couldn't open %s: %s", file, strerror(errno));
+        g_free(file);
+        return false;
+    }
+    while (flock(img->cache_lock_fd, LOCK_SH)) {
+        if (errno != EINTR) {
+            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                    "Couldn't lock %s: %s", file, strerror(errno));
+            close(img->cache_lock_fd);
+            g_free(file);
+            return false;
+        }
+    }
+    g_free(file);
+    return true;
+}
+
+static void save_access_times(struct vmnetfs_image *img)
+{
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t chunk;
+    uint32_t now = GUINT32_TO_LE(time(NULL));
+    uint32_t *times = NULL;
+    uint8_t *accessed;
+    uint8_t *fetched;
+    char *file;
+    gsize len;
+    GError *err = NULL;
+
+    file = g_strdup_printf("%s/%s", img->read_base, ACCESS_TIMES_FILENAME);
+    if (!g_file_get_contents(file, (char **) &times, &len, NULL) ||
+            len != chunks * sizeof(*times)) {
+        g_free(times);
+        times = g_new0(uint32_t, chunks);
+    }
+    accessed = g_malloc((chunks + 7) / 8);
+    fetched = g_malloc((chunks + 7) / 8);
+    _vmnetfs_bit_export(img->accessed_map, accessed, chunks);
+    _vmnetfs_bit_export(img->fetched_map, fetched, chunks);
+    for (chunk = 0; chunk < chunks; chunk++) {
+        if ((accessed[chunk / 8] | fetched[chunk / 8]) & (1 << (chunk % 8))) {
+            times[chunk] = now;
+        }
+    }
+    if (!g_file_set_contents(file, (char *) times, chunks * sizeof(*times),
+            &err)) {
+        g_warning("Couldn't save chunk access times: %s", err->message);
+        g_clear_error(&err);
+    }
+    g_free(fetched);
+    g_free(accessed);
+    g_free(times);
+    g_free(file);
+}
+
+/* Mark the chunks in the image's zero map as present. */
+static bool zero_map_init(struct vmnetfs_image *img, GError **err)
+{
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    char *data;
+    gsize len;
+
+    if (img->zero_map_file == NULL) {
+        return true;
+    }
+    if (!g_file_get_contents(img->zero_map_file, &data, &len, err)) {
+        return false;
+    }
+    if (len != (chunks + 7) / 8) {
+        g_set_error(err, VMNETFS_CONFIG_ERROR,
+                VMNETFS_CONFIG_ERROR_INVALID_CONFIG,
+                "%s has size %"PRIu64", expected %"PRIu64,
+                img->zero_map_file, (uint64_t) len, (chunks + 7) / 8);
+        g_free(data);
+        return false;
+    }
+    _vmnetfs_bit_import(img->zero_map, data, chunks);
+    _vmnetfs_bit_import(img->present_map, data, chunks);
+    g_free(data);
+    return true;
+}
+
+bool _vmnetfs_ll_pristine_init(struct vmnetfs_image *img, GError **err)
+{
+    bool ret;
+
+    if (!mkdir_with_parents(img->read_base, 0700, err)) {
+        return false;
+    }
+    if (!lock_cache(img, err)) {
+        return false;
+    }
+    if (!open_fetch_lock(img, err)) {
+        close(img->cache_lock_fd);
+        return false;
+    }
+
+    img->zero_map = _vmnetfs_bit_new(img->bitmaps, false);
+    switch (img->cache_layout) {
+    case CACHE_LAYOUT_PACK:
+        ret = pack_init(img, err);
+        break;
+    default:
+        ret = chunks_init(img, err);
+        break;
+    }
+    if (ret && (!zero_map_init(img, err) || !store_init(img, err))) {
+        _vmnetfs_bit_free(img->present_map);
+        ret = false;
+    }
+    if (!ret) {
+        _vmnetfs_bit_free(img->zero_map);
+        close(img->fetch_lock_fd);
+        close(img->cache_lock_fd);
+    }
+    return ret;
+}
+
+/* Called at clean shutdown, once nothing else can write to the pristine
+   cache. */
+void _vmnetfs_ll_pristine_close(struct vmnetfs_image *img)
+{
+    save_access_times(img);
+    if (img->cache_layout == CACHE_LAYOUT_CHUNKS) {
+        save_snapshot(img);
+    }
+}
+
 void _vmnetfs_ll_pristine_destroy(struct vmnetfs_image *img)
 {
+    if (img->pack) {
+        pack_free(img->pack);
+        img->pack = NULL;
+    }
     _vmnetfs_bit_free(img->present_map);
+    _vmnetfs_bit_free(img->zero_map);
+    g_free(img->chunk_hashes);
+    /* Releases the locks */
+    close(img->fetch_lock_fd);
+    close(img->cache_lock_fd);
 }
 
-bool _vmnetfs_ll_pristine_read_chunk(struct vmnetfs_image *img, void *data,
+static bool write_zero_chunk(struct vmnetfs_image *img, uint64_t chunk,
+        GError **err)
+{
+    struct pack_state *pack = img->pack;
+    uint8_t entry = CHUNK_ZERO;
+
+    if (pack) {
+        if (!_vmnetfs_safe_pwrite(pack->index_file, pack->index_fd, &entry,
+                1, chunk, err)) {
+            return false;
+        }
+        pack->index[chunk] = entry;
+    }
+    _vmnetfs_bit_set(img->zero_map, chunk);
+    _vmnetfs_bit_set(img->present_map, chunk);
+    return true;
+}
+
+static bool pack_write_chunk(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t length, GError **err)
+{
+    struct pack_state *pack = img->pack;
+    uint64_t start = chunk * img->chunk_size;
+    enum chunk_encoding encoding;
+    char *buf = NULL;
+    uint32_t stored_len;
+    uint32_t le_len;
+    uint8_t entry;
+    bool ret = true;
+
+    encoding = encode_chunk(img, data, length, sizeof(le_len), &buf,
+            &stored_len);
+    switch (encoding) {
+    case CHUNK_RAW:
+        ret = _vmnetfs_safe_pwrite(pack->file, pack->fd, data, length,
+                start, err);
+        break;
+    case CHUNK_ZERO:
+        /* Leave the slot sparse */
+        break;
+    case CHUNK_LZ4:
+        le_len = GUINT32_TO_LE(stored_len);
+        memcpy(buf, &le_len, sizeof(le_len));
+        ret = _vmnetfs_safe_pwrite(pack->file, pack->fd, buf,
+                sizeof(le_len) + stored_len, start, err);
+        g_free(buf);
+        break;
+    default:
+        g_assert_not_reached();
+    }
+    if (!ret) {
+        return false;
+    }
+    entry = encoding;
+    if (!_vmnetfs_safe_pwrite(pack->index_file, pack->index_fd, &entry,
+            1, chunk, err)) {
+        return false;
+    }
+    pack->index[chunk] = entry;
+    _vmnetfs_bit_set(img->present_map, chunk);
+    return true;
+}
+
+static bool pack_read_chunk(struct vmnetfs_image *img, void *data,
         uint64_t chunk, uint32_t offset, uint32_t length, GError **err)
 {
-    char *file;
-    int fd;
+    struct pack_state *pack = img->pack;
+    uint64_t start = chunk * img->chunk_size;
+    uint32_t le_len;
+    uint32_t stored_len;
+    char *buf;
     bool ret;
 
-    g_assert(_vmnetfs_bit_test(img->present_map, chunk));
-    g_assert(offset < img->chunk_size);
-    g_assert(offset + length <= img->chunk_size);
-    g_assert(chunk * img->chunk_size + offset + length <= img->initial_size);
+    switch (pack->index[chunk]) {
+    case CHUNK_RAW:
+        return _vmnetfs_safe_pread(pack->file, pack->fd, data, length,
+                start + offset, err);
+    case CHUNK_ZERO:
+        memset(data, 0, length);
+        return true;
+    case CHUNK_LZ4:
+        if (!_vmnetfs_safe_pread(pack->file, pack->fd, &le_len,
+                sizeof(le_len), start, err)) {
+            return false;
+        }
+        stored_len = GUINT32_FROM_LE(le_len);
+        if (stored_len >= get_chunk_length(img, chunk) - sizeof(le_len)) {
+            g_set_error(err, VMNETFS_IO_ERROR,
+                    VMNETFS_IO_ERROR_INVALID_CACHE,
+                    "Invalid compressed length for chunk %"PRIu64" in %s",
+                    chunk, pack->file);
+            return false;
+        }
+        buf = g_malloc(stored_len);
+        ret = _vmnetfs_safe_pread(pack->file, pack->fd, buf, stored_len,
+                start + sizeof(le_len), err) &&
+                decode_chunk(img, pack->file, buf, stored_len, data, chunk,
+                offset, length, err);
+        g_free(buf);
+        return ret;
+    default:
+        g_assert_not_reached();
+    }
+}
+
+/* Read part of a chunk from a file in the chunks layout. */
+static bool read_chunk_file(struct vmnetfs_image *img, const char *file,
+        void *data, uint64_t chunk, uint32_t offset, uint32_t length,
+        GError **err)
+{
+    uint32_t chunk_len;
+    struct stat st;
+    char *buf;
+    int fd;
+    bool ret;
 
-    file = get_file(img, chunk);
     fd = open(file, O_RDONLY);
     if (fd == -1) {
         g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
                 "Couldn't open %s: %s", file, strerror(errno));
-        g_free(file);
         return false;
     }
-    ret = _vmnetfs_safe_pread(file, fd, data, length, offset, err);
+    if (fstat(fd, &st)) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Couldn't stat %s: %s", file, strerror(errno));
+        ret = false;
+        goto out;
+    }
+    chunk_len = get_chunk_length(img, chunk);
+    if ((uint64_t) st.st_size == chunk_len) {
+        ret = _vmnetfs_safe_pread(file, fd, data, length, offset, err);
+    } else if (st.st_size == 0) {
+        memset(data, 0, length);
+        ret = true;
+    } else if ((uint64_t) st.st_size < chunk_len) {
+        buf = g_malloc(st.st_size);
+        ret = _vmnetfs_safe_pread(file, fd, buf, st.st_size, 0, err) &&
+                decode_chunk(img, file, buf, st.st_size, data, chunk,
+                offset, length, err);
+        g_free(buf);
+    } else {
+        g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INVALID_CACHE,
+                "%s has size %"PRIu64", expected at most %u", file,
+                (uint64_t) st.st_size, chunk_len);
+        ret = false;
+    }
+
+out:
     close(fd);
+    return ret;
+}
+
+/* Atomically write a chunk to a file in the chunks layout, creating its
+   directory with the specified mode. */
+static bool write_chunk_file(struct vmnetfs_image *img, const char *dir,
+        int dir_mode, const char *file, const void *data, uint32_t length,
+        GError **err)
+{
+    enum chunk_encoding encoding;
+    char *buf = NULL;
+    uint32_t stored_len;
+    bool ret;
+
+    if (!mkdir_with_parents(dir, dir_mode, err)) {
+        return false;
+    }
+    encoding = encode_chunk(img, data, length, 0, &buf, &stored_len);
+    switch (encoding) {
+    case CHUNK_RAW:
+        ret = g_file_set_contents(file, data, length, err);
+        break;
+    case CHUNK_ZERO:
+        ret = g_file_set_contents(file, "", 0, err);
+        break;
+    case CHUNK_LZ4:
+        ret = g_file_set_contents(file, buf, stored_len, err);
+        g_free(buf);
+        break;
+    default:
+        g_assert_not_reached();
+    }
+    return ret;
+}
+
+bool _vmnetfs_ll_pristine_read_chunk(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length, GError **err)
+{
+    char *file;
+    bool ret;
+
+    g_assert(_vmnetfs_bit_test(img->present_map, chunk));
+    g_assert(offset < img->chunk_size);
+    g_assert(offset + length <= img->chunk_size);
+    g_assert(chunk * img->chunk_size + offset + length <= img->initial_size);
+
+    if (_vmnetfs_bit_test(img->zero_map, chunk)) {
+        memset(data, 0, length);
+        return true;
+    }
+    if (img->pack) {
+        return pack_read_chunk(img, data, chunk, offset, length, err);
+    }
+
+    file = get_file(img->read_base, chunk);
+    ret = read_chunk_file(img, file, data, chunk, offset, length, err);
     g_free(file);
     return ret;
 }
@@ -162,21 +1109,104 @@ bool _vmnetfs_ll_pristine_write_chunk(struct vmnetfs_image *img, void *data,
     g_assert(length <= img->chunk_size);
     g_assert(chunk * img->chunk_size + length <= img->initial_size);
 
-    dir = get_dir(img, chunk);
-    file = get_file(img, chunk);
+    if (_vmnetfs_is_zero(data, length)) {
+        return write_zero_chunk(img, chunk, err);
+    }
+    if (img->pack) {
+        return pack_write_chunk(img, data, chunk, length, err);
+    }
 
-    ret = mkdir_with_parents(dir, err);
-    if (!ret) {
-        goto out;
+    dir = get_dir(img->read_base, chunk);
+    file = get_file(img->read_base, chunk);
+    ret = write_chunk_file(img, dir, 0700, file, data, length, err);
+    if (ret) {
+        if (img->chunk_hashes) {
+            store_export(img, data, chunk, length, file);
+        }
+        _vmnetfs_bit_set(img->present_map, chunk);
+    }
+    g_free(file);
+    g_free(dir);
+    return ret;
+}
+
+/* Read a whole chunk from the shared tier.  Returns false if the chunk is
+   not there or is unusable; problems other than absence are logged. */
+bool _vmnetfs_ll_pristine_read_shared(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t length)
+{
+    GError *err = NULL;
+    char *file;
+    bool ret;
+
+    if (img->shared_path == NULL) {
+        return false;
     }
-    ret = g_file_set_contents(file, data, length, err);
+    g_assert(length == get_chunk_length(img, chunk));
+
+    file = get_file(img->shared_path, chunk);
+    ret = read_chunk_file(img, file, data, chunk, 0, length, &err);
     if (!ret) {
-        goto out;
+        if (!g_error_matches(err, G_FILE_ERROR, G_FILE_ERROR_NOENT)) {
+            g_warning("Couldn't read chunk %"PRIu64" from shared cache: %s",
+                    chunk, err->message);
+        }
+        g_clear_error(&err);
+    } else if (img->chunk_hashes &&
+            !chunk_matches_hash(img, data, chunk, length)) {
+        g_warning("%s doesn't match its hash; ignoring it", file);
+        ret = false;
     }
-    _vmnetfs_bit_set(img->present_map, chunk);
+    if (ret) {
+        _vmnetfs_u64_stat_increment(img->chunk_shared_hits, 1);
+    }
+    g_free(file);
+    return ret;
+}
 
-out:
+/* Returns true if the shared tier appears to have the chunk.  The chunk
+   may still turn out to be unusable when it is read. */
+bool _vmnetfs_ll_pristine_shared_contains(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    char *file;
+    bool ret;
+
+    if (img->shared_path == NULL) {
+        return false;
+    }
+    file = get_file(img->shared_path, chunk);
+    ret = g_file_test(file, G_FILE_TEST_IS_REGULAR);
     g_free(file);
-    g_free(dir);
     return ret;
 }
+
+/* Add a chunk fetched from the origin to the shared tier.  The shared
+   tier may not be writable by us, so after the first failure we stop
+   trying.  Called only from the writeback thread. */
+void _vmnetfs_ll_pristine_write_shared(struct vmnetfs_image *img,
+        const void *data, uint64_t chunk, uint32_t length)
+{
+    GError *err = NULL;
+    char *dir;
+    char *file;
+
+    if (img->shared_path == NULL || img->shared_readonly) {
+        return;
+    }
+    if (img->chunk_hashes && !chunk_matches_hash(img, data, chunk, length)) {
+        return;
+    }
+    dir = get_dir(img->shared_path, chunk);
+    file = get_file(img->shared_path, chunk);
+    /* Another host may have added it since we looked */
+    if (!g_file_test(file, G_FILE_TEST_EXISTS) &&
+            !write_chunk_file(img, dir, 0777, file, data, length, &err)) {
+        g_warning("Couldn't add chunk %"PRIu64" to shared cache; not "
+                "adding any more: %s", chunk, err->message);
+        g_clear_error(&err);
+        img->shared_readonly = true;
+    }
+    g_free(file);
+    g_free(dir);
+}
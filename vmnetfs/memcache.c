@@ -0,0 +1,170 @@
+/*
+ * vmnetfs - virtual machine network execution virtual filesystem
+ *
+ * Copyright (C) 2006-2014 Carnegie Mellon University
+ *
+ * This program is free software; you can redistribute it and/or modify it
+ * under the terms of version 2 of the GNU General Public License as published
+ * by the Free Software Foundation.  A copy of the GNU General Public License
+ * should have been distributed along with this program in the file
+ * COPYING.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+ * for more details.
+ */
+
+/* In-memory cache of recently read pristine chunks.  The image is exported
+   with direct_io, so the kernel page cache never sees repeated reads of
+   the same chunk; this cache saves the trip to the pristine cache (and
+   any decompression) for chunks the guest reads often.
+
+   Pristine chunks never change, so entries never need to be invalidated.
+   Chunks that become modified are read from the modified cache instead,
+   and their entries age out.  The cache is divided into shards by chunk
+   number, each with its own lock and LRU list, so concurrent readers of
+   different chunks rarely contend. */
+
+#include <string.h>
+#include "vmnetfs-private.h"
+
+#define MEMCACHE_SHARDS 16
+
+struct memcache_entry {
+    uint64_t chunk;
+    uint32_t length;
+    char *data;
+    GList *link;            /* in shard LRU list, most recent first */
+};
+
+struct memcache_shard {
+    GMutex *lock;
+    GHashTable *entries;    /* uint64_t -> struct memcache_entry */
+    GQueue lru;
+    uint64_t size;
+    uint64_t capacity;
+};
+
+struct memcache_state {
+    struct memcache_shard shards[MEMCACHE_SHARDS];
+};
+
+static void entry_free(void *data)
+{
+    struct memcache_entry *entry = data;
+
+    g_free(entry->data);
+    g_slice_free(struct memcache_entry, entry);
+}
+
+static struct memcache_shard *get_shard(struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    return &img->memcache->shards[chunk % MEMCACHE_SHARDS];
+}
+
+void _vmnetfs_memcache_init(struct vmnetfs_image *img)
+{
+    struct memcache_state *mc;
+    struct memcache_shard *shard;
+    int i;
+
+    if (img->memcache_size == 0) {
+        return;
+    }
+    mc = g_slice_new0(struct memcache_state);
+    for (i = 0; i < MEMCACHE_SHARDS; i++) {
+        shard = &mc->shards[i];
+        shard->lock = g_mutex_new();
+        shard->entries = g_hash_table_new_full(g_int64_hash, g_int64_equal,
+                NULL, entry_free);
+        g_queue_init(&shard->lru);
+        shard->capacity = img->memcache_size / MEMCACHE_SHARDS;
+    }
+    img->memcache = mc;
+}
+
+void _vmnetfs_memcache_destroy(struct vmnetfs_image *img)
+{
+    struct memcache_state *mc = img->memcache;
+    struct memcache_shard *shard;
+    int i;
+
+    if (mc == NULL) {
+        return;
+    }
+    for (i = 0; i < MEMCACHE_SHARDS; i++) {
+        shard = &mc->shards[i];
+        g_queue_clear(&shard->lru);
+        g_hash_table_destroy(shard->entries);
+        g_mutex_free(shard->lock);
+    }
+    g_slice_free(struct memcache_state, mc);
+    img->memcache = NULL;
+}
+
+/* Returns false on a cache miss. */
+bool _vmnetfs_memcache_read(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length)
+{
+    struct memcache_shard *shard;
+    struct memcache_entry *entry;
+
+    if (img->memcache == NULL) {
+        return false;
+    }
+    shard = get_shard(img, chunk);
+    g_mutex_lock(shard->lock);
+    entry = g_hash_table_lookup(shard->entries, &chunk);
+    if (entry == NULL || offset + length > entry->length) {
+        g_mutex_unlock(shard->lock);
+        _vmnetfs_u64_stat_increment(img->memcache_misses, 1);
+        return false;
+    }
+    memcpy(data, entry->data + offset, length);
+    g_queue_unlink(&shard->lru, entry->link);
+    g_queue_push_head_link(&shard->lru, entry->link);
+    g_mutex_unlock(shard->lock);
+    _vmnetfs_u64_stat_increment(img->memcache_hits, 1);
+    return true;
+}
+
+/* Add the full contents of a pristine chunk, evicting least recently used
+   chunks to make room. */
+void _vmnetfs_memcache_insert(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t length)
+{
+    struct memcache_shard *shard;
+    struct memcache_entry *entry;
+    GList *link;
+
+    if (img->memcache == NULL) {
+        return;
+    }
+    shard = get_shard(img, chunk);
+    if (length > shard->capacity) {
+        return;
+    }
+    g_mutex_lock(shard->lock);
+    if (g_hash_table_lookup(shard->entries, &chunk) != NULL) {
+        g_mutex_unlock(shard->lock);
+        return;
+    }
+    while (shard->size + length > shard->capacity) {
+        link = g_queue_pop_tail_link(&shard->lru);
+        entry = link->data;
+        g_list_free_1(link);
+        shard->size -= entry->length;
+        g_hash_table_remove(shard->entries, &entry->chunk);
+    }
+    entry = g_slice_new0(struct memcache_entry);
+    entry->chunk = chunk;
+    entry->length = length;
+    entry->data = g_memdup(data, length);
+    g_queue_push_head(&shard->lru, entry);
+    entry->link = shard->lru.head;
+    g_hash_table_replace(shard->entries, &entry->chunk, entry);
+    shard->size += length;
+    g_mutex_unlock(shard->lock);
+}
@@ -0,0 +1,355 @@
+/*
+ * vmnetfs - virtual machine network execution virtual filesystem
+ *
+ * Copyright (C) 2006-2014 Carnegie Mellon University
+ *
+ * This program is free software; you can redistribute it and/or modify it
+ * under the terms of version 2 of the GNU General Public License as published
+ * by the Free Software Foundation.  A copy of the GNU General Public License
+ * should have been distributed along with this program in the file
+ * COPYING.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+ * for more details.
+ */
+
+/* Chunk transition model.  For each chunk, we count which chunks the guest
+   read immediately after it, keeping only the few most frequent
+   successors.  When the guest reads a chunk, its likely successors are
+   returned for prefetching, following the most likely successor a few
+   steps further while the combined confidence stays high enough.  This
+   catches access patterns that are neither sequential nor part of the
+   saved access profile.
+
+   The model is saved in the pristine cache directory at the end of the
+   session and loaded at the start of the next one.  Counts are halved
+   when saving, rounding up so that a transition seen once per session
+   survives, and older observations gradually lose weight against new
+   ones. */
+
+#include <string.h>
+#include <inttypes.h>
+#include "vmnetfs-private.h"
+
+#define PREDICT_FILENAME "transitions"
+/* Successors tracked per chunk */
+#define PREDICT_SUCCESSORS 4
+/* Maximum number of chunks with tracked successors */
+#define PREDICT_MAX_SOURCES 65536
+/* Counts are halved when a chunk's total reaches this value */
+#define PREDICT_MAX_COUNT 1024
+/* Minimum number of observations before a transition is predicted */
+#define PREDICT_MIN_COUNT 2
+/* Minimum confidence, in percent, for a prediction */
+#define PREDICT_MIN_CONFIDENCE 30
+/* Maximum number of steps to follow the most likely successor */
+#define PREDICT_MAX_DEPTH 4
+
+struct successors {
+    uint64_t chunk;
+    uint64_t next[PREDICT_SUCCESSORS];
+    uint32_t count[PREDICT_SUCCESSORS];
+    uint32_t total;
+};
+
+struct predict_state {
+    GMutex *lock;
+    GHashTable *sources;    /* uint64_t -> struct successors */
+    uint64_t last;
+    bool have_last;
+    bool changed;
+};
+
+static char *get_model_file(struct vmnetfs_image *img)
+{
+    return g_strdup_printf("%s/%s", img->read_base, PREDICT_FILENAME);
+}
+
+static void successors_free(void *data)
+{
+    g_slice_free(struct successors, data);
+}
+
+/* Lock must be held.  Returns NULL if the table is full. */
+static struct successors *get_successors(struct predict_state *pred,
+        uint64_t chunk)
+{
+    struct successors *succ;
+
+    succ = g_hash_table_lookup(pred->sources, &chunk);
+    if (succ == NULL) {
+        if (g_hash_table_size(pred->sources) >= PREDICT_MAX_SOURCES) {
+            return NULL;
+        }
+        succ = g_slice_new0(struct successors);
+        succ->chunk = chunk;
+        g_hash_table_replace(pred->sources, &succ->chunk, succ);
+    }
+    return succ;
+}
+
+/* Lock must be held.  If the successor is not already tracked and
+   there is no free slot, it replaces the least frequent one, inheriting
+   its count so that a new successor is not immediately evicted again. */
+static void add_transition(struct successors *succ, uint64_t next,
+        uint32_t count)
+{
+    int victim = 0;
+    int i;
+
+    for (i = 0; i < PREDICT_SUCCESSORS; i++) {
+        if (succ->count[i] > 0 && succ->next[i] == next) {
+            victim = i;
+            break;
+        }
+        if (succ->count[i] < succ->count[victim]) {
+            victim = i;
+        }
+    }
+    if (i == PREDICT_SUCCESSORS) {
+        succ->next[victim] = next;
+    }
+    succ->count[victim] += count;
+    succ->total += count;
+    if (succ->total >= PREDICT_MAX_COUNT) {
+        succ->total = 0;
+        for (i = 0; i < PREDICT_SUCCESSORS; i++) {
+            succ->count[i] /= 2;
+            succ->total += succ->count[i];
+        }
+    }
+}
+
+static bool load_model(struct vmnetfs_image *img,
+        struct predict_state *pred, GError **err)
+{
+    struct successors *succ;
+    char *file;
+    char *data;
+    char **lines;
+    char **line;
+    char **fields;
+    uint64_t chunks;
+    uint64_t vals[3];
+    char *endptr;
+    int i;
+    bool ret = true;
+
+    file = get_model_file(img);
+    if (!g_file_test(file, G_FILE_TEST_EXISTS)) {
+        g_free(file);
+        return true;
+    }
+    if (!g_file_get_contents(file, &data, NULL, err)) {
+        g_free(file);
+        return false;
+    }
+    chunks = (img->initial_size + img->chunk_size - 1) / img->chunk_size;
+    lines = g_strsplit(data, "\n", 0);
+    for (line = lines; ret && *line != NULL; line++) {
+        if (**line == 0) {
+            continue;
+        }
+        fields = g_strsplit(*line, " ", 0);
+        for (i = 0; ret && i < 3; i++) {
+            if (fields[i] == NULL) {
+                ret = false;
+                break;
+            }
+            vals[i] = g_ascii_strtoull(fields[i], &endptr, 10);
+            if (*fields[i] == 0 || *endptr != 0) {
+                ret = false;
+            }
+        }
+        if (ret && (fields[3] != NULL || vals[0] >= chunks ||
+                vals[1] >= chunks || vals[2] == 0 ||
+                vals[2] >= PREDICT_MAX_COUNT)) {
+            ret = false;
+        }
+        g_strfreev(fields);
+        if (!ret) {
+            g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INVALID_CACHE,
+                    "Invalid transition entry in %s: %s", file, *line);
+            break;
+        }
+        succ = get_successors(pred, vals[0]);
+        if (succ != NULL) {
+            add_transition(succ, vals[1], vals[2]);
+        }
+    }
+    g_strfreev(lines);
+    g_free(data);
+    g_free(file);
+    return ret;
+}
+
+/* Failure to load the model is not fatal; we just start over. */
+void _vmnetfs_predict_init(struct vmnetfs_image *img)
+{
+    struct predict_state *pred;
+    GError *err = NULL;
+
+    if (!img->transition_model) {
+        return;
+    }
+    pred = g_slice_new0(struct predict_state);
+    pred->lock = g_mutex_new();
+    pred->sources = g_hash_table_new_full(g_int64_hash, g_int64_equal,
+            NULL, successors_free);
+    if (!load_model(img, pred, &err)) {
+        g_warning("Couldn't load transition model: %s", err->message);
+        g_clear_error(&err);
+        g_hash_table_remove_all(pred->sources);
+    }
+    img->predict = pred;
+}
+
+void _vmnetfs_predict_destroy(struct vmnetfs_image *img)
+{
+    struct predict_state *pred = img->predict;
+
+    if (pred == NULL) {
+        return;
+    }
+    g_hash_table_destroy(pred->sources);
+    g_mutex_free(pred->lock);
+    g_slice_free(struct predict_state, pred);
+    img->predict = NULL;
+}
+
+/* Lock must be held.  Returns true if the transition in slot @i is
+   likely enough to predict, given the confidence (in percent) that the
+   guest will reach the source chunk at all. */
+static bool is_likely(struct successors *succ, int i, uint32_t confidence)
+{
+    return succ->count[i] >= PREDICT_MIN_COUNT &&
+            confidence * succ->count[i] / succ->total >=
+            PREDICT_MIN_CONFIDENCE;
+}
+
+/* Lock must be held.  Returns the slot of the most frequent successor. */
+static int most_likely(struct successors *succ)
+{
+    int best = 0;
+    int i;
+
+    for (i = 1; i < PREDICT_SUCCESSORS; i++) {
+        if (succ->count[i] > succ->count[best]) {
+            best = i;
+        }
+    }
+    return best;
+}
+
+/* Called when the guest reads a chunk.  Records the transition from the
+   previously read chunk, and stores up to @max predicted upcoming chunks
+   in @predicted.  Returns the number of predictions. */
+guint _vmnetfs_predict_access(struct vmnetfs_image *img, uint64_t chunk,
+        uint64_t *predicted, guint max)
+{
+    struct predict_state *pred = img->predict;
+    struct successors *succ;
+    uint32_t confidence;
+    guint count = 0;
+    guint depth;
+    int best;
+    int i;
+
+    if (pred == NULL) {
+        return 0;
+    }
+
+    g_mutex_lock(pred->lock);
+    if (pred->have_last && pred->last == chunk) {
+        /* Another read within the same chunk */
+        g_mutex_unlock(pred->lock);
+        return 0;
+    }
+    if (pred->have_last) {
+        succ = get_successors(pred, pred->last);
+        if (succ != NULL) {
+            add_transition(succ, chunk, 1);
+            pred->changed = true;
+        }
+    }
+    pred->last = chunk;
+    pred->have_last = true;
+
+    /* Predict every likely successor */
+    succ = g_hash_table_lookup(pred->sources, &chunk);
+    if (succ == NULL || succ->total == 0) {
+        g_mutex_unlock(pred->lock);
+        return 0;
+    }
+    for (i = 0; i < PREDICT_SUCCESSORS && count < max; i++) {
+        if (is_likely(succ, i, 100)) {
+            predicted[count++] = succ->next[i];
+        }
+    }
+
+    /* Follow the most likely path a few steps further */
+    confidence = 100;
+    for (depth = 1; depth < PREDICT_MAX_DEPTH && count < max; depth++) {
+        best = most_likely(succ);
+        if (!is_likely(succ, best, confidence)) {
+            break;
+        }
+        confidence = confidence * succ->count[best] / succ->total;
+        succ = g_hash_table_lookup(pred->sources, &succ->next[best]);
+        if (succ == NULL || succ->total == 0) {
+            break;
+        }
+        best = most_likely(succ);
+        if (!is_likely(succ, best, confidence) || succ->next[best] == chunk) {
+            break;
+        }
+        predicted[count++] = succ->next[best];
+    }
+    g_mutex_unlock(pred->lock);
+    return count;
+}
+
+/* Write the updated model to the cache.  Errors are logged. */
+void _vmnetfs_predict_save(struct vmnetfs_image *img)
+{
+    struct predict_state *pred = img->predict;
+    struct successors *succ;
+    GHashTableIter iter;
+    GString *data;
+    char *file;
+    int i;
+    GError *err = NULL;
+
+    if (pred == NULL) {
+        return;
+    }
+
+    g_mutex_lock(pred->lock);
+    if (!pred->changed) {
+        /* Nothing learned; keep the existing model */
+        g_mutex_unlock(pred->lock);
+        return;
+    }
+    data = g_string_new(NULL);
+    g_hash_table_iter_init(&iter, pred->sources);
+    while (g_hash_table_iter_next(&iter, NULL, (void **) &succ)) {
+        for (i = 0; i < PREDICT_SUCCESSORS; i++) {
+            if (succ->count[i] > 0) {
+                g_string_append_printf(data, "%"PRIu64" %"PRIu64" %u\n",
+                        succ->chunk, succ->next[i],
+                        (succ->count[i] + 1) / 2);
+            }
+        }
+    }
+    g_mutex_unlock(pred->lock);
+
+    file = get_model_file(img);
+    if (!g_file_set_contents(file, data->str, data->len, &err)) {
+        g_warning("Couldn't save transition model: %s", err->message);
+        g_clear_error(&err);
+    }
+    g_free(file);
+    g_string_free(data, TRUE);
+}
@@ -0,0 +1,492 @@
+/*
+ * vmnetfs - virtual machine network execution virtual filesystem
+ *
+ * Copyright (C) 2006-2014 Carnegie Mellon University
+ *
+ * This program is free software; you can redistribute it and/or modify it
+ * under the terms of version 2 of the GNU General Public License as published
+ * by the Free Software Foundation.  A copy of the GNU General Public License
+ * should have been distributed along with this program in the file
+ * COPYING.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+ * for more details.
+ */
+
+/* Background prefetching of image chunks.
+
+   Each image with readahead enabled has a set of readahead streams, each
+   tracking one sequential or strided access pattern.  When the guest
+   reads the chunk a stream expects next, the stream's window grows
+   (doubling, up to the configured maximum) and the chunks in the window
+   are queued for a per-image prefetch thread.  The thread coalesces
+   adjacent queued chunks into a single range request, and never holds
+   chunk locks while waiting for the network, so demand readers are never
+   blocked behind readahead.
+
+   If the transition model is enabled, the chunks it predicts will follow
+   each read are queued along with readahead.
+
+   When the image has a saved access profile, the thread replays it
+   whenever the readahead queue is empty, so readahead for the guest's
+   current access pattern always takes priority.
+
+   If background fill is enabled, the thread fetches the remaining missing
+   chunks in ascending order once there is nothing else to do.  Fill only
+   runs after demand fetching has been idle for a while, and an in-flight
+   fill request is cancelled as soon as a demand fetch starts. */
+
+#include <string.h>
+#include <inttypes.h>
+#include "vmnetfs-private.h"
+
+/* Number of access patterns tracked concurrently */
+#define READAHEAD_STREAMS 8
+/* Largest stride, in chunks, that is recognized as a pattern */
+#define READAHEAD_MAX_STRIDE 8
+/* Window size, in chunks, when a pattern is first recognized */
+#define READAHEAD_INITIAL_WINDOW 2
+/* Maximum number of chunks fetched in a single request */
+#define PREFETCH_MAX_RUN 16
+/* Maximum number of chunks predicted from a single read */
+#define PREDICT_MAX_CHUNKS 8
+/* How long demand fetching must be idle before background fill runs, in
+   ms */
+#define FILL_IDLE_INTERVAL 1000
+
+struct readahead_stream {
+    uint64_t last;          /* last chunk accessed */
+    uint64_t queued_until;  /* furthest chunk queued for this stream */
+    uint64_t stride;        /* 0 if no pattern has been established */
+    uint32_t window;
+    uint64_t last_used;
+    bool valid;
+};
+
+struct prefetch_state {
+    GMutex *lock;
+    GCond *cond;
+    GQueue *queue;          /* chunks, as uint64_t */
+    GHashTable *queued;     /* uint64_t -> uint64_t in queue */
+    uint32_t max_queued;
+    uint32_t max_window;
+    struct readahead_stream streams[READAHEAD_STREAMS];
+    uint64_t clock;
+    GArray *replay;         /* access profile, or NULL */
+    guint replay_pos;
+    bool fill;
+    uint64_t fill_pos;      /* chunks before this are not missing */
+    GTimeVal last_demand;
+    gint demand_seq;        /* atomic operations only */
+    gint fill_seq;          /* private to prefetch thread */
+    GThread *thread;
+    bool stop;
+    gint cancel;  /* atomic operations only */
+};
+
+static void uint64_free(void *data)
+{
+    g_slice_free(uint64_t, data);
+}
+
+/* Whether the pristine data of a chunk is still needed.  Incomplete
+   chunks in the modified cache are merged when it arrives. */
+static bool chunk_wanted(struct vmnetfs_image *img, uint64_t chunk)
+{
+    return !_vmnetfs_bit_test(img->present_map, chunk) &&
+            (!_vmnetfs_bit_test(img->modified_map, chunk) ||
+            _vmnetfs_ll_modified_is_incomplete(img, chunk));
+}
+
+/* State lock must be held. */
+static void enqueue(struct prefetch_state *pf, struct vmnetfs_image *img,
+        uint64_t chunk)
+{
+    uint64_t *entry;
+
+    if (g_hash_table_lookup(pf->queued, &chunk) != NULL ||
+            !chunk_wanted(img, chunk)) {
+        return;
+    }
+    /* If the queue is full, the oldest entries are the least likely to
+       still be useful. */
+    while (g_queue_get_length(pf->queue) >= pf->max_queued) {
+        entry = g_queue_pop_head(pf->queue);
+        g_hash_table_remove(pf->queued, entry);
+        uint64_free(entry);
+    }
+    entry = g_slice_new(uint64_t);
+    *entry = chunk;
+    g_queue_push_tail(pf->queue, entry);
+    g_hash_table_insert(pf->queued, entry, entry);
+    g_cond_signal(pf->cond);
+}
+
+/* State lock must be held.  Returns the number of chunks in the run
+   starting with the first queued chunk, and removes them from the
+   queue. */
+static uint64_t dequeue_run(struct prefetch_state *pf, uint64_t *start)
+{
+    uint64_t *entry;
+    uint64_t next;
+    uint64_t count;
+
+    entry = g_queue_pop_head(pf->queue);
+    g_hash_table_remove(pf->queued, entry);
+    *start = *entry;
+    uint64_free(entry);
+    for (count = 1; count < PREFETCH_MAX_RUN; count++) {
+        next = *start + count;
+        entry = g_hash_table_lookup(pf->queued, &next);
+        if (entry == NULL) {
+            break;
+        }
+        g_queue_remove(pf->queue, entry);
+        g_hash_table_remove(pf->queued, entry);
+        uint64_free(entry);
+    }
+    return count;
+}
+
+/* State lock must be held.  Returns the number of chunks in the next run
+   of the access profile that has not yet been fetched, or 0 if the
+   profile is exhausted.  Runs follow the profile order, so a run only
+   extends while the profile itself is sequential. */
+static uint64_t replay_run(struct prefetch_state *pf,
+        struct vmnetfs_image *img, uint64_t *start)
+{
+    uint64_t chunk;
+    uint64_t count = 0;
+
+    while (pf->replay_pos < pf->replay->len && count < PREFETCH_MAX_RUN) {
+        chunk = g_array_index(pf->replay, uint64_t, pf->replay_pos);
+        if (count == 0) {
+            pf->replay_pos++;
+            if (chunk_wanted(img, chunk)) {
+                *start = chunk;
+                count = 1;
+            }
+        } else if (chunk == *start + count) {
+            pf->replay_pos++;
+            count++;
+        } else {
+            break;
+        }
+    }
+    return count;
+}
+
+static bool replay_pending(struct prefetch_state *pf)
+{
+    return pf->replay != NULL && pf->replay_pos < pf->replay->len;
+}
+
+/* State lock must be held.  Advances the fill position past chunks that
+   are no longer missing, and returns the number of missing chunks in the
+   run starting there.  The fill position is not advanced past the run;
+   that happens when it has been fetched. */
+static uint64_t fill_run(struct prefetch_state *pf,
+        struct vmnetfs_image *img, uint64_t *start)
+{
+    uint64_t chunks = (img->initial_size + img->chunk_size - 1) /
+            img->chunk_size;
+    uint64_t orig = pf->fill_pos;
+    uint64_t count;
+
+    while (pf->fill_pos < chunks && !chunk_wanted(img, pf->fill_pos)) {
+        pf->fill_pos++;
+    }
+    _vmnetfs_u64_stat_increment(img->fill_position, pf->fill_pos - orig);
+    *start = pf->fill_pos;
+    for (count = 0; count < PREFETCH_MAX_RUN &&
+            *start + count < chunks && chunk_wanted(img, *start + count);
+            count++) {}
+    return count;
+}
+
+static bool fill_pending(struct prefetch_state *pf,
+        struct vmnetfs_image *img)
+{
+    return pf->fill && pf->fill_pos < (img->initial_size +
+            img->chunk_size - 1) / img->chunk_size;
+}
+
+/* State lock must be held.  Returns true if demand fetching has been
+   idle long enough for background fill to run; otherwise stores the time
+   when it will have been in *deadline. */
+static bool demand_idle(struct prefetch_state *pf, GTimeVal *deadline)
+{
+    GTimeVal now;
+
+    g_get_current_time(&now);
+    *deadline = pf->last_demand;
+    g_time_val_add(deadline, FILL_IDLE_INTERVAL * 1000);
+    return now.tv_sec > deadline->tv_sec || (now.tv_sec == deadline->tv_sec &&
+            now.tv_usec >= deadline->tv_usec);
+}
+
+static bool prefetch_should_cancel(void *arg)
+{
+    struct prefetch_state *pf = arg;
+
+    return g_atomic_int_get(&pf->cancel);
+}
+
+static bool fill_should_cancel(void *arg)
+{
+    struct prefetch_state *pf = arg;
+
+    return g_atomic_int_get(&pf->cancel) ||
+            g_atomic_int_get(&pf->demand_seq) != pf->fill_seq;
+}
+
+static void *prefetch_thread(void *data)
+{
+    struct vmnetfs_image *img = data;
+    struct prefetch_state *pf = img->prefetch;
+    uint64_t start;
+    uint64_t count;
+    uint64_t fetched;
+    enum transport_class cls;
+    should_cancel_fn *should_cancel;
+    GTimeVal deadline;
+    bool interrupted;
+    GError *err = NULL;
+
+    g_mutex_lock(pf->lock);
+    while (true) {
+        while (!pf->stop && g_queue_is_empty(pf->queue) &&
+                !replay_pending(pf) && !fill_pending(pf, img)) {
+            g_cond_wait(pf->cond, pf->lock);
+        }
+        if (pf->stop) {
+            break;
+        }
+        should_cancel = prefetch_should_cancel;
+        if (!g_queue_is_empty(pf->queue)) {
+            count = dequeue_run(pf, &start);
+            cls = TRANSPORT_CLASS_READAHEAD;
+        } else if (replay_pending(pf)) {
+            count = replay_run(pf, img, &start);
+            cls = TRANSPORT_CLASS_PROFILE;
+            if (count == 0) {
+                continue;
+            }
+        } else {
+            if (!demand_idle(pf, &deadline)) {
+                g_cond_timed_wait(pf->cond, pf->lock, &deadline);
+                continue;
+            }
+            count = fill_run(pf, img, &start);
+            if (count == 0) {
+                continue;
+            }
+            cls = TRANSPORT_CLASS_FILL;
+            should_cancel = fill_should_cancel;
+            pf->fill_seq = g_atomic_int_get(&pf->demand_seq);
+        }
+        g_mutex_unlock(pf->lock);
+
+        fetched = _vmnetfs_io_prefetch(img, start, count, cls, should_cancel,
+                pf, &err);
+        interrupted = g_error_matches(err, VMNETFS_IO_ERROR,
+                VMNETFS_IO_ERROR_INTERRUPTED);
+        if (err) {
+            if (!interrupted) {
+                g_warning("Prefetch of chunks %"PRIu64"-%"PRIu64" failed: "
+                        "%s", start, start + count - 1, err->message);
+            }
+            g_clear_error(&err);
+        }
+        if (cls == TRANSPORT_CLASS_FILL) {
+            _vmnetfs_u64_stat_increment(img->chunk_fills, fetched);
+        }
+
+        g_mutex_lock(pf->lock);
+        if (cls == TRANSPORT_CLASS_FILL && !interrupted) {
+            /* On failure, leave the chunks to be fetched on demand */
+            pf->fill_pos = start + count;
+            _vmnetfs_u64_stat_increment(img->fill_position, count);
+        }
+    }
+    g_mutex_unlock(pf->lock);
+    return NULL;
+}
+
+bool _vmnetfs_prefetch_start(struct vmnetfs_image *img, GError **err)
+{
+    struct prefetch_state *pf;
+    GArray *replay;
+
+    g_assert(!img->prefetch);
+
+    replay = _vmnetfs_profile_get_replay(img);
+    if (img->readahead_chunks == 0 && (replay == NULL || replay->len == 0) &&
+            !img->background_fill && !img->transition_model) {
+        return true;
+    }
+
+    pf = g_slice_new0(struct prefetch_state);
+    pf->lock = g_mutex_new();
+    pf->cond = g_cond_new();
+    pf->queue = g_queue_new();
+    pf->queued = g_hash_table_new(g_int64_hash, g_int64_equal);
+    pf->max_window = img->readahead_chunks;
+    pf->max_queued = READAHEAD_STREAMS * img->readahead_chunks +
+            PREDICT_MAX_CHUNKS;
+    pf->replay = replay;
+    pf->fill = img->background_fill;
+    img->prefetch = pf;
+
+    pf->thread = g_thread_create(prefetch_thread, img, TRUE, err);
+    if (!pf->thread) {
+        img->prefetch = NULL;
+        g_hash_table_destroy(pf->queued);
+        g_queue_free(pf->queue);
+        g_cond_free(pf->cond);
+        g_mutex_free(pf->lock);
+        g_slice_free(struct prefetch_state, pf);
+        return false;
+    }
+    return true;
+}
+
+void _vmnetfs_prefetch_stop(struct vmnetfs_image *img)
+{
+    struct prefetch_state *pf = img->prefetch;
+
+    if (pf) {
+        g_atomic_int_set(&pf->cancel, 1);
+        g_mutex_lock(pf->lock);
+        pf->stop = true;
+        g_cond_broadcast(pf->cond);
+        g_mutex_unlock(pf->lock);
+    }
+}
+
+void _vmnetfs_prefetch_destroy(struct vmnetfs_image *img)
+{
+    struct prefetch_state *pf = img->prefetch;
+    uint64_t *entry;
+
+    if (pf == NULL) {
+        return;
+    }
+    _vmnetfs_prefetch_stop(img);
+    g_thread_join(pf->thread);
+    while ((entry = g_queue_pop_head(pf->queue)) != NULL) {
+        uint64_free(entry);
+    }
+    g_queue_free(pf->queue);
+    g_hash_table_destroy(pf->queued);
+    g_cond_free(pf->cond);
+    g_mutex_free(pf->lock);
+    g_slice_free(struct prefetch_state, pf);
+    img->prefetch = NULL;
+}
+
+/* Called before the image fetches data on demand. */
+void _vmnetfs_prefetch_demand(struct vmnetfs_image *img)
+{
+    struct prefetch_state *pf = img->prefetch;
+
+    if (pf == NULL) {
+        return;
+    }
+    g_mutex_lock(pf->lock);
+    g_get_current_time(&pf->last_demand);
+    g_atomic_int_inc(&pf->demand_seq);
+    g_mutex_unlock(pf->lock);
+}
+
+/* State lock must be held. */
+static struct readahead_stream *find_stream(struct prefetch_state *pf,
+        uint64_t chunk, bool *hit)
+{
+    struct readahead_stream *rs;
+    struct readahead_stream *victim = NULL;
+    int i;
+
+    *hit = false;
+    for (i = 0; i < READAHEAD_STREAMS; i++) {
+        rs = &pf->streams[i];
+        if (!rs->valid) {
+            if (victim == NULL || victim->valid) {
+                victim = rs;
+            }
+            continue;
+        }
+        if (chunk == rs->last) {
+            /* Another read within the same chunk */
+            return rs;
+        }
+        if (rs->stride && chunk == rs->last + rs->stride) {
+            *hit = true;
+            return rs;
+        }
+        if (victim == NULL || (victim->valid &&
+                rs->last_used < victim->last_used)) {
+            victim = rs;
+        }
+    }
+    /* Look for a new stream to establish a stride */
+    for (i = 0; i < READAHEAD_STREAMS; i++) {
+        rs = &pf->streams[i];
+        if (rs->valid && !rs->stride && chunk > rs->last &&
+                chunk - rs->last <= READAHEAD_MAX_STRIDE) {
+            rs->stride = chunk - rs->last;
+            rs->window = READAHEAD_INITIAL_WINDOW / 2;
+            rs->queued_until = chunk;
+            *hit = true;
+            return rs;
+        }
+    }
+    /* Replace the least recently used stream */
+    memset(victim, 0, sizeof(*victim));
+    victim->valid = true;
+    victim->last = chunk;
+    return victim;
+}
+
+/* Called when the guest reads a chunk. */
+void _vmnetfs_prefetch_access(struct vmnetfs_image *img, uint64_t chunk)
+{
+    struct prefetch_state *pf = img->prefetch;
+    struct readahead_stream *rs;
+    uint64_t predicted[PREDICT_MAX_CHUNKS];
+    uint64_t end;
+    uint64_t next;
+    guint npredicted;
+    guint i;
+    bool hit;
+
+    if (pf == NULL) {
+        return;
+    }
+
+    npredicted = _vmnetfs_predict_access(img, chunk, predicted,
+            G_N_ELEMENTS(predicted));
+    g_mutex_lock(pf->lock);
+    for (i = 0; i < npredicted; i++) {
+        enqueue(pf, img, predicted[i]);
+    }
+    if (pf->max_window == 0) {
+        g_mutex_unlock(pf->lock);
+        return;
+    }
+    rs = find_stream(pf, chunk, &hit);
+    rs->last_used = ++pf->clock;
+    if (hit) {
+        rs->last = chunk;
+        rs->window = CLAMP(rs->window * 2, 1, pf->max_window);
+        end = chunk + rs->stride * rs->window;
+        next = MAX(rs->queued_until, chunk) + rs->stride;
+        for (; next <= end; next += rs->stride) {
+            enqueue(pf, img, next);
+        }
+        rs->queued_until = MAX(rs->queued_until, end);
+    }
+    g_mutex_unlock(pf->lock);
+}
@@ -0,0 +1,204 @@
+/*
+ * vmnetfs - virtual machine network execution virtual filesystem
+ *
+ * Copyright (C) 2006-2014 Carnegie Mellon University
+ *
+ * This program is free software; you can redistribute it and/or modify it
+ * under the terms of version 2 of the GNU General Public License as published
+ * by the Free Software Foundation.  A copy of the GNU General Public License
+ * should have been distributed along with this program in the file
+ * COPYING.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+ * for more details.
+ */
+
+/* Access profiles.  We record the order in which the guest first accesses
+   each chunk, and save it in the pristine cache directory at the end of
+   the session.  On the next launch from the same cache, the prefetch
+   thread replays the saved profile so that chunks arrive before the
+   guest asks for them.
+
+   The saved profile starts with the chunks accessed in the most recent
+   session, followed by chunks from earlier sessions that were not
+   accessed this time, so a short session does not discard what was
+   learned from longer ones. */
+
+#include <string.h>
+#include <inttypes.h>
+#include "vmnetfs-private.h"
+
+#define PROFILE_FILENAME "profile"
+/* Maximum number of chunks in a saved profile */
+#define PROFILE_MAX_CHUNKS 32768
+
+struct profile_state {
+    GMutex *lock;
+    GArray *recorded;
+    GArray *previous;
+};
+
+static char *get_profile_file(struct vmnetfs_image *img)
+{
+    return g_strdup_printf("%s/%s", img->read_base, PROFILE_FILENAME);
+}
+
+static GArray *load_profile(struct vmnetfs_image *img, GError **err)
+{
+    GArray *profile;
+    char *file;
+    char *data;
+    char **lines;
+    char **line;
+    char *endptr;
+    uint64_t chunks;
+    uint64_t chunk;
+
+    profile = g_array_new(FALSE, FALSE, sizeof(uint64_t));
+    file = get_profile_file(img);
+    if (!g_file_test(file, G_FILE_TEST_EXISTS)) {
+        g_free(file);
+        return profile;
+    }
+    if (!g_file_get_contents(file, &data, NULL, err)) {
+        g_free(file);
+        g_array_free(profile, TRUE);
+        return NULL;
+    }
+    chunks = (img->initial_size + img->chunk_size - 1) / img->chunk_size;
+    lines = g_strsplit(data, "\n", 0);
+    for (line = lines; *line != NULL; line++) {
+        if (**line == 0) {
+            continue;
+        }
+        chunk = g_ascii_strtoull(*line, &endptr, 10);
+        if (*endptr != 0 || chunk >= chunks) {
+            g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INVALID_CACHE,
+                    "Invalid profile entry in %s: %s", file, *line);
+            g_array_free(profile, TRUE);
+            profile = NULL;
+            break;
+        }
+        g_array_append_val(profile, chunk);
+    }
+    g_strfreev(lines);
+    g_free(data);
+    g_free(file);
+    return profile;
+}
+
+/* Failure to load the profile is not fatal; we just don't replay it. */
+void _vmnetfs_profile_init(struct vmnetfs_image *img)
+{
+    struct profile_state *prof;
+    GError *err = NULL;
+
+    if (!img->access_profile) {
+        return;
+    }
+    prof = g_slice_new0(struct profile_state);
+    prof->lock = g_mutex_new();
+    prof->recorded = g_array_new(FALSE, FALSE, sizeof(uint64_t));
+    prof->previous = load_profile(img, &err);
+    if (prof->previous == NULL) {
+        g_warning("Couldn't load access profile: %s", err->message);
+        g_clear_error(&err);
+        prof->previous = g_array_new(FALSE, FALSE, sizeof(uint64_t));
+    }
+    img->profile = prof;
+}
+
+void _vmnetfs_profile_destroy(struct vmnetfs_image *img)
+{
+    struct profile_state *prof = img->profile;
+
+    if (prof == NULL) {
+        return;
+    }
+    g_array_free(prof->recorded, TRUE);
+    g_array_free(prof->previous, TRUE);
+    g_mutex_free(prof->lock);
+    g_slice_free(struct profile_state, prof);
+    img->profile = NULL;
+}
+
+/* Return the profile saved by the previous session, in access order.
+   The array remains valid until the profile is destroyed. */
+GArray *_vmnetfs_profile_get_replay(struct vmnetfs_image *img)
+{
+    if (img->profile == NULL) {
+        return NULL;
+    }
+    return img->profile->previous;
+}
+
+/* Called the first time the guest accesses a chunk. */
+void _vmnetfs_profile_record(struct vmnetfs_image *img, uint64_t chunk)
+{
+    struct profile_state *prof = img->profile;
+
+    if (prof == NULL) {
+        return;
+    }
+    g_mutex_lock(prof->lock);
+    if (prof->recorded->len < PROFILE_MAX_CHUNKS) {
+        g_array_append_val(prof->recorded, chunk);
+    }
+    g_mutex_unlock(prof->lock);
+}
+
+/* Write the merged profile to the cache.  Errors are logged. */
+void _vmnetfs_profile_save(struct vmnetfs_image *img)
+{
+    struct profile_state *prof = img->profile;
+    struct bitmap_group *mgrp;
+    struct bitmap *seen;
+    GString *data;
+    GArray *arrays[2];
+    uint64_t chunk;
+    uint64_t count = 0;
+    char *file;
+    guint i;
+    guint j;
+    GError *err = NULL;
+
+    if (prof == NULL) {
+        return;
+    }
+
+    g_mutex_lock(prof->lock);
+    if (prof->recorded->len == 0) {
+        /* Nothing learned; keep the existing profile */
+        g_mutex_unlock(prof->lock);
+        return;
+    }
+    mgrp = _vmnetfs_bit_group_new((img->initial_size + img->chunk_size - 1) /
+            img->chunk_size);
+    seen = _vmnetfs_bit_new(mgrp, false);
+    data = g_string_new(NULL);
+    arrays[0] = prof->recorded;
+    arrays[1] = prof->previous;
+    for (i = 0; i < G_N_ELEMENTS(arrays); i++) {
+        for (j = 0; j < arrays[i]->len && count < PROFILE_MAX_CHUNKS; j++) {
+            chunk = g_array_index(arrays[i], uint64_t, j);
+            if (!_vmnetfs_bit_test(seen, chunk)) {
+                _vmnetfs_bit_set(seen, chunk);
+                g_string_append_printf(data, "%"PRIu64"\n", chunk);
+                count++;
+            }
+        }
+    }
+    g_mutex_unlock(prof->lock);
+    _vmnetfs_bit_free(seen);
+    _vmnetfs_bit_group_free(mgrp);
+
+    file = get_profile_file(img);
+    if (!g_file_set_contents(file, data->str, data->len, &err)) {
+        g_warning("Couldn't save access profile: %s", err->message);
+        g_clear_error(&err);
+    }
+    g_free(file);
+    g_string_free(data, TRUE);
+}
@@ -0,0 +1,140 @@
+/*
+ * vmnetfs - virtual machine network execution virtual filesystem
+ *
+ * Copyright (C) 2006-2012 Carnegie Mellon University
+ *
+ * This program is free software; you can redistribute it and/or modify it
+ * under the terms of version 2 of the GNU General Public License as published
+ * by the Free Software Foundation.  A copy of the GNU General Public License
+ * should have been distributed along with this program in the file
+ * COPYING.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+ * for more details.
+ */
+
+/* Tests for the persistent modified cache. */
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include "vmnetfs-private.h"
+
+#define CHUNK_SIZE 4096
+#define IMAGE_SIZE (2 * CHUNK_SIZE)
+
+static struct vmnetfs_image *image_new(const char *dir)
+{
+    struct vmnetfs_image *img;
+
+    img = g_slice_new0(struct vmnetfs_image);
+    img->read_base = g_strdup(dir);
+    img->initial_size = IMAGE_SIZE;
+    img->chunk_size = CHUNK_SIZE;
+    img->persist_modified = true;
+    img->bitmaps = _vmnetfs_bit_group_new(IMAGE_SIZE / CHUNK_SIZE);
+    return img;
+}
+
+static void image_free(struct vmnetfs_image *img)
+{
+    _vmnetfs_ll_modified_destroy(img);
+    _vmnetfs_bit_group_free(img->bitmaps);
+    g_free(img->read_base);
+    g_slice_free(struct vmnetfs_image, img);
+}
+
+static void remove_dir(const char *dir)
+{
+    GDir *handle;
+    const char *name;
+    char *path;
+
+    handle = g_dir_open(dir, 0, NULL);
+    g_assert(handle != NULL);
+    while ((name = g_dir_read_name(handle)) != NULL) {
+        path = g_strdup_printf("%s/%s", dir, name);
+        g_assert(!unlink(path));
+        g_free(path);
+    }
+    g_dir_close(handle);
+    g_assert(!rmdir(dir));
+}
+
+/* A second instance sharing the cache directory must not claim, truncate,
+   or save the modified cache held by the first. */
+static void test_in_use(void)
+{
+    struct vmnetfs_image *owner;
+    struct vmnetfs_image *other;
+    struct vmnetfs_image *next;
+    uint64_t owner_size;
+    uint64_t other_size;
+    uint64_t next_size;
+    char data[CHUNK_SIZE];
+    char buf[CHUNK_SIZE];
+    char *dir;
+    GError *err = NULL;
+
+    dir = g_strdup_printf("%s/vmnetfs-test-XXXXXX", g_get_tmp_dir());
+    g_assert(mkdtemp(dir) != NULL);
+
+    owner = image_new(dir);
+    g_assert(_vmnetfs_ll_modified_init(owner, &owner_size, &err));
+    g_assert_no_error(err);
+    g_assert_cmpuint(owner->modified_persisted, ==, 1);
+    g_assert_cmpuint(owner->modified_resumed, ==, 0);
+    memset(data, 'a', sizeof(data));
+    g_assert(_vmnetfs_ll_modified_write_chunk(owner, owner_size, data, 0,
+            0, sizeof(data), &err));
+    g_assert_no_error(err);
+
+    other = image_new(dir);
+    g_assert(_vmnetfs_ll_modified_init(other, &other_size, &err));
+    g_assert_no_error(err);
+    g_assert_cmpuint(other->modified_persisted, ==, 0);
+    g_assert_cmpuint(other->modified_resumed, ==, 0);
+    g_assert(!other->persist_modified);
+    memset(data, 'b', sizeof(data));
+    g_assert(_vmnetfs_ll_modified_write_chunk(other, other_size, data, 0,
+            0, sizeof(data), &err));
+    g_assert_no_error(err);
+
+    /* The owner's changes survive the second instance */
+    g_assert(_vmnetfs_ll_modified_read_chunk(owner, owner_size, buf, 0, 0,
+            sizeof(buf), &err));
+    g_assert_no_error(err);
+    memset(data, 'a', sizeof(data));
+    g_assert(!memcmp(buf, data, sizeof(buf)));
+
+    /* Closing the second instance last doesn't replace the owner's state */
+    _vmnetfs_ll_modified_close(owner, owner_size);
+    image_free(owner);
+    _vmnetfs_ll_modified_close(other, other_size);
+    image_free(other);
+
+    next = image_new(dir);
+    g_assert(_vmnetfs_ll_modified_init(next, &next_size, &err));
+    g_assert_no_error(err);
+    g_assert_cmpuint(next->modified_persisted, ==, 1);
+    g_assert_cmpuint(next->modified_resumed, ==, 1);
+    g_assert(_vmnetfs_ll_modified_read_chunk(next, next_size, buf, 0, 0,
+            sizeof(buf), &err));
+    g_assert_no_error(err);
+    g_assert(!memcmp(buf, data, sizeof(buf)));
+    image_free(next);
+
+    remove_dir(dir);
+    g_free(dir);
+}
+
+int main(int argc, char **argv)
+{
+    g_test_init(&argc, &argv, NULL);
+    /* The in-use path is expected to warn */
+    g_log_set_always_fatal(G_LOG_LEVEL_ERROR | G_LOG_LEVEL_CRITICAL);
+    g_test_add_func("/ll-modified/in-use", test_in_use);
+    return g_test_run();
+}
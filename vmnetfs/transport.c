@@ -15,39 +15,115 @@
  * for more details.
  */
 
+/* All fetches in the process are performed by a single transport engine.
+   The engine thread drives a curl multi handle, multiplexing requests
+   over HTTP/2 connections where the server supports it.  Requesting
+   threads queue a transfer and sleep until it completes; streamed data is
+   handed back to the requesting thread, which runs the stream callback
+   itself, so slow consumers never block the engine.
+
+   Transfers are divided into classes.  Demand transfers are started as
+   soon as they are queued.  The other classes share a limited number of
+   transfer slots, and are additionally paused when they have received
+   more than their configured share of the bytes delivered to background
+   transfers.
+
+   Completed demand transfers are used to estimate the round-trip time and
+   bandwidth of each origin server, so that callers can decide how much
+   data to request at once. */
+
 #include <string.h>
 #include <inttypes.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <sys/select.h>
 #include <curl/curl.h>
 #include "vmnetfs-private.h"
 
 #define TRANSPORT_TRIES 5
 #define TRANSPORT_RETRY_DELAY 5
+/* Maximum number of simultaneous non-demand transfers */
+#define TRANSPORT_MAX_BACKGROUND 8
+/* How often a waiting requester checks whether to cancel, in ms */
+#define TRANSPORT_POLL_INTERVAL 100
+/* Longest time the engine thread sleeps without checking for work, in ms */
+#define TRANSPORT_MAX_SLEEP 100
+/* Bytes of streamed data buffered before the transfer is paused */
+#define TRANSPORT_STREAM_BUFFER (1 << 20)
+/* Bytes, scaled by share, by which a class may exceed its share before
+   it is paused */
+#define TRANSPORT_SHARE_SLACK (1 << 20)
+/* Smallest transfer, in bytes, used to estimate bandwidth */
+#define TRANSPORT_MIN_BANDWIDTH_SAMPLE (32 << 10)
+/* Weight of a new sample in the link estimates, as 1/n */
+#define TRANSPORT_ESTIMATE_WEIGHT 8
 
-struct connection_pool {
-    GQueue *conns;
+static const uint32_t default_shares[TRANSPORT_CLASS_COUNT] = {
+    [TRANSPORT_CLASS_READAHEAD] = 30,
+    [TRANSPORT_CLASS_PROFILE] = 20,
+    [TRANSPORT_CLASS_STREAM] = 50,
+    [TRANSPORT_CLASS_FILL] = 10,
+};
+
+struct transport_engine {
     GMutex *lock;
+    GMutex *share_lock;
+    CURLM *multi;
     CURLSH *share;
     char *user_agent;
+    int wake[2];
+    GThread *thread;
+    uint32_t shares[TRANSPORT_CLASS_COUNT];
+    long weights[TRANSPORT_CLASS_COUNT];
+
+    /* Protected by lock */
+    GQueue *idle;
+    GQueue *queued[TRANSPORT_CLASS_COUNT];
+    GHashTable *links;  /* origin -> struct link_estimate */
+    bool stop;
+
+    /* Private to engine thread */
+    GList *active;
+    uint32_t nactive[TRANSPORT_CLASS_COUNT];
+    uint32_t background_active;
+    uint64_t vtime[TRANSPORT_CLASS_COUNT];
 };
 
 struct connection {
-    struct connection_pool *pool;
+    struct transport_engine *eng;
     CURL *curl;
     char errbuf[CURL_ERROR_SIZE];
+    GCond *cond;
+    enum transport_class cls;
     GError *err;
     char *buf;
-    stream_fn *callback;
-    void *arg;
     uint64_t offset;
     uint64_t length;
     const char *expected_etag;
     time_t expected_last_modified;
     char *etag;
-    should_cancel_fn *should_cancel;
-    void *should_cancel_arg;
+
+    /* Protected by engine lock */
+    GQueue *pending;  /* GByteArray, when streaming */
+    uint64_t pending_bytes;
+    bool streaming;
+    bool cancel;
+    bool done;
+    CURLcode result;
+
+    /* Private to engine thread */
+    bool share_paused;
+    bool flow_paused;
+    bool paused;
 };
 
+struct link_estimate {
+    uint64_t rtt;        /* usec */
+    uint64_t bandwidth;  /* bytes/sec; 0 if unknown */
+};
+
+static struct transport_engine *engine;
+
 static size_t header_callback(void *data, size_t size, size_t nmemb,
         void *private)
 {
@@ -110,11 +186,51 @@ static bool check_validators(struct connection *conn, GError **err)
     return true;
 }
 
+/* Engine thread only.  Returns the lowest virtual time of any background
+   class that is currently able to receive data. */
+static uint64_t min_active_vtime(struct transport_engine *eng,
+        enum transport_class cls)
+{
+    struct connection *conn;
+    GList *cur;
+    uint64_t min = eng->vtime[cls];
+
+    for (cur = eng->active; cur != NULL; cur = cur->next) {
+        conn = cur->data;
+        if (conn->cls != TRANSPORT_CLASS_DEMAND && !conn->flow_paused) {
+            min = MIN(min, eng->vtime[conn->cls]);
+        }
+    }
+    return min;
+}
+
+/* Engine thread only. */
+static bool share_exceeded(struct transport_engine *eng,
+        enum transport_class cls)
+{
+    if (cls == TRANSPORT_CLASS_DEMAND) {
+        return false;
+    }
+    return eng->vtime[cls] > min_active_vtime(eng, cls) +
+            TRANSPORT_SHARE_SLACK;
+}
+
+static void wake_engine(struct transport_engine *eng)
+{
+    char c = 0;
+
+    if (write(eng->wake[1], &c, 1) == -1) {
+        /* Pipe is full, so the engine will wake anyway */
+    }
+}
+
 static size_t write_callback(void *data, size_t size, size_t nmemb,
         void *private)
 {
     struct connection *conn = private;
+    struct transport_engine *eng = conn->eng;
     uint64_t count = MIN(size * nmemb, conn->length - conn->offset);
+    GByteArray *arr;
 
     g_return_val_if_fail(conn->err == NULL, 0);
 
@@ -125,28 +241,33 @@ static size_t write_callback(void *data, size_t size, size_t nmemb,
         }
     }
 
-    if (conn->callback) {
-        if (!conn->callback(conn->arg, data, count, &conn->err)) {
-            return 0;
+    if (share_exceeded(eng, conn->cls)) {
+        conn->share_paused = true;
+        conn->paused = true;
+        return CURL_WRITEFUNC_PAUSE;
+    }
+    if (conn->streaming) {
+        g_mutex_lock(eng->lock);
+        if (conn->pending_bytes >= TRANSPORT_STREAM_BUFFER) {
+            g_mutex_unlock(eng->lock);
+            conn->flow_paused = true;
+            conn->paused = true;
+            return CURL_WRITEFUNC_PAUSE;
         }
+        arr = g_byte_array_sized_new(count);
+        g_byte_array_append(arr, data, count);
+        g_queue_push_tail(conn->pending, arr);
+        conn->pending_bytes += count;
+        g_cond_broadcast(conn->cond);
+        g_mutex_unlock(eng->lock);
     } else {
         memcpy(conn->buf + conn->offset, data, count);
     }
     conn->offset += count;
-    return count;
-}
-
-static int progress_callback(void *private,
-        double dltotal G_GNUC_UNUSED, double dlnow G_GNUC_UNUSED,
-        double ultotal G_GNUC_UNUSED, double ulnow G_GNUC_UNUSED)
-{
-    struct connection *conn = private;
-    bool cancel = false;
-
-    if (conn->should_cancel) {
-        cancel = conn->should_cancel(conn->should_cancel_arg);
+    if (conn->cls != TRANSPORT_CLASS_DEMAND) {
+        eng->vtime[conn->cls] += count * 100 / eng->shares[conn->cls];
     }
-    return cancel;
+    return count;
 }
 
 static void conn_free(struct connection *conn)
@@ -155,16 +276,20 @@ static void conn_free(struct connection *conn)
     if (conn->curl) {
         curl_easy_cleanup(conn->curl);
     }
+    g_queue_free(conn->pending);
+    g_cond_free(conn->cond);
     g_slice_free(struct connection, conn);
 }
 
-static struct connection *conn_new(struct connection_pool *pool,
+static struct connection *conn_new(struct transport_engine *eng,
         GError **err)
 {
     struct connection *conn;
 
     conn = g_slice_new0(struct connection);
-    conn->pool = pool;
+    conn->eng = eng;
+    conn->cond = g_cond_new();
+    conn->pending = g_queue_new();
     conn->curl = curl_easy_init();
     if (conn->curl == NULL) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
@@ -172,10 +297,10 @@ static struct connection *conn_new(struct connection_pool *pool,
                 "Couldn't initialize CURL handle");
         goto bad;
     }
-    if (curl_easy_setopt(conn->curl, CURLOPT_NOPROGRESS, 0)) {
+    if (curl_easy_setopt(conn->curl, CURLOPT_PRIVATE, conn)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
-                "Couldn't enable curl progress meter");
+                "Couldn't set CURL handle private data");
         goto bad;
     }
     if (curl_easy_setopt(conn->curl, CURLOPT_NOSIGNAL, 1)) {
@@ -184,7 +309,7 @@ static struct connection *conn_new(struct connection_pool *pool,
                 "Couldn't disable signals");
         goto bad;
     }
-    if (curl_easy_setopt(conn->curl, CURLOPT_SHARE, pool->share)) {
+    if (curl_easy_setopt(conn->curl, CURLOPT_SHARE, eng->share)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
                 "Couldn't set share handle");
@@ -196,7 +321,7 @@ static struct connection *conn_new(struct connection_pool *pool,
                 "Couldn't enable file timestamps");
         goto bad;
     }
-    if (curl_easy_setopt(conn->curl, CURLOPT_USERAGENT, pool->user_agent)) {
+    if (curl_easy_setopt(conn->curl, CURLOPT_USERAGENT, eng->user_agent)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
                 "Couldn't set user agent string");
@@ -234,19 +359,6 @@ static struct connection *conn_new(struct connection_pool *pool,
                 "Couldn't set write callback data");
         goto bad;
     }
-    if (curl_easy_setopt(conn->curl, CURLOPT_PROGRESSFUNCTION,
-            progress_callback)) {
-        g_set_error(err, VMNETFS_TRANSPORT_ERROR,
-                VMNETFS_TRANSPORT_ERROR_FATAL,
-                "Couldn't set progress callback");
-        goto bad;
-    }
-    if (curl_easy_setopt(conn->curl, CURLOPT_PROGRESSDATA, conn)) {
-        g_set_error(err, VMNETFS_TRANSPORT_ERROR,
-                VMNETFS_TRANSPORT_ERROR_FATAL,
-                "Couldn't set progress data");
-        goto bad;
-    }
     if (curl_easy_setopt(conn->curl, CURLOPT_ERRORBUFFER, conn->errbuf)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
@@ -259,6 +371,16 @@ static struct connection *conn_new(struct connection_pool *pool,
                 "Couldn't set fail-on-error flag");
         goto bad;
     }
+#if LIBCURL_VERSION_NUM >= 0x072f00
+    /* Not supported by every libcurl build, so ignore failures */
+    curl_easy_setopt(conn->curl, CURLOPT_HTTP_VERSION,
+            (long) CURL_HTTP_VERSION_2TLS);
+#endif
+#if LIBCURL_VERSION_NUM >= 0x072b00
+    /* Prefer multiplexing over an existing connection to opening a new
+       one */
+    curl_easy_setopt(conn->curl, CURLOPT_PIPEWAIT, 1L);
+#endif
     return conn;
 
 bad:
@@ -266,44 +388,271 @@ bad:
     return NULL;
 }
 
-static struct connection *conn_get(struct connection_pool *cpool,
+static struct connection *conn_get(struct transport_engine *eng,
         GError **err)
 {
     struct connection *conn;
 
-    g_mutex_lock(cpool->lock);
-    conn = g_queue_pop_head(cpool->conns);
-    g_mutex_unlock(cpool->lock);
+    g_mutex_lock(eng->lock);
+    conn = g_queue_pop_head(eng->idle);
+    g_mutex_unlock(eng->lock);
     if (conn == NULL) {
-        conn = conn_new(cpool, err);
+        conn = conn_new(eng, err);
     }
     return conn;
 }
 
 static void conn_put(struct connection *conn)
 {
+    struct transport_engine *eng = conn->eng;
+    GByteArray *arr;
+
     g_free(conn->etag);
     conn->etag = NULL;
-    g_mutex_lock(conn->pool->lock);
-    g_queue_push_head(conn->pool->conns, conn);
-    g_mutex_unlock(conn->pool->lock);
+    g_mutex_lock(eng->lock);
+    while ((arr = g_queue_pop_head(conn->pending)) != NULL) {
+        g_byte_array_free(arr, TRUE);
+    }
+    conn->pending_bytes = 0;
+    g_queue_push_head(eng->idle, conn);
+    g_mutex_unlock(eng->lock);
+}
+
+/* Engine lock must be held. */
+static void complete_locked(struct connection *conn, CURLcode result)
+{
+    conn->result = result;
+    conn->done = true;
+    g_cond_broadcast(conn->cond);
+}
+
+static void complete(struct connection *conn, CURLcode result)
+{
+    g_mutex_lock(conn->eng->lock);
+    complete_locked(conn, result);
+    g_mutex_unlock(conn->eng->lock);
+}
+
+/* Engine lock must be held.  Returns the background class with queued
+   transfers that has received the least data relative to its share, or
+   TRANSPORT_CLASS_DEMAND if there is none. */
+static enum transport_class next_background_class(
+        struct transport_engine *eng)
+{
+    enum transport_class best = TRANSPORT_CLASS_DEMAND;
+    int cls;
+
+    for (cls = 0; cls < TRANSPORT_CLASS_COUNT; cls++) {
+        if (cls == TRANSPORT_CLASS_DEMAND ||
+                g_queue_is_empty(eng->queued[cls])) {
+            continue;
+        }
+        if (best == TRANSPORT_CLASS_DEMAND ||
+                eng->vtime[cls] < eng->vtime[best]) {
+            best = cls;
+        }
+    }
+    return best;
+}
+
+/* Engine thread only. */
+static void start_transfer(struct transport_engine *eng,
+        struct connection *conn)
+{
+    CURLMcode code;
+
+    if (conn->cls != TRANSPORT_CLASS_DEMAND) {
+        if (eng->nactive[conn->cls] == 0) {
+            /* Don't let a class that has been idle claim the bandwidth
+               it didn't use */
+            eng->vtime[conn->cls] = MAX(eng->vtime[conn->cls],
+                    min_active_vtime(eng, conn->cls));
+        }
+        eng->background_active++;
+    }
+    eng->nactive[conn->cls]++;
+    conn->share_paused = false;
+    conn->flow_paused = false;
+    conn->paused = false;
+#if LIBCURL_VERSION_NUM >= 0x072e00
+    curl_easy_setopt(conn->curl, CURLOPT_STREAM_WEIGHT,
+            eng->weights[conn->cls]);
+#endif
+    code = curl_multi_add_handle(eng->multi, conn->curl);
+    if (code) {
+        g_set_error(&conn->err, VMNETFS_TRANSPORT_ERROR,
+                VMNETFS_TRANSPORT_ERROR_FATAL,
+                "Couldn't start transfer: %s", curl_multi_strerror(code));
+        eng->nactive[conn->cls]--;
+        if (conn->cls != TRANSPORT_CLASS_DEMAND) {
+            eng->background_active--;
+        }
+        complete(conn, CURLE_FAILED_INIT);
+        return;
+    }
+    eng->active = g_list_prepend(eng->active, conn);
+}
+
+/* Engine thread only. */
+static void finish_transfer(struct transport_engine *eng,
+        struct connection *conn, CURLcode result)
+{
+    curl_multi_remove_handle(eng->multi, conn->curl);
+    eng->active = g_list_remove(eng->active, conn);
+    eng->nactive[conn->cls]--;
+    if (conn->cls != TRANSPORT_CLASS_DEMAND) {
+        eng->background_active--;
+    }
+    complete(conn, result);
+}
+
+/* Engine thread only.  Handle cancellations, start queued transfers, and
+   pause or resume active ones. */
+static void schedule(struct transport_engine *eng)
+{
+    struct connection *conn;
+    GList *cancelled = NULL;
+    GList *started = NULL;
+    GList *cur;
+    GList *next;
+    uint32_t background = eng->background_active;
+    int cls;
+
+    g_mutex_lock(eng->lock);
+    for (cls = 0; cls < TRANSPORT_CLASS_COUNT; cls++) {
+        for (cur = eng->queued[cls]->head; cur != NULL; cur = next) {
+            next = cur->next;
+            conn = cur->data;
+            if (conn->cancel) {
+                g_queue_delete_link(eng->queued[cls], cur);
+                complete_locked(conn, CURLE_ABORTED_BY_CALLBACK);
+            }
+        }
+    }
+    for (cur = eng->active; cur != NULL; cur = cur->next) {
+        conn = cur->data;
+        if (conn->cancel) {
+            cancelled = g_list_prepend(cancelled, conn);
+        }
+        if (conn->flow_paused &&
+                conn->pending_bytes < TRANSPORT_STREAM_BUFFER) {
+            conn->flow_paused = false;
+        }
+    }
+    /* Demand transfers never wait */
+    while ((conn = g_queue_pop_head(eng->queued[TRANSPORT_CLASS_DEMAND]))
+            != NULL) {
+        started = g_list_prepend(started, conn);
+    }
+    while (background < TRANSPORT_MAX_BACKGROUND &&
+            (cls = next_background_class(eng)) != TRANSPORT_CLASS_DEMAND) {
+        started = g_list_prepend(started,
+                g_queue_pop_head(eng->queued[cls]));
+        background++;
+    }
+    g_mutex_unlock(eng->lock);
+
+    /* libcurl may call our callbacks from these functions, so the engine
+       lock must not be held */
+    for (cur = cancelled; cur != NULL; cur = cur->next) {
+        finish_transfer(eng, cur->data, CURLE_ABORTED_BY_CALLBACK);
+    }
+    g_list_free(cancelled);
+    for (cur = g_list_last(started); cur != NULL; cur = cur->prev) {
+        start_transfer(eng, cur->data);
+    }
+    g_list_free(started);
+    for (cur = eng->active; cur != NULL; cur = cur->next) {
+        conn = cur->data;
+        if (conn->share_paused && !share_exceeded(eng, conn->cls)) {
+            conn->share_paused = false;
+        }
+        if (conn->paused && !conn->share_paused && !conn->flow_paused) {
+            /* May call the write callback, which may pause again */
+            conn->paused = false;
+            curl_easy_pause(conn->curl, CURLPAUSE_CONT);
+        }
+    }
+}
+
+/* Engine thread only. */
+static void reap(struct transport_engine *eng)
+{
+    struct connection *conn;
+    CURLMsg *msg;
+    int remaining;
+
+    while ((msg = curl_multi_info_read(eng->multi, &remaining)) != NULL) {
+        if (msg->msg != CURLMSG_DONE) {
+            continue;
+        }
+        curl_easy_getinfo(msg->easy_handle, CURLINFO_PRIVATE, &conn);
+        finish_transfer(eng, conn, msg->data.result);
+    }
+}
+
+/* Engine thread only. */
+static void wait_for_activity(struct transport_engine *eng)
+{
+    fd_set rfds;
+    fd_set wfds;
+    fd_set efds;
+    int maxfd = -1;
+    long timeout;
+    struct timeval tv;
+    char buf[64];
+
+    FD_ZERO(&rfds);
+    FD_ZERO(&wfds);
+    FD_ZERO(&efds);
+    curl_multi_fdset(eng->multi, &rfds, &wfds, &efds, &maxfd);
+    FD_SET(eng->wake[0], &rfds);
+    maxfd = MAX(maxfd, eng->wake[0]);
+    if (curl_multi_timeout(eng->multi, &timeout) || timeout < 0 ||
+            timeout > TRANSPORT_MAX_SLEEP) {
+        timeout = TRANSPORT_MAX_SLEEP;
+    }
+    tv.tv_sec = timeout / 1000;
+    tv.tv_usec = (timeout % 1000) * 1000;
+    if (select(maxfd + 1, &rfds, &wfds, &efds, &tv) > 0 &&
+            FD_ISSET(eng->wake[0], &rfds)) {
+        while (read(eng->wake[0], buf, sizeof(buf)) > 0) {}
+    }
+}
+
+static void *engine_thread(void *data)
+{
+    struct transport_engine *eng = data;
+    int running;
+
+    g_mutex_lock(eng->lock);
+    while (!eng->stop) {
+        g_mutex_unlock(eng->lock);
+        schedule(eng);
+        curl_multi_perform(eng->multi, &running);
+        reap(eng);
+        wait_for_activity(eng);
+        g_mutex_lock(eng->lock);
+    }
+    g_mutex_unlock(eng->lock);
+    return NULL;
 }
 
 static void lock_callback(CURL *handle G_GNUC_UNUSED,
         curl_lock_data data G_GNUC_UNUSED,
         curl_lock_access access G_GNUC_UNUSED, void *private)
 {
-    struct connection_pool *cpool = private;
+    struct transport_engine *eng = private;
 
-    g_mutex_lock(cpool->lock);
+    g_mutex_lock(eng->share_lock);
 }
 
 static void unlock_callback(CURL *handle G_GNUC_UNUSED,
         curl_lock_data data G_GNUC_UNUSED, void *private)
 {
-    struct connection_pool *cpool = private;
+    struct transport_engine *eng = private;
 
-    g_mutex_unlock(cpool->lock);
+    g_mutex_unlock(eng->share_lock);
 }
 
 bool _vmnetfs_transport_init(void)
@@ -314,50 +663,131 @@ bool _vmnetfs_transport_init(void)
     return true;
 }
 
-struct connection_pool *_vmnetfs_transport_pool_new(GError **err)
+static void link_estimate_free(void *data)
+{
+    g_slice_free(struct link_estimate, data);
+}
+
+static void engine_free(struct transport_engine *eng)
+{
+    struct connection *conn;
+    int cls;
+
+    while ((conn = g_queue_pop_head(eng->idle)) != NULL) {
+        conn_free(conn);
+    }
+    g_queue_free(eng->idle);
+    g_hash_table_destroy(eng->links);
+    for (cls = 0; cls < TRANSPORT_CLASS_COUNT; cls++) {
+        g_queue_free(eng->queued[cls]);
+    }
+    if (eng->multi) {
+        curl_multi_cleanup(eng->multi);
+    }
+    if (eng->share) {
+        curl_share_cleanup(eng->share);
+    }
+    if (eng->wake[0] != -1) {
+        close(eng->wake[0]);
+        close(eng->wake[1]);
+    }
+    g_free(eng->user_agent);
+    g_mutex_free(eng->share_lock);
+    g_mutex_free(eng->lock);
+    g_slice_free(struct transport_engine, eng);
+}
+
+/* Start the transport engine shared by all images.  @shares gives the
+   relative bandwidth share of each non-demand class; zero selects the
+   default. */
+bool _vmnetfs_transport_start(const uint32_t *shares, GError **err)
 {
-    struct connection_pool *cpool;
+    struct transport_engine *eng;
+    uint32_t total = 0;
+    int cls;
+
+    g_assert(engine == NULL);
 
-    cpool = g_slice_new0(struct connection_pool);
-    cpool->conns = g_queue_new();
-    cpool->lock = g_mutex_new();
-    cpool->share = curl_share_init();
-    cpool->user_agent = g_strdup_printf("vmnetfs/" PACKAGE_VERSION " %s",
+    eng = g_slice_new0(struct transport_engine);
+    eng->lock = g_mutex_new();
+    eng->share_lock = g_mutex_new();
+    eng->idle = g_queue_new();
+    eng->links = g_hash_table_new_full(g_str_hash, g_str_equal, g_free,
+            link_estimate_free);
+    for (cls = 0; cls < TRANSPORT_CLASS_COUNT; cls++) {
+        eng->queued[cls] = g_queue_new();
+        if (cls != TRANSPORT_CLASS_DEMAND) {
+            eng->shares[cls] = shares[cls] ?: default_shares[cls];
+            total += eng->shares[cls];
+        }
+    }
+    /* HTTP/2 stream weights range from 1 to 256; demand gets the most */
+    eng->weights[TRANSPORT_CLASS_DEMAND] = 256;
+    for (cls = 0; cls < TRANSPORT_CLASS_COUNT; cls++) {
+        if (cls != TRANSPORT_CLASS_DEMAND) {
+            eng->weights[cls] = 1 + eng->shares[cls] * 127 / total;
+        }
+    }
+    eng->wake[0] = eng->wake[1] = -1;
+    eng->user_agent = g_strdup_printf("vmnetfs/" PACKAGE_VERSION " %s",
             curl_version());
 
-    if (cpool->share == NULL) {
+    if (pipe(eng->wake)) {
+        eng->wake[0] = eng->wake[1] = -1;
+        g_set_error(err, VMNETFS_TRANSPORT_ERROR,
+                VMNETFS_TRANSPORT_ERROR_FATAL,
+                "Couldn't create wakeup pipe");
+        goto bad;
+    }
+    fcntl(eng->wake[0], F_SETFL, O_NONBLOCK);
+    fcntl(eng->wake[1], F_SETFL, O_NONBLOCK);
+
+    eng->multi = curl_multi_init();
+    if (eng->multi == NULL) {
+        g_set_error(err, VMNETFS_TRANSPORT_ERROR,
+                VMNETFS_TRANSPORT_ERROR_FATAL,
+                "Couldn't initialize multi handle");
+        goto bad;
+    }
+#ifdef CURLPIPE_MULTIPLEX
+    /* Not supported by every libcurl build, so ignore failures */
+    curl_multi_setopt(eng->multi, CURLMOPT_PIPELINING, CURLPIPE_MULTIPLEX);
+#endif
+
+    eng->share = curl_share_init();
+    if (eng->share == NULL) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
                 "Couldn't initialize share handle");
         goto bad;
     }
-    if (curl_share_setopt(cpool->share, CURLSHOPT_USERDATA, cpool)) {
+    if (curl_share_setopt(eng->share, CURLSHOPT_USERDATA, eng)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
                 "Couldn't set share handle private data");
         goto bad;
     }
-    if (curl_share_setopt(cpool->share, CURLSHOPT_LOCKFUNC, lock_callback)) {
+    if (curl_share_setopt(eng->share, CURLSHOPT_LOCKFUNC, lock_callback)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
                 "Couldn't set lock callback");
         goto bad;
     }
-    if (curl_share_setopt(cpool->share, CURLSHOPT_UNLOCKFUNC,
+    if (curl_share_setopt(eng->share, CURLSHOPT_UNLOCKFUNC,
             unlock_callback)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
                 "Couldn't set unlock callback");
         goto bad;
     }
-    if (curl_share_setopt(cpool->share, CURLSHOPT_SHARE,
+    if (curl_share_setopt(eng->share, CURLSHOPT_SHARE,
             CURL_LOCK_DATA_COOKIE)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
                 "Couldn't enable cookie sharing");
         goto bad;
     }
-    if (curl_share_setopt(cpool->share, CURLSHOPT_SHARE,
+    if (curl_share_setopt(eng->share, CURLSHOPT_SHARE,
             CURL_LOCK_DATA_DNS)) {
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
@@ -365,45 +795,47 @@ struct connection_pool *_vmnetfs_transport_pool_new(GError **err)
         goto bad;
     }
     /* Not supported on RHEL 6, so ignore failures */
-    curl_share_setopt(cpool->share, CURLSHOPT_SHARE,
+    curl_share_setopt(eng->share, CURLSHOPT_SHARE,
             CURL_LOCK_DATA_SSL_SESSION);
 
-    return cpool;
+    eng->thread = g_thread_create(engine_thread, eng, TRUE, err);
+    if (eng->thread == NULL) {
+        goto bad;
+    }
+    engine = eng;
+    return true;
 
 bad:
-    g_free(cpool->user_agent);
-    if (cpool->share) {
-        curl_share_cleanup(cpool->share);
-    }
-    g_queue_free(cpool->conns);
-    g_mutex_free(cpool->lock);
-    g_slice_free(struct connection_pool, cpool);
-    return NULL;
+    engine_free(eng);
+    return false;
 }
 
-void _vmnetfs_transport_pool_free(struct connection_pool *cpool)
+/* All transfers must have completed. */
+void _vmnetfs_transport_stop(void)
 {
-    struct connection *conn;
+    struct transport_engine *eng = engine;
 
-    while ((conn = g_queue_pop_head(cpool->conns)) != NULL) {
-        conn_free(conn);
+    if (eng == NULL) {
+        return;
     }
-    g_queue_free(cpool->conns);
-    curl_share_cleanup(cpool->share);
-    g_mutex_free(cpool->lock);
-    g_free(cpool->user_agent);
-    g_slice_free(struct connection_pool, cpool);
+    g_mutex_lock(eng->lock);
+    eng->stop = true;
+    g_mutex_unlock(eng->lock);
+    wake_engine(eng);
+    g_thread_join(eng->thread);
+    g_assert(eng->active == NULL);
+    engine_free(eng);
+    engine = NULL;
 }
 
 /* This is not safe if any connections may be active, curl #1215 */
-bool _vmnetfs_transport_pool_set_cookie(struct connection_pool *cpool,
-        const char *cookie, GError **err)
+bool _vmnetfs_transport_set_cookie(const char *cookie, GError **err)
 {
     struct connection *conn;
     char *str;
     bool ret = true;
 
-    conn = conn_get(cpool, err);
+    conn = conn_get(engine, err);
     if (conn == NULL) {
         return false;
     }
@@ -419,20 +851,169 @@ bool _vmnetfs_transport_pool_set_cookie(struct connection_pool *cpool,
     return ret;
 }
 
+/* Engine lock must be held. */
+static void cancel_locked(struct connection *conn)
+{
+    if (!conn->cancel) {
+        conn->cancel = true;
+        wake_engine(conn->eng);
+    }
+}
+
+/* Wait for the transfer to complete, passing streamed data to @callback
+   and cancelling the transfer if @should_cancel returns true. */
+static void wait_for_transfer(struct connection *conn, stream_fn *callback,
+        void *arg, should_cancel_fn *should_cancel, void *should_cancel_arg,
+        GError **err)
+{
+    struct transport_engine *eng = conn->eng;
+    GByteArray *arr;
+    GTimeVal timeout;
+    bool cancel;
+
+    g_mutex_lock(eng->lock);
+    while (true) {
+        arr = g_queue_pop_head(conn->pending);
+        if (arr != NULL) {
+            if (conn->pending_bytes >= TRANSPORT_STREAM_BUFFER &&
+                    conn->pending_bytes - arr->len <
+                    TRANSPORT_STREAM_BUFFER) {
+                /* The engine may have paused the transfer */
+                wake_engine(eng);
+            }
+            conn->pending_bytes -= arr->len;
+            g_mutex_unlock(eng->lock);
+            if ((err == NULL || *err == NULL) &&
+                    !callback(arg, arr->data, arr->len, err)) {
+                g_mutex_lock(eng->lock);
+                cancel_locked(conn);
+                g_mutex_unlock(eng->lock);
+            }
+            g_byte_array_free(arr, TRUE);
+            g_mutex_lock(eng->lock);
+            continue;
+        }
+        if (conn->done) {
+            break;
+        }
+        if (!conn->cancel && should_cancel) {
+            g_mutex_unlock(eng->lock);
+            cancel = should_cancel(should_cancel_arg);
+            g_mutex_lock(eng->lock);
+            if (cancel) {
+                cancel_locked(conn);
+                continue;
+            }
+        }
+        g_get_current_time(&timeout);
+        g_time_val_add(&timeout, TRANSPORT_POLL_INTERVAL * 1000);
+        g_cond_timed_wait(conn->cond, eng->lock, &timeout);
+    }
+    g_mutex_unlock(eng->lock);
+}
+
+/* Returns the scheme, host, and port portion of the URL. */
+static char *get_origin(const char *url)
+{
+    const char *host;
+    const char *end;
+
+    host = strstr(url, "://");
+    host = host ? host + 3 : url;
+    end = strchr(host, '/');
+    return end ? g_strndup(url, end - url) : g_strdup(url);
+}
+
+static uint64_t update_estimate(uint64_t old, uint64_t sample)
+{
+    if (old == 0) {
+        return sample;
+    }
+    return old - old / TRANSPORT_ESTIMATE_WEIGHT +
+            sample / TRANSPORT_ESTIMATE_WEIGHT;
+}
+
+/* Update the link estimates for the origin of @url from a successful
+   transfer.  The round-trip time is taken to be the delay between sending
+   the request and receiving the first byte of the response, which is the
+   fixed cost of each request. */
+static void record_link_sample(struct transport_engine *eng,
+        struct connection *conn, const char *url)
+{
+    struct link_estimate *link;
+    double pretransfer;
+    double starttransfer;
+    double total;
+    double size;
+    char *origin;
+
+    if (curl_easy_getinfo(conn->curl, CURLINFO_PRETRANSFER_TIME,
+            &pretransfer) ||
+            curl_easy_getinfo(conn->curl, CURLINFO_STARTTRANSFER_TIME,
+            &starttransfer) ||
+            curl_easy_getinfo(conn->curl, CURLINFO_TOTAL_TIME, &total) ||
+            curl_easy_getinfo(conn->curl, CURLINFO_SIZE_DOWNLOAD, &size)) {
+        return;
+    }
+    if (starttransfer < pretransfer) {
+        return;
+    }
+
+    origin = get_origin(url);
+    g_mutex_lock(eng->lock);
+    link = g_hash_table_lookup(eng->links, origin);
+    if (link == NULL) {
+        link = g_slice_new0(struct link_estimate);
+        g_hash_table_replace(eng->links, origin, link);
+    } else {
+        g_free(origin);
+    }
+    link->rtt = update_estimate(link->rtt,
+            MAX((starttransfer - pretransfer) * G_USEC_PER_SEC, 1));
+    if (size >= TRANSPORT_MIN_BANDWIDTH_SAMPLE && total > starttransfer) {
+        link->bandwidth = update_estimate(link->bandwidth,
+                MAX(size / (total - starttransfer), 1));
+    }
+    g_mutex_unlock(eng->lock);
+}
+
+/* Returns the estimated bandwidth-delay product, in bytes, of the path to
+   the origin server of @url: the amount of additional data that can be
+   received in the time needed to issue one more request.  Returns 0 if
+   nothing is known about the origin yet. */
+uint64_t _vmnetfs_transport_estimate_bdp(const char *url)
+{
+    struct transport_engine *eng = engine;
+    struct link_estimate *link;
+    char *origin;
+    uint64_t ret = 0;
+
+    origin = get_origin(url);
+    g_mutex_lock(eng->lock);
+    link = g_hash_table_lookup(eng->links, origin);
+    if (link != NULL) {
+        ret = link->bandwidth * link->rtt / G_USEC_PER_SEC;
+    }
+    g_mutex_unlock(eng->lock);
+    g_free(origin);
+    return ret;
+}
+
 /* Make one attempt to fetch the specified byte range from the URL. */
-static bool fetch(struct connection_pool *cpool, const char *url,
+static bool fetch(enum transport_class cls, const char *url,
         const char *username, const char *password, const char *etag,
         time_t last_modified, void *buf, stream_fn *callback, void *arg,
         uint64_t offset, uint64_t length,
         should_cancel_fn *should_cancel, void *should_cancel_arg,
         GError **err)
 {
+    struct transport_engine *eng = engine;
     struct connection *conn;
     char *range;
     bool ret = false;
-    CURLcode code;
+    GError *my_err = NULL;
 
-    conn = conn_get(cpool, err);
+    conn = conn_get(eng, err);
     if (conn == NULL) {
         return false;
     }
@@ -463,37 +1044,52 @@ static bool fetch(struct connection_pool *cpool, const char *url,
         goto out;
     }
     g_free(range);
-    if (buf) {
-        conn->buf = buf;
-        conn->callback = NULL;
-    } else {
-        conn->buf = NULL;
-        conn->callback = callback;
-        conn->arg = arg;
-    }
+    conn->cls = cls;
+    conn->buf = buf;
+    conn->streaming = (buf == NULL);
     conn->offset = 0;
     conn->length = length;
     conn->expected_etag = etag;
     conn->expected_last_modified = last_modified;
-    conn->should_cancel = should_cancel;
-    conn->should_cancel_arg = should_cancel_arg;
+    conn->cancel = false;
+    conn->done = false;
     g_assert(conn->err == NULL);
 
-    code = curl_easy_perform(conn->curl);
+    /* Submit and wait */
+    g_mutex_lock(eng->lock);
+    g_queue_push_tail(eng->queued[cls], conn);
+    g_mutex_unlock(eng->lock);
+    wake_engine(eng);
+    wait_for_transfer(conn, callback, arg, should_cancel, should_cancel_arg,
+            &my_err);
+
+    if (my_err) {
+        /* Stream callback failed */
+        g_propagate_error(err, my_err);
+        g_clear_error(&conn->err);
+        goto out;
+    }
     if (conn->err) {
         g_propagate_error(err, conn->err);
         conn->err = NULL;
         goto out;
     }
-    switch (code) {
+    switch (conn->result) {
     case CURLE_OK:
         if (conn->offset != length) {
             g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                     VMNETFS_TRANSPORT_ERROR_FATAL,
                     "short read from server: %"PRIu64"/%"PRIu64,
                     conn->offset, length);
+        } else {
+            ret = true;
+            if (cls == TRANSPORT_CLASS_DEMAND) {
+                /* Background transfers may be paused or share the link
+                   with each other, so only demand transfers give a
+                   useful estimate */
+                record_link_sample(eng, conn, url);
+            }
         }
-        ret = true;
         break;
     case CURLE_COULDNT_RESOLVE_PROXY:
     case CURLE_COULDNT_RESOLVE_HOST:
@@ -503,10 +1099,11 @@ static bool fetch(struct connection_pool *cpool, const char *url,
     case CURLE_GOT_NOTHING:
     case CURLE_SEND_ERROR:
     case CURLE_RECV_ERROR:
+    case CURLE_PARTIAL_FILE:
     case CURLE_BAD_CONTENT_ENCODING:
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_NETWORK,
-                "curl error %d: %s", code, conn->errbuf);
+                "curl error %d: %s", conn->result, conn->errbuf);
         break;
     case CURLE_ABORTED_BY_CALLBACK:
         g_set_error(err, VMNETFS_IO_ERROR, VMNETFS_IO_ERROR_INTERRUPTED,
@@ -515,7 +1112,7 @@ static bool fetch(struct connection_pool *cpool, const char *url,
     default:
         g_set_error(err, VMNETFS_TRANSPORT_ERROR,
                 VMNETFS_TRANSPORT_ERROR_FATAL,
-                "curl error %d: %s", code, conn->errbuf);
+                "curl error %d: %s", conn->result, conn->errbuf);
         break;
     }
 out:
@@ -525,7 +1122,7 @@ out:
 
 /* Attempt to fetch the specified byte range from the URL, retrying
    several times in case of retryable errors. */
-bool _vmnetfs_transport_fetch(struct connection_pool *cpool, const char *url,
+bool _vmnetfs_transport_fetch(enum transport_class cls, const char *url,
         const char *username, const char *password, const char *etag,
         time_t last_modified, void *buf, uint64_t offset, uint64_t length,
         should_cancel_fn *should_cancel, void *should_cancel_arg,
@@ -539,7 +1136,7 @@ bool _vmnetfs_transport_fetch(struct connection_pool *cpool, const char *url,
             g_clear_error(&my_err);
             sleep(TRANSPORT_RETRY_DELAY);
         }
-        if (fetch(cpool, url, username, password, etag, last_modified, buf,
+        if (fetch(cls, url, username, password, etag, last_modified, buf,
                 NULL, NULL, offset, length, should_cancel, should_cancel_arg,
                 &my_err)) {
             return true;
@@ -554,15 +1151,16 @@ bool _vmnetfs_transport_fetch(struct connection_pool *cpool, const char *url,
     return false;
 }
 
-/* Attempt to stream the specified URL.  Do not retry. */
-bool _vmnetfs_transport_fetch_stream_once(struct connection_pool *cpool,
+/* Attempt to stream the specified URL.  Do not retry.  @callback is
+   called from the calling thread. */
+bool _vmnetfs_transport_fetch_stream_once(enum transport_class cls,
         const char *url, const char *username, const char *password,
         const char *etag, time_t last_modified, stream_fn *callback,
         void *arg, uint64_t offset, uint64_t length,
         should_cancel_fn *should_cancel, void *should_cancel_arg,
         GError **err)
 {
-    return fetch(cpool, url, username, password, etag, last_modified, NULL,
+    return fetch(cls, url, username, password, etag, last_modified, NULL,
             callback, arg, offset, length, should_cancel, should_cancel_arg,
             err);
 }
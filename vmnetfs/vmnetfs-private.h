@@ -37,6 +37,20 @@ enum fetch_mode {
     FETCH_MODE_STREAM,
 };
 
+enum cache_layout {
+    CACHE_LAYOUT_CHUNKS,
+    CACHE_LAYOUT_PACK,
+};
+
+enum transport_class {
+    TRANSPORT_CLASS_DEMAND,
+    TRANSPORT_CLASS_READAHEAD,
+    TRANSPORT_CLASS_PROFILE,
+    TRANSPORT_CLASS_STREAM,
+    TRANSPORT_CLASS_FILL,
+    TRANSPORT_CLASS_COUNT,
+};
+
 struct vmnetfs_image {
     char *url;
     char *username;
@@ -46,31 +60,79 @@ struct vmnetfs_image {
     uint64_t fetch_offset;
     uint64_t initial_size;
     uint32_t chunk_size;
+    enum cache_layout cache_layout;
+    bool compress_cache;
+    uint64_t memcache_size;
+    char *store_path;
+    char *hashes_file;
+    char *zero_map_file;
+    char *shared_path;
+    uint64_t modified_mem_size;
+    char *modified_path;
+    bool persist_modified;
     char *etag;
     time_t last_modified;
     enum fetch_mode fetch_mode;
+    uint32_t readahead_chunks;
+    uint32_t stream_connections;
+    bool access_profile;
+    bool transition_model;
+    bool background_fill;
 
     /* io */
-    struct connection_pool *cpool;
     struct chunk_state *chunk_state;
     struct stream_state *stream;
     struct bitmap_group *bitmaps;
     struct bitmap *accessed_map;
     struct bitmap *fetched_map;
 
+    /* prefetch */
+    struct prefetch_state *prefetch;
+
+    /* profile */
+    struct profile_state *profile;
+
+    /* predict */
+    struct predict_state *predict;
+
+    /* memcache */
+    struct memcache_state *memcache;
+
+    /* writeback */
+    struct writeback_state *writeback;
+
     /* ll_pristine */
     struct bitmap *present_map;
+    struct bitmap *zero_map;
+    struct pack_state *pack;
+    int cache_lock_fd;
+    int fetch_lock_fd;
+    uint8_t *chunk_hashes;
+    bool shared_readonly;
 
     /* ll_modified */
     int write_fd;
     struct bitmap *modified_map;
+    GMutex *incomplete_lock;
+    GHashTable *incomplete_chunks;
+    struct modified_mem *modified_mem;
+    uint32_t modified_persisted;
+    uint32_t modified_resumed;
 
     /* stats */
     struct vmnetfs_stream_group *io_stream;
     struct vmnetfs_stat *bytes_read;
     struct vmnetfs_stat *bytes_written;
+    struct vmnetfs_stat *bytes_discarded;
     struct vmnetfs_stat *chunk_fetch_skips;
     struct vmnetfs_stat *chunk_fetches;
+    struct vmnetfs_stat *chunk_prefetches;
+    struct vmnetfs_stat *chunk_fills;
+    struct vmnetfs_stat *chunk_store_hits;
+    struct vmnetfs_stat *chunk_shared_hits;
+    struct vmnetfs_stat *memcache_hits;
+    struct vmnetfs_stat *memcache_misses;
+    struct vmnetfs_stat *fill_position;
     struct vmnetfs_stat *chunk_dirties;
     struct vmnetfs_stat *io_errors;
 };
@@ -101,6 +163,8 @@ struct vmnetfs_fuse_ops {
             uint64_t count);
     int (*write)(struct vmnetfs_fuse_fh *fh, const void *buf,
             uint64_t start, uint64_t count);
+    int (*fallocate)(struct vmnetfs_fuse_fh *fh, int mode, uint64_t start,
+            uint64_t count);
     int (*poll)(struct vmnetfs_fuse_fh *fh, struct fuse_pollhandle *ph,
             bool *readable);
     void (*release)(struct vmnetfs_fuse_fh *fh);
@@ -152,6 +216,17 @@ enum VMNetFSTransportError {
     VMNETFS_TRANSPORT_ERROR_NETWORK,
 };
 
+typedef bool (stream_fn)(void *arg, const void *buf, uint64_t count,
+        GError **err);
+typedef bool (should_cancel_fn)(void *arg);
+
+/* compress */
+bool _vmnetfs_is_zero(const void *buf, uint64_t len);
+uint32_t _vmnetfs_compress(const void *in, uint32_t in_len, void *out,
+        uint32_t out_len);
+bool _vmnetfs_decompress(const void *in, uint32_t in_len, void *out,
+        uint32_t out_len);
+
 /* fuse */
 struct vmnetfs_fuse *_vmnetfs_fuse_new(struct vmnetfs *fs, GError **err);
 void _vmnetfs_fuse_run(struct vmnetfs_fuse *fuse);
@@ -188,23 +263,91 @@ uint64_t _vmnetfs_io_read_chunk(struct vmnetfs_image *img, void *data,
         uint64_t chunk, uint32_t offset, uint32_t length, GError **err);
 uint64_t _vmnetfs_io_write_chunk(struct vmnetfs_image *img, const void *data,
         uint64_t chunk, uint32_t offset, uint32_t length, GError **err);
+uint64_t _vmnetfs_io_zero_chunk(struct vmnetfs_image *img, uint64_t chunk,
+        uint32_t offset, uint32_t length, GError **err);
 uint64_t _vmnetfs_io_get_image_size(struct vmnetfs_image *img,
         uint64_t *change_cookie);
 bool _vmnetfs_io_set_image_size(struct vmnetfs_image *img, uint64_t size,
         GError **err);
 bool _vmnetfs_io_image_size_add_poll_handle(struct vmnetfs_image *img,
         struct fuse_pollhandle *ph, uint64_t change_cookie);
+bool _vmnetfs_io_fetch_range(struct vmnetfs_image *img, uint64_t start,
+        uint64_t count, GError **err);
+uint64_t _vmnetfs_io_prefetch(struct vmnetfs_image *img, uint64_t start_chunk,
+        uint64_t count, enum transport_class cls,
+        should_cancel_fn *should_cancel,
+        void *should_cancel_arg, GError **err);
+
+/* prefetch */
+bool _vmnetfs_prefetch_start(struct vmnetfs_image *img, GError **err);
+void _vmnetfs_prefetch_stop(struct vmnetfs_image *img);
+void _vmnetfs_prefetch_destroy(struct vmnetfs_image *img);
+void _vmnetfs_prefetch_access(struct vmnetfs_image *img, uint64_t chunk);
+void _vmnetfs_prefetch_demand(struct vmnetfs_image *img);
+
+/* profile */
+void _vmnetfs_profile_init(struct vmnetfs_image *img);
+void _vmnetfs_profile_destroy(struct vmnetfs_image *img);
+GArray *_vmnetfs_profile_get_replay(struct vmnetfs_image *img);
+void _vmnetfs_profile_record(struct vmnetfs_image *img, uint64_t chunk);
+void _vmnetfs_profile_save(struct vmnetfs_image *img);
+
+/* predict */
+void _vmnetfs_predict_init(struct vmnetfs_image *img);
+void _vmnetfs_predict_destroy(struct vmnetfs_image *img);
+guint _vmnetfs_predict_access(struct vmnetfs_image *img, uint64_t chunk,
+        uint64_t *predicted, guint max);
+void _vmnetfs_predict_save(struct vmnetfs_image *img);
+
+/* memcache */
+void _vmnetfs_memcache_init(struct vmnetfs_image *img);
+void _vmnetfs_memcache_destroy(struct vmnetfs_image *img);
+bool _vmnetfs_memcache_read(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length);
+void _vmnetfs_memcache_insert(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t length);
+
+/* writeback */
+bool _vmnetfs_writeback_init(struct vmnetfs_image *img, GError **err);
+void _vmnetfs_writeback_destroy(struct vmnetfs_image *img);
+void _vmnetfs_writeback_add(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t length, bool publish);
+bool _vmnetfs_writeback_contains(struct vmnetfs_image *img, uint64_t chunk);
+bool _vmnetfs_writeback_read(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length);
 
 /* ll_pristine */
 bool _vmnetfs_ll_pristine_init(struct vmnetfs_image *img, GError **err);
+void _vmnetfs_ll_pristine_close(struct vmnetfs_image *img);
 void _vmnetfs_ll_pristine_destroy(struct vmnetfs_image *img);
 bool _vmnetfs_ll_pristine_read_chunk(struct vmnetfs_image *img, void *data,
         uint64_t chunk, uint32_t offset, uint32_t length, GError **err);
 bool _vmnetfs_ll_pristine_write_chunk(struct vmnetfs_image *img, void *data,
         uint64_t chunk, uint32_t length, GError **err);
+bool _vmnetfs_ll_pristine_lock_fetch(struct vmnetfs_image *img,
+        uint64_t start_chunk, uint64_t count,
+        should_cancel_fn *should_cancel, void *should_cancel_arg,
+        GError **err);
+void _vmnetfs_ll_pristine_trylock_fetch(struct vmnetfs_image *img,
+        uint64_t start_chunk, uint64_t count);
+void _vmnetfs_ll_pristine_unlock_fetch(struct vmnetfs_image *img,
+        uint64_t start_chunk, uint64_t count);
+bool _vmnetfs_ll_pristine_claim_stream(struct vmnetfs_image *img);
+void _vmnetfs_ll_pristine_release_stream(struct vmnetfs_image *img);
+bool _vmnetfs_ll_pristine_refresh_chunk(struct vmnetfs_image *img,
+        uint64_t chunk);
+bool _vmnetfs_ll_pristine_shared_contains(struct vmnetfs_image *img,
+        uint64_t chunk);
+bool _vmnetfs_ll_pristine_read_shared(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t length);
+void _vmnetfs_ll_pristine_write_shared(struct vmnetfs_image *img,
+        const void *data, uint64_t chunk, uint32_t length);
 
 /* ll_modified */
-bool _vmnetfs_ll_modified_init(struct vmnetfs_image *img, GError **err);
+bool _vmnetfs_ll_modified_init(struct vmnetfs_image *img,
+        uint64_t *image_size, GError **err);
+void _vmnetfs_ll_modified_close(struct vmnetfs_image *img,
+        uint64_t image_size);
 void _vmnetfs_ll_modified_destroy(struct vmnetfs_image *img);
 bool _vmnetfs_ll_modified_read_chunk(struct vmnetfs_image *img,
         uint64_t image_size, void *data, uint64_t chunk, uint32_t offset,
@@ -212,29 +355,37 @@ bool _vmnetfs_ll_modified_read_chunk(struct vmnetfs_image *img,
 bool _vmnetfs_ll_modified_write_chunk(struct vmnetfs_image *img,
         uint64_t image_size, const void *data, uint64_t chunk,
         uint32_t offset, uint32_t length, GError **err);
+bool _vmnetfs_ll_modified_zero_chunk(struct vmnetfs_image *img,
+        uint64_t image_size, uint64_t chunk, uint32_t offset,
+        uint32_t length, GError **err);
 bool _vmnetfs_ll_modified_set_size(struct vmnetfs_image *img,
         uint64_t current_size, uint64_t new_size, GError **err);
+bool _vmnetfs_ll_modified_write_is_aligned(struct vmnetfs_image *img,
+        uint64_t chunk, uint32_t offset, uint32_t length);
+bool _vmnetfs_ll_modified_is_incomplete(struct vmnetfs_image *img,
+        uint64_t chunk);
+bool _vmnetfs_ll_modified_range_is_dirty(struct vmnetfs_image *img,
+        uint64_t chunk, uint32_t offset, uint32_t length);
+bool _vmnetfs_ll_modified_merge(struct vmnetfs_image *img,
+        const void *pristine, uint64_t chunk, GError **err);
 
 /* transport */
-typedef bool (stream_fn)(void *arg, const void *buf, uint64_t count,
-        GError **err);
-typedef bool (should_cancel_fn)(void *arg);
 bool _vmnetfs_transport_init(void);
-struct connection_pool *_vmnetfs_transport_pool_new(GError **err);
-void _vmnetfs_transport_pool_free(struct connection_pool *cpool);
-bool _vmnetfs_transport_pool_set_cookie(struct connection_pool *cpool,
-        const char *cookie, GError **err);
-bool _vmnetfs_transport_fetch(struct connection_pool *cpool, const char *url,
+bool _vmnetfs_transport_start(const uint32_t *shares, GError **err);
+void _vmnetfs_transport_stop(void);
+bool _vmnetfs_transport_set_cookie(const char *cookie, GError **err);
+bool _vmnetfs_transport_fetch(enum transport_class cls, const char *url,
         const char *username, const char *password, const char *etag,
         time_t last_modified, void *buf, uint64_t offset, uint64_t length,
         should_cancel_fn *should_cancel, void *should_cancel_arg,
         GError **err);
-bool _vmnetfs_transport_fetch_stream_once(struct connection_pool *cpool,
+bool _vmnetfs_transport_fetch_stream_once(enum transport_class cls,
         const char *url, const char *username, const char *password,
         const char *etag, time_t last_modified, stream_fn *callback,
         void *arg, uint64_t offset, uint64_t length,
         should_cancel_fn *should_cancel, void *should_cancel_arg,
         GError **err);
+uint64_t _vmnetfs_transport_estimate_bdp(const char *url);
 
 /* bitmap */
 struct bitmap_group *_vmnetfs_bit_group_new(uint64_t initial_bits);
@@ -245,6 +396,8 @@ struct bitmap *_vmnetfs_bit_new(struct bitmap_group *mgrp, bool set_on_extend);
 void _vmnetfs_bit_free(struct bitmap *map);
 void _vmnetfs_bit_set(struct bitmap *map, uint64_t bit);
 bool _vmnetfs_bit_test(struct bitmap *map, uint64_t bit);
+void _vmnetfs_bit_export(struct bitmap *map, void *buf, uint64_t bits);
+void _vmnetfs_bit_import(struct bitmap *map, const void *buf, uint64_t bits);
 struct vmnetfs_stream_group *_vmnetfs_bit_get_stream_group(struct bitmap *map);
 
 /* stream */
@@ -35,8 +35,16 @@ static void _image_free(struct vmnetfs_image *img)
     _vmnetfs_stream_group_free(img->io_stream);
     _vmnetfs_stat_free(img->bytes_read);
     _vmnetfs_stat_free(img->bytes_written);
+    _vmnetfs_stat_free(img->bytes_discarded);
     _vmnetfs_stat_free(img->chunk_fetch_skips);
     _vmnetfs_stat_free(img->chunk_fetches);
+    _vmnetfs_stat_free(img->chunk_prefetches);
+    _vmnetfs_stat_free(img->chunk_fills);
+    _vmnetfs_stat_free(img->chunk_store_hits);
+    _vmnetfs_stat_free(img->chunk_shared_hits);
+    _vmnetfs_stat_free(img->memcache_hits);
+    _vmnetfs_stat_free(img->memcache_misses);
+    _vmnetfs_stat_free(img->fill_position);
     _vmnetfs_stat_free(img->chunk_dirties);
     _vmnetfs_stat_free(img->io_errors);
     g_free(img->url);
@@ -47,6 +55,11 @@ static void _image_free(struct vmnetfs_image *img)
         img->cookies = g_list_delete_link(img->cookies, img->cookies);
     }
     g_free(img->read_base);
+    g_free(img->store_path);
+    g_free(img->hashes_file);
+    g_free(img->zero_map_file);
+    g_free(img->shared_path);
+    g_free(img->modified_path);
     g_free(img->etag);
     g_slice_free(struct vmnetfs_image, img);
 }
@@ -310,6 +323,31 @@ static bool image_add(GHashTable *images, xmlDocPtr args,
     img->fetch_offset = xpath_get_uint(ctx, "v:origin/v:offset/text()");
     img->initial_size = xpath_get_uint(ctx, "v:size/text()");
     img->chunk_size = xpath_get_uint(ctx, "v:cache/v:chunk-size/text()");
+    str = xpath_get_str(ctx, "v:cache/v:layout/text()");
+    if (str && !strcmp(str, "pack")) {
+        img->cache_layout = CACHE_LAYOUT_PACK;
+    } else {
+        img->cache_layout = CACHE_LAYOUT_CHUNKS;
+    }
+    g_free(str);
+    str = xpath_get_str(ctx, "v:cache/v:compress/text()");
+    img->compress_cache = str && (!strcmp(str, "true") ||
+            !strcmp(str, "1"));
+    g_free(str);
+    img->memcache_size = xpath_get_uint(ctx,
+            "v:cache/v:memory-cache/text()");
+    img->store_path = xpath_get_str(ctx, "v:cache/v:store/v:path/text()");
+    img->hashes_file = xpath_get_str(ctx,
+            "v:cache/v:store/v:hashes/text()");
+    img->shared_path = xpath_get_str(ctx, "v:cache/v:shared/text()");
+    img->zero_map_file = xpath_get_str(ctx, "v:cache/v:zero-map/text()");
+    img->modified_mem_size = xpath_get_uint(ctx,
+            "v:modified/v:memory/text()");
+    img->modified_path = xpath_get_str(ctx, "v:modified/v:path/text()");
+    str = xpath_get_str(ctx, "v:modified/v:persist/text()");
+    img->persist_modified = str && (!strcmp(str, "true") ||
+            !strcmp(str, "1"));
+    g_free(str);
     img->etag = xpath_get_str(ctx, "v:origin/v:validators/v:etag/text()");
     img->last_modified = xpath_get_uint(ctx,
             "v:origin/v:validators/v:last-modified/text()");
@@ -321,6 +359,21 @@ static bool image_add(GHashTable *images, xmlDocPtr args,
         img->fetch_mode = FETCH_MODE_DEMAND;
     }
     g_free(str);
+    img->readahead_chunks = xpath_get_uint(ctx,
+            "v:fetch/v:readahead/text()");
+    img->stream_connections = xpath_get_uint(ctx,
+            "v:fetch/v:connections/text()");
+    str = xpath_get_str(ctx, "v:fetch/v:profile/text()");
+    img->access_profile = str && (!strcmp(str, "true") || !strcmp(str, "1"));
+    g_free(str);
+    str = xpath_get_str(ctx, "v:fetch/v:predict/text()");
+    img->transition_model = str && (!strcmp(str, "true") ||
+            !strcmp(str, "1"));
+    g_free(str);
+    str = xpath_get_str(ctx, "v:fetch/v:fill/text()");
+    img->background_fill = str && (!strcmp(str, "true") ||
+            !strcmp(str, "1"));
+    g_free(str);
 
     obj = xmlXPathEval(BAD_CAST "v:origin/v:cookies/v:cookie/text()", ctx);
     for (i = 0; obj && obj->nodesetval && i < obj->nodesetval->nodeNr; i++) {
@@ -335,8 +388,16 @@ static bool image_add(GHashTable *images, xmlDocPtr args,
     img->io_stream = _vmnetfs_stream_group_new(NULL, NULL);
     img->bytes_read = _vmnetfs_stat_new();
     img->bytes_written = _vmnetfs_stat_new();
+    img->bytes_discarded = _vmnetfs_stat_new();
     img->chunk_fetch_skips = _vmnetfs_stat_new();
     img->chunk_fetches = _vmnetfs_stat_new();
+    img->chunk_prefetches = _vmnetfs_stat_new();
+    img->chunk_fills = _vmnetfs_stat_new();
+    img->chunk_store_hits = _vmnetfs_stat_new();
+    img->chunk_shared_hits = _vmnetfs_stat_new();
+    img->memcache_hits = _vmnetfs_stat_new();
+    img->memcache_misses = _vmnetfs_stat_new();
+    img->fill_position = _vmnetfs_stat_new();
     img->chunk_dirties = _vmnetfs_stat_new();
     img->io_errors = _vmnetfs_stat_new();
 
@@ -367,8 +428,16 @@ static void image_close(void *key G_GNUC_UNUSED, void *value,
     _vmnetfs_io_close(img);
     _vmnetfs_stat_close(img->bytes_read);
     _vmnetfs_stat_close(img->bytes_written);
+    _vmnetfs_stat_close(img->bytes_discarded);
     _vmnetfs_stat_close(img->chunk_fetch_skips);
     _vmnetfs_stat_close(img->chunk_fetches);
+    _vmnetfs_stat_close(img->chunk_prefetches);
+    _vmnetfs_stat_close(img->chunk_fills);
+    _vmnetfs_stat_close(img->chunk_store_hits);
+    _vmnetfs_stat_close(img->chunk_shared_hits);
+    _vmnetfs_stat_close(img->memcache_hits);
+    _vmnetfs_stat_close(img->memcache_misses);
+    _vmnetfs_stat_close(img->fill_position);
     _vmnetfs_stat_close(img->chunk_dirties);
     _vmnetfs_stat_close(img->io_errors);
     _vmnetfs_stream_group_close(img->io_stream);
@@ -429,6 +498,7 @@ static void run(FILE *pipe, const char *config_file)
     xmlXPathContextPtr xpath;
     xmlXPathObjectPtr obj;
     xmlChar *xstr;
+    uint32_t shares[TRANSPORT_CLASS_COUNT] = {0};
     int i;
     GError *err = NULL;
 
@@ -461,8 +531,24 @@ static void run(FILE *pipe, const char *config_file)
     fs->images = g_hash_table_new_full(g_str_hash, g_str_equal, g_free,
             image_free);
 
-    /* Set up images */
+    /* Start transport */
     xpath = make_xpath_context(args);
+    shares[TRANSPORT_CLASS_READAHEAD] = xpath_get_uint(xpath,
+            "/v:config/v:transport/v:readahead-share/text()");
+    shares[TRANSPORT_CLASS_PROFILE] = xpath_get_uint(xpath,
+            "/v:config/v:transport/v:profile-share/text()");
+    shares[TRANSPORT_CLASS_STREAM] = xpath_get_uint(xpath,
+            "/v:config/v:transport/v:stream-share/text()");
+    shares[TRANSPORT_CLASS_FILL] = xpath_get_uint(xpath,
+            "/v:config/v:transport/v:fill-share/text()");
+    if (!_vmnetfs_transport_start(shares, &err)) {
+        fprintf(pipe, "%s\n", err->message);
+        xmlXPathFreeContext(xpath);
+        xmlFreeDoc(args);
+        goto out;
+    }
+
+    /* Set up images */
     obj = xmlXPathEval(BAD_CAST "/v:config/v:image", xpath);
     for (i = 0; obj && obj->nodesetval && i < obj->nodesetval->nodeNr; i++) {
         if (!image_add(fs->images, args, obj->nodesetval->nodeTab[i], &err)) {
@@ -537,6 +623,7 @@ out:
     }
     _vmnetfs_fuse_free(fs->fuse);
     g_hash_table_destroy(fs->images);
+    _vmnetfs_transport_stop();
     _vmnetfs_log_destroy(fs->log);
     g_free(fs->censored_config);
     g_slice_free(struct vmnetfs, fs);
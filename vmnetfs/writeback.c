@@ -0,0 +1,244 @@
+/*
+ * vmnetfs - virtual machine network execution virtual filesystem
+ *
+ * Copyright (C) 2006-2014 Carnegie Mellon University
+ *
+ * This program is free software; you can redistribute it and/or modify it
+ * under the terms of version 2 of the GNU General Public License as published
+ * by the Free Software Foundation.  A copy of the GNU General Public License
+ * should have been distributed along with this program in the file
+ * COPYING.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+ * for more details.
+ */
+
+/* Write-behind of fetched chunks.  Rather than writing each fetched chunk
+   to the pristine cache and reading it back to satisfy the request that
+   caused the fetch, the fetcher queues the chunk here and readers are
+   served from the queued copy.  A writer thread drains the queue in
+   batches, in chunk order, and a chunk is marked present in the pristine
+   cache only after it has been written there.  Until then, the chunk is
+   neither missing nor present; readers must check for a pending copy
+   before deciding to fetch.
+
+   Writers block while too much data is queued, so a slow disk throttles
+   fetching rather than exhausting memory.  If a chunk can't be written,
+   it is dropped and will be fetched again if needed.  Either way, the
+   writer then releases the chunk's fetch lock, letting other vmnetfs
+   processes sharing the cache see the result.  Chunks fetched from the
+   origin are then also written to the shared tier, if there is one,
+   while readers continue to be served from the queued copy. */
+
+#include <string.h>
+#include <inttypes.h>
+#include "vmnetfs-private.h"
+
+/* Producers wait while more than this many bytes are queued */
+#define WRITEBACK_MAX_BYTES (64 << 20)
+
+struct pending_chunk {
+    uint64_t chunk;
+    uint32_t length;
+    char *data;
+    bool publish;           /* add to the shared tier */
+};
+
+struct writeback_state {
+    GMutex *lock;
+    GCond *cond;            /* queue changed or stop requested */
+    GHashTable *pending;    /* uint64_t -> struct pending_chunk */
+    GPtrArray *queue;       /* chunks not yet taken by the writer */
+    uint64_t pending_bytes;
+    GThread *thread;
+    bool stop;
+};
+
+static void pending_free(void *data)
+{
+    struct pending_chunk *pc = data;
+
+    g_free(pc->data);
+    g_slice_free(struct pending_chunk, pc);
+}
+
+static gint pending_compare(gconstpointer a, gconstpointer b)
+{
+    const struct pending_chunk *pa = *(struct pending_chunk * const *) a;
+    const struct pending_chunk *pb = *(struct pending_chunk * const *) b;
+
+    if (pa->chunk < pb->chunk) {
+        return -1;
+    } else if (pa->chunk > pb->chunk) {
+        return 1;
+    }
+    return 0;
+}
+
+static void *writeback_thread(void *data)
+{
+    struct vmnetfs_image *img = data;
+    struct writeback_state *wb = img->writeback;
+    struct pending_chunk *pc;
+    GPtrArray *batch;
+    GError *err = NULL;
+    guint i;
+
+    g_mutex_lock(wb->lock);
+    while (true) {
+        while (!wb->stop && wb->queue->len == 0) {
+            g_cond_wait(wb->cond, wb->lock);
+        }
+        if (wb->queue->len == 0) {
+            /* Stopped and drained */
+            break;
+        }
+        batch = wb->queue;
+        wb->queue = g_ptr_array_new();
+        g_mutex_unlock(wb->lock);
+
+        /* Entries can't be freed until we remove them, so we don't need
+           the lock to write them */
+        g_ptr_array_sort(batch, pending_compare);
+        for (i = 0; i < batch->len; i++) {
+            pc = g_ptr_array_index(batch, i);
+            if (!_vmnetfs_ll_pristine_write_chunk(img, pc->data, pc->chunk,
+                    pc->length, &err)) {
+                g_warning("Couldn't write chunk %"PRIu64" to cache: %s",
+                        pc->chunk, err->message);
+                g_clear_error(&err);
+            }
+            _vmnetfs_ll_pristine_unlock_fetch(img, pc->chunk, 1);
+        }
+        for (i = 0; i < batch->len; i++) {
+            pc = g_ptr_array_index(batch, i);
+            if (pc->publish) {
+                _vmnetfs_ll_pristine_write_shared(img, pc->data, pc->chunk,
+                        pc->length);
+            }
+        }
+
+        g_mutex_lock(wb->lock);
+        for (i = 0; i < batch->len; i++) {
+            pc = g_ptr_array_index(batch, i);
+            wb->pending_bytes -= pc->length;
+            g_hash_table_remove(wb->pending, &pc->chunk);
+        }
+        g_ptr_array_free(batch, TRUE);
+        g_cond_broadcast(wb->cond);
+    }
+    g_mutex_unlock(wb->lock);
+    return NULL;
+}
+
+bool _vmnetfs_writeback_init(struct vmnetfs_image *img, GError **err)
+{
+    struct writeback_state *wb;
+
+    wb = g_slice_new0(struct writeback_state);
+    wb->lock = g_mutex_new();
+    wb->cond = g_cond_new();
+    wb->pending = g_hash_table_new_full(g_int64_hash, g_int64_equal, NULL,
+            pending_free);
+    wb->queue = g_ptr_array_new();
+    img->writeback = wb;
+
+    wb->thread = g_thread_create(writeback_thread, img, TRUE, err);
+    if (!wb->thread) {
+        img->writeback = NULL;
+        g_ptr_array_free(wb->queue, TRUE);
+        g_hash_table_destroy(wb->pending);
+        g_cond_free(wb->cond);
+        g_mutex_free(wb->lock);
+        g_slice_free(struct writeback_state, wb);
+        return false;
+    }
+    return true;
+}
+
+/* Writes all pending chunks to the pristine cache.  No more chunks may be
+   added. */
+void _vmnetfs_writeback_destroy(struct vmnetfs_image *img)
+{
+    struct writeback_state *wb = img->writeback;
+
+    if (wb == NULL) {
+        return;
+    }
+    g_mutex_lock(wb->lock);
+    wb->stop = true;
+    g_cond_broadcast(wb->cond);
+    g_mutex_unlock(wb->lock);
+    g_thread_join(wb->thread);
+
+    g_assert(g_hash_table_size(wb->pending) == 0);
+    g_ptr_array_free(wb->queue, TRUE);
+    g_hash_table_destroy(wb->pending);
+    g_cond_free(wb->cond);
+    g_mutex_free(wb->lock);
+    g_slice_free(struct writeback_state, wb);
+    img->writeback = NULL;
+}
+
+/* Queue a fetched chunk for writing to the pristine cache, taking over its
+   fetch lock.  If @publish is true, the chunk came from the origin and
+   should also be written to the shared tier.  Chunk lock must be held,
+   and the chunk must be neither present nor pending. */
+void _vmnetfs_writeback_add(struct vmnetfs_image *img, const void *data,
+        uint64_t chunk, uint32_t length, bool publish)
+{
+    struct writeback_state *wb = img->writeback;
+    struct pending_chunk *pc;
+
+    pc = g_slice_new(struct pending_chunk);
+    pc->chunk = chunk;
+    pc->length = length;
+    pc->data = g_memdup(data, length);
+    pc->publish = publish;
+
+    g_mutex_lock(wb->lock);
+    while (wb->pending_bytes > 0 &&
+            wb->pending_bytes + length > WRITEBACK_MAX_BYTES) {
+        g_cond_wait(wb->cond, wb->lock);
+    }
+    g_assert(g_hash_table_lookup(wb->pending, &chunk) == NULL);
+    g_hash_table_replace(wb->pending, &pc->chunk, pc);
+    g_ptr_array_add(wb->queue, pc);
+    wb->pending_bytes += length;
+    g_cond_broadcast(wb->cond);
+    g_mutex_unlock(wb->lock);
+}
+
+bool _vmnetfs_writeback_contains(struct vmnetfs_image *img, uint64_t chunk)
+{
+    struct writeback_state *wb = img->writeback;
+    bool ret;
+
+    g_mutex_lock(wb->lock);
+    ret = g_hash_table_lookup(wb->pending, &chunk) != NULL;
+    g_mutex_unlock(wb->lock);
+    return ret;
+}
+
+/* Copy data from a pending chunk.  Returns false if the chunk is not
+   pending, in which case it is either missing or present in the pristine
+   cache. */
+bool _vmnetfs_writeback_read(struct vmnetfs_image *img, void *data,
+        uint64_t chunk, uint32_t offset, uint32_t length)
+{
+    struct writeback_state *wb = img->writeback;
+    struct pending_chunk *pc;
+
+    g_mutex_lock(wb->lock);
+    pc = g_hash_table_lookup(wb->pending, &chunk);
+    if (pc == NULL) {
+        g_mutex_unlock(wb->lock);
+        return false;
+    }
+    g_assert(offset + length <= pc->length);
+    memcpy(data, pc->data + offset, length);
+    g_mutex_unlock(wb->lock);
+    return true;
+}
@@ -0,0 +1,702 @@
+#
+# vmnetx.cache - Management of the local chunk cache
+#
+# Copyright (C) 2014 Carnegie Mellon University
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of version 2 of the GNU General Public License as published
+# by the Free Software Foundation.  A copy of the GNU General Public License
+# should have been distributed along with this program in the file
+# COPYING.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+
+# The chunk cache contains one directory per package version, named by
+# a hash of the package URL and validators.  Each holds an info file and
+# a subdirectory per image and chunk size, in the format written by
+# vmnetfs.  We keep the total size of cached chunks within a byte budget
+# by evicting the least recently used chunks across all packages.
+#
+# While vmnetfs has an image open, it holds a shared lock on the lock file
+# in the image's cache directory, so we skip any image we can't lock
+# exclusively.  At shutdown, vmnetfs records the last use time of each
+# chunk it touched; chunks without a recorded time fall back to the
+# modification time of the file containing them.  Chunks listed in the
+# pinned file are never evicted.
+#
+# Images of packages with chunk hashes share identical chunks through a
+# content-addressed store, whose entries are hard links to the chunk files
+# in the image caches.  A chunk shared by several images only counts once
+# against the budget, and its space is reclaimed when it has been evicted
+# from all of them and the store entry is removed.
+#
+# When a package is republished, its new version gets a new cache
+# directory.  If the new version has chunk hashes, then before its first
+# launch we copy or link in every chunk of an older cached version of the
+# same URL that matches a hash, and carry over the access profile and
+# transition model, so only the changed chunks have to be fetched.
+#
+# The cache can be backed by a shared tier, typically on a network
+# filesystem, that vmnetfs checks before fetching from the origin and
+# fills with the chunks it fetches.  It is laid out like this cache, with
+# one chunk per file, but is not locked or trimmed by us.
+#
+# If sessions are resumable, vmnetfs keeps each image's modified data in
+# its cache directory and saves its state there at exit, and we save the
+# running VM's memory alongside the disk image.  The next launch of the
+# package picks up where the last one left off.  Saved sessions don't
+# count against the budget.
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+from hashlib import sha256
+import json
+import os
+import re
+import shutil
+import struct
+from tempfile import NamedTemporaryFile
+
+from .util import get_cache_dir
+
+BUDGET_FILENAME = 'budget'
+SHARED_FILENAME = 'shared'
+RESUME_FILENAME = 'resume'
+INFO_FILENAME = 'info'
+LOCK_FILENAME = 'lock'
+ACCESS_TIMES_FILENAME = 'access-times'
+PINNED_FILENAME = 'pinned'
+PROFILE_FILENAME = 'profile'
+SNAPSHOT_FILENAME = 'present'
+PACK_FILENAME = 'pack'
+PACK_INDEX_FILENAME = 'pack.index'
+HASHES_FILENAME = 'chunk-hashes'
+ZERO_MAP_FILENAME = 'zero-map'
+MODIFIED_STATE_FILENAME = 'modified-state'
+SAVED_MEMORY_FILENAME = 'saved-memory'
+HASH_LEN = 32
+# Per-image metadata still useful for a newer version of the image
+CARRIED_FILENAMES = (PROFILE_FILENAME, 'transitions', PINNED_FILENAME)
+
+# Pack index entries, as written by vmnetfs
+_PACK_ABSENT = '\0'
+_PACK_ZERO = '\2'
+
+# linux/falloc.h
+_FALLOC_FL_KEEP_SIZE = 1
+_FALLOC_FL_PUNCH_HOLE = 2
+
+_SIZE_SUFFIXES = 'KMGT'
+
+
+class CacheError(Exception):
+    pass
+
+
+def parse_size(value):
+    match = re.match(r'^([0-9]+)([%s]?)B?$' % _SIZE_SUFFIXES, value.upper())
+    if match is None:
+        raise ValueError('Invalid size: %s' % value)
+    size = int(match.group(1))
+    if match.group(2):
+        size <<= 10 * (_SIZE_SUFFIXES.index(match.group(2)) + 1)
+    return size
+
+
+def format_size(size):
+    value = float(size)
+    unit = 'B'
+    for suffix in _SIZE_SUFFIXES:
+        if value < 1024:
+            break
+        value /= 1024
+        unit = suffix
+    if unit == 'B':
+        return '%d B' % size
+    return '%.1f %siB' % (value, unit)
+
+
+def _chunk_path(path, chunk):
+    # Must match vmnetfs's CHUNKS_PER_DIR
+    return os.path.join(path, str(chunk // 4096 * 4096), str(chunk))
+
+
+def _punch_hole(fd, offset, length):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = libc.fallocate64
+    except (OSError, AttributeError):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+            ctypes.c_int64]
+    if fallocate(fd, _FALLOC_FL_KEEP_SIZE | _FALLOC_FL_PUNCH_HOLE, offset,
+            length):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+class _CachedChunk(object):
+    def __init__(self, image, chunk, size, atime, inode=None):
+        self.image = image
+        self.chunk = chunk
+        self.size = size
+        self.atime = atime
+        # Identifies the storage, which may be shared with other images
+        self.key = inode or (image.path, chunk)
+
+
+class CachedImage(object):
+    '''The cached chunks of one image at one chunk size.'''
+
+    def __init__(self, path, label, chunk_size):
+        self.path = path
+        self.label = label
+        self.chunk_size = chunk_size
+        self._lock_fd = None
+        self._chunks = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def layout(self):
+        if os.path.exists(self._file(PACK_INDEX_FILENAME)):
+            return 'pack'
+        return 'chunks'
+
+    @property
+    def in_use(self):
+        '''Whether a vmnetfs process currently has the image open.'''
+        if self._lock_fd is not None:
+            return False
+        if not self.lock():
+            return True
+        self.unlock()
+        return False
+
+    def lock(self):
+        '''Try to lock the image against use by vmnetfs.  Return False if
+        vmnetfs has it open.'''
+        fd = os.open(self._file(LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        self._lock_fd = fd
+        # The image may have changed since we last looked
+        self._chunks = None
+        return True
+
+    def unlock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    @property
+    def saved_session(self):
+        '''Whether vmnetfs saved the image's modified data for the next
+        launch.'''
+        return os.path.exists(self._file(MODIFIED_STATE_FILENAME))
+
+    def _read_access_times(self):
+        try:
+            with open(self._file(ACCESS_TIMES_FILENAME), 'rb') as fh:
+                data = fh.read()
+        except IOError:
+            return ()
+        count = len(data) // 4
+        return struct.unpack('<%dI' % count, data[:count * 4])
+
+    def _scan_chunks(self):
+        times = self._read_access_times()
+        chunks = {}
+        for dirname in os.listdir(self.path):
+            if not dirname.isdigit():
+                continue
+            dirpath = os.path.join(self.path, dirname)
+            for filename in os.listdir(dirpath):
+                if not filename.isdigit():
+                    continue
+                chunk = int(filename)
+                try:
+                    st = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    # Unlocked image being modified by vmnetfs
+                    continue
+                if chunk < len(times) and times[chunk]:
+                    atime = times[chunk]
+                else:
+                    atime = st.st_mtime
+                chunks[chunk] = _CachedChunk(self, chunk, st.st_blocks * 512,
+                        atime, (st.st_dev, st.st_ino))
+        return chunks
+
+    def _scan_pack(self):
+        times = self._read_access_times()
+        with open(self._file(PACK_INDEX_FILENAME), 'rb') as fh:
+            index = fh.read()
+        image_size = os.stat(self._file(PACK_FILENAME)).st_size
+        mtime = os.stat(self._file(PACK_INDEX_FILENAME)).st_mtime
+        chunks = {}
+        for chunk, encoding in enumerate(index):
+            if encoding == _PACK_ABSENT:
+                continue
+            elif encoding == _PACK_ZERO:
+                # Not allocated
+                size = 0
+            else:
+                size = min(self.chunk_size,
+                        image_size - chunk * self.chunk_size)
+            if chunk < len(times) and times[chunk]:
+                atime = times[chunk]
+            else:
+                atime = mtime
+            chunks[chunk] = _CachedChunk(self, chunk, size, atime)
+        return chunks
+
+    @property
+    def chunks(self):
+        '''Dict from chunk number to cached chunk.'''
+        if self._chunks is None:
+            if self.layout == 'pack':
+                self._chunks = self._scan_pack()
+            else:
+                self._chunks = self._scan_chunks()
+        return self._chunks
+
+    @property
+    def size(self):
+        return sum(c.size for c in self.chunks.itervalues())
+
+    def _get_pinned(self):
+        try:
+            with open(self._file(PINNED_FILENAME)) as fh:
+                return set(int(l) for l in fh if l.strip())
+        except IOError:
+            return set()
+
+    def _set_pinned(self, chunks):
+        path = self._file(PINNED_FILENAME)
+        if chunks:
+            with open(path, 'w') as fh:
+                for chunk in sorted(chunks):
+                    fh.write('%d\n' % chunk)
+        elif os.path.exists(path):
+            os.unlink(path)
+
+    pinned = property(_get_pinned, _set_pinned)
+
+    @property
+    def hashes(self):
+        '''The chunk hashes of the image as a string, or None.'''
+        try:
+            with open(self._file(HASHES_FILENAME), 'rb') as fh:
+                return fh.read()
+        except IOError:
+            return None
+
+    def read_chunk(self, chunk):
+        '''Return the stored contents of a chunk.  vmnetfs may have
+        compressed it, in which case the result will not match the chunk
+        hash.'''
+        if self.layout == 'pack':
+            with open(self._file(PACK_INDEX_FILENAME), 'rb') as fh:
+                fh.seek(chunk)
+                encoding = fh.read(1)
+            with open(self._file(PACK_FILENAME), 'rb') as fh:
+                image_size = os.fstat(fh.fileno()).st_size
+                size = min(self.chunk_size,
+                        image_size - chunk * self.chunk_size)
+                if encoding == _PACK_ZERO:
+                    return '\0' * size
+                fh.seek(chunk * self.chunk_size)
+                return fh.read(size)
+        with open(_chunk_path(self.path, chunk), 'rb') as fh:
+            data = fh.read()
+        if not data:
+            # All-zero chunk.  Assume a full chunk; if this is the short
+            # final chunk, the hash check will reject it.
+            return '\0' * self.chunk_size
+        return data
+
+    def _add_chunk(self, chunk, source, source_chunk, data):
+        # Chunks layout only.  Link the source file if we can, so the
+        # chunk is stored once.
+        path = _chunk_path(self.path, chunk)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if source.layout == 'chunks':
+            try:
+                os.link(_chunk_path(source.path, source_chunk), path)
+                return path
+            except OSError:
+                pass
+        # Write atomically, like vmnetfs
+        with NamedTemporaryFile(dir=os.path.dirname(path),
+                prefix='%d.' % chunk, delete=False) as fh:
+            fh.write(data)
+        os.rename(fh.name, path)
+        return path
+
+    def seed(self, hashes, source, store_path=None):
+        '''Add the chunks of cached image @source that match the chunk
+        hash string @hashes of this image, which must use the chunks
+        layout.  If the source has no hashes, only chunks at the same
+        position are checked.  Link added chunks into the chunk store
+        at @store_path.  Both images must be locked if possible.  Return
+        the number of chunks added.'''
+        wanted = {}
+        for chunk in xrange(len(hashes) // HASH_LEN):
+            if chunk not in self.chunks:
+                digest = hashes[chunk * HASH_LEN:(chunk + 1) * HASH_LEN]
+                wanted.setdefault(digest, []).append(chunk)
+
+        source_hashes = source.hashes
+        added = 0
+        for source_chunk in sorted(source.chunks):
+            start = source_chunk * HASH_LEN
+            if source_hashes is not None:
+                digest = source_hashes[start:start + HASH_LEN]
+            else:
+                digest = hashes[start:start + HASH_LEN]
+            if digest not in wanted:
+                continue
+            # Always verify, since the source may be trimmed as we read
+            try:
+                data = source.read_chunk(source_chunk)
+            except (IOError, OSError):
+                continue
+            if sha256(data).digest() != digest:
+                continue
+            for chunk in wanted.pop(digest):
+                path = self._add_chunk(chunk, source, source_chunk, data)
+                added += 1
+                if store_path is not None:
+                    hexdigest = digest.encode('hex')
+                    store_file = os.path.join(store_path, hexdigest[:2],
+                            hexdigest)
+                    try:
+                        if not os.path.isdir(os.path.dirname(store_file)):
+                            os.makedirs(os.path.dirname(store_file))
+                        os.link(path, store_file)
+                    except OSError:
+                        pass
+
+        for name in CARRIED_FILENAMES:
+            if (os.path.exists(source._file(name)) and
+                    not os.path.exists(self._file(name))):
+                shutil.copy(source._file(name), self._file(name))
+
+        if added:
+            self._chunks = None
+            try:
+                os.unlink(self._file(SNAPSHOT_FILENAME))
+            except OSError:
+                pass
+        return added
+
+    @property
+    def profile(self):
+        '''The chunks recorded in the access profile, in access order.'''
+        try:
+            with open(self._file(PROFILE_FILENAME)) as fh:
+                return [int(l) for l in fh if l.strip()]
+        except IOError:
+            return []
+
+    def evict(self, chunks):
+        '''Remove the specified chunk numbers from the cache.  The image
+        must be locked.  Return the number of bytes freed.'''
+        assert self._lock_fd is not None
+        # The snapshot of present chunks would no longer be accurate
+        try:
+            os.unlink(self._file(SNAPSHOT_FILENAME))
+        except OSError:
+            pass
+        if self.layout == 'pack':
+            freed = self._evict_pack(chunks)
+        else:
+            freed = self._evict_chunks(chunks)
+        self._chunks = None
+        return freed
+
+    def _evict_chunks(self, chunks):
+        freed = 0
+        for chunk in chunks:
+            path = _chunk_path(self.path, chunk)
+            if os.stat(path).st_nlink == 1:
+                freed += self.chunks[chunk].size
+            os.unlink(path)
+        return freed
+
+    def _evict_pack(self, chunks):
+        # Mark the chunks absent before discarding their data, so a crash
+        # can't leave the index pointing at a hole
+        fd = os.open(self._file(PACK_INDEX_FILENAME), os.O_WRONLY)
+        try:
+            for chunk in chunks:
+                os.lseek(fd, chunk, os.SEEK_SET)
+                os.write(fd, '\0')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        freed = 0
+        fd = os.open(self._file(PACK_FILENAME), os.O_WRONLY)
+        try:
+            for chunk in chunks:
+                try:
+                    _punch_hole(fd, chunk * self.chunk_size,
+                            self.chunks[chunk].size)
+                except OSError, e:
+                    if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS):
+                        raise
+                    # The chunks are gone from the index but their space
+                    # can't be reclaimed in place
+                    break
+                freed += self.chunks[chunk].size
+        finally:
+            os.close(fd)
+        return freed
+
+
+class CachedPackage(object):
+    '''The cached images of one version of a package.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.id = os.path.basename(path)
+        try:
+            with open(os.path.join(path, INFO_FILENAME)) as fh:
+                self.info = json.load(fh)
+        except (IOError, ValueError):
+            self.info = {}
+        self.url = self.info.get('url')
+
+    @property
+    def images(self):
+        images = []
+        for label in sorted(os.listdir(self.path)):
+            labelpath = os.path.join(self.path, label)
+            if not os.path.isdir(labelpath):
+                continue
+            for chunk_size in sorted(os.listdir(labelpath)):
+                if not chunk_size.isdigit():
+                    continue
+                imagepath = os.path.join(labelpath, chunk_size)
+                if os.path.isdir(imagepath):
+                    images.append(CachedImage(imagepath, label,
+                            int(chunk_size)))
+        return images
+
+
+class ChunkCache(object):
+    def __init__(self, path=None, store_path=None):
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'chunks')
+        if store_path is None:
+            store_path = os.path.join(get_cache_dir(), 'store')
+        self.path = path
+        self.store_path = store_path
+
+    @property
+    def packages(self):
+        if not os.path.isdir(self.path):
+            return []
+        return [CachedPackage(os.path.join(self.path, name))
+                for name in sorted(os.listdir(self.path))
+                if os.path.isdir(os.path.join(self.path, name))]
+
+    def get_package(self, name):
+        '''Look up a package by a unique prefix of its ID or by its URL.'''
+        matches = [p for p in self.packages
+                if p.id.startswith(name) or p.url == name]
+        if not matches:
+            raise CacheError('No cached package matches %s' % name)
+        if len(matches) > 1:
+            raise CacheError('Multiple cached packages match %s' % name)
+        return matches[0]
+
+    def _get_budget(self):
+        try:
+            with open(os.path.join(self.path, BUDGET_FILENAME)) as fh:
+                return int(fh.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _set_budget(self, budget):
+        path = os.path.join(self.path, BUDGET_FILENAME)
+        if budget is not None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(path, 'w') as fh:
+                fh.write('%d\n' % budget)
+        elif os.path.exists(path):
+            os.unlink(path)
+
+    budget = property(_get_budget, _set_budget,
+            doc='Maximum bytes of cached chunks, or None for no limit.')
+
+    def _get_shared(self):
+        try:
+            with open(os.path.join(self.path, SHARED_FILENAME)) as fh:
+                return fh.read().strip() or None
+        except IOError:
+            return None
+
+    def _set_shared(self, path):
+        shared_file = os.path.join(self.path, SHARED_FILENAME)
+        if path is not None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(shared_file, 'w') as fh:
+                fh.write('%s\n' % os.path.abspath(path))
+        elif os.path.exists(shared_file):
+            os.unlink(shared_file)
+
+    shared = property(_get_shared, _set_shared,
+            doc='Root directory of the shared cache tier, or None.')
+
+    def _get_resume(self):
+        return os.path.exists(os.path.join(self.path, RESUME_FILENAME))
+
+    def _set_resume(self, resume):
+        resume_file = os.path.join(self.path, RESUME_FILENAME)
+        if resume:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            open(resume_file, 'w').close()
+        elif os.path.exists(resume_file):
+            os.unlink(resume_file)
+
+    resume = property(_get_resume, _set_resume,
+            doc='Whether to save sessions at exit and resume them.')
+
+    @property
+    def size(self):
+        '''Bytes of cached chunks, counting shared chunks once.'''
+        sizes = {}
+        for package in self.packages:
+            for image in package.images:
+                for cached in image.chunks.itervalues():
+                    sizes[cached.key] = cached.size
+        return sum(sizes.itervalues())
+
+    def seed(self, url, path, label, chunk_size, hashes):
+        '''Seed the cache directory @path for a new version of the image
+        @label of the package at @url from older cached versions of the
+        package, newest first.  Return the number of chunks added.'''
+        image = CachedImage(path, label, chunk_size)
+        sources = []
+        for package in self.packages:
+            if package.url != url:
+                continue
+            for source in package.images:
+                if (source.label == label and
+                        source.chunk_size == chunk_size and
+                        source.path != image.path):
+                    sources.append(source)
+        sources.sort(key=lambda s: os.stat(s.path).st_mtime, reverse=True)
+
+        # If someone else holds the target lock, they are already seeding
+        # or running the image
+        if not image.lock():
+            return 0
+        added = 0
+        try:
+            for source in sources:
+                locked = source.lock()
+                try:
+                    added += image.seed(hashes, source, self.store_path)
+                finally:
+                    if locked:
+                        source.unlock()
+        finally:
+            image.unlock()
+        return added
+
+    def _sweep_store(self):
+        '''Remove store entries not linked from any image cache.  Return
+        the number of bytes freed.'''
+        freed = 0
+        if not os.path.isdir(self.store_path):
+            return 0
+        for dirname in os.listdir(self.store_path):
+            dirpath = os.path.join(self.store_path, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                    if st.st_nlink == 1:
+                        # If vmnetfs links the chunk in the meantime, its
+                        # link survives
+                        os.unlink(path)
+                        freed += st.st_blocks * 512
+                except OSError:
+                    pass
+        return freed
+
+    def trim(self, budget=None):
+        '''Evict least recently used chunks until the cache fits within
+        the budget.  Images in use by vmnetfs count against the budget,
+        but only other images are trimmed.  Return the number of bytes
+        freed.'''
+        if budget is None:
+            budget = self.budget
+            if budget is None:
+                return 0
+
+        locked = []
+        try:
+            candidates = []
+            sizes = {}
+            refs = {}
+            for package in self.packages:
+                for image in package.images:
+                    evictable = image.lock()
+                    if evictable:
+                        locked.append(image)
+                        pinned = image.pinned
+                        chunks = image.chunks
+                    else:
+                        # In use by vmnetfs.  Count it, but leave it alone.
+                        try:
+                            chunks = image.chunks
+                        except (IOError, OSError):
+                            continue
+                    for cached in chunks.itervalues():
+                        sizes[cached.key] = cached.size
+                        refs[cached.key] = refs.get(cached.key, 0) + 1
+                        if evictable and cached.chunk not in pinned:
+                            candidates.append(cached)
+
+            victims = {}
+            excess = sum(sizes.itervalues()) - budget
+            candidates.sort(key=lambda c: c.atime)
+            for cached in candidates:
+                if excess <= 0:
+                    break
+                victims.setdefault(cached.image, []).append(cached.chunk)
+                # Shared chunks are only freed by their last eviction
+                refs[cached.key] -= 1
+                if refs[cached.key] == 0:
+                    excess -= cached.size
+
+            freed = 0
+            for image, chunks in victims.iteritems():
+                freed += image.evict(chunks)
+            return freed + self._sweep_store()
+        finally:
+            for image in locked:
+                image.unlock()
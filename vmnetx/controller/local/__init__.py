@@ -38,9 +38,11 @@ from urlparse import urlsplit, urlunsplit
 import uuid
 from wsgiref.handlers import format_date_time as format_rfc1123_date
 
+from ...cache import (ChunkCache, HASHES_FILENAME, SAVED_MEMORY_FILENAME,
+        ZERO_MAP_FILENAME, format_size)
 from ...domain import DomainXML
 from ...generate import copy_memory
-from ...memory import LibvirtQemuMemoryHeader
+from ...memory import LibvirtQemuMemoryHeader, MemoryImageError
 from ...package import Package
 from ...source import source_open, SourceRange
 from ...util import ErrorBuffer, ensure_dir, get_cache_dir, setup_libvirt
@@ -61,11 +63,33 @@ LibvirtEventImpl().register()
 
 class _Image(object):
     def __init__(self, label, range, username=None, password=None,
-            chunk_size=131072, stream=False):
+            chunk_size=131072, stream=False, readahead=0, profile=False,
+            connections=1, fill=False, predict=False, cache_layout='chunks',
+            hashes=None, compress=False, memory_cache=0, shared_cache=None,
+            modified_memory=0, persist=False, zero_map=None):
         self.label = label
         self.username = username
         self.password = password
         self.stream = stream
+        self.readahead = readahead
+        self.profile = profile
+        self.connections = connections
+        self.fill = fill
+        self.predict = predict
+        self.compress = compress
+        self.memory_cache = memory_cache
+        self.modified_memory = modified_memory
+        self.persist = persist
+        # Chunk hashes and zero maps are only useful if they match our
+        # chunks
+        if hashes is not None and hashes.chunk_size != chunk_size:
+            hashes = None
+        self.hashes = hashes
+        if zero_map is not None and zero_map.chunk_size != chunk_size:
+            zero_map = None
+        self.zero_map = zero_map
+        # The chunk store links to individual chunk files
+        self.cache_layout = 'chunks' if hashes is not None else cache_layout
         self.cookies = range.source.cookies
         self.url = range.source.url
         self.offset = range.offset
@@ -75,10 +99,11 @@ class _Image(object):
         self.last_modified = range.source.last_modified
 
         parsed_url = urlsplit(self.url)
+        # Exclude query string from cache path
+        self._cache_url = urlunsplit((parsed_url.scheme, parsed_url.netloc,
+                parsed_url.path, '', ''))
         self._cache_info = json.dumps({
-            # Exclude query string from cache path
-            'url': urlunsplit((parsed_url.scheme, parsed_url.netloc,
-                    parsed_url.path, '', '')),
+            'url': self._cache_url,
             'etag': self.etag,
             'last-modified': self.last_modified.isoformat()
                     if self.last_modified else None,
@@ -87,11 +112,44 @@ class _Image(object):
                 sha256(self._cache_info).hexdigest())
         # Hash collisions will allow cache poisoning!
         self.cache = os.path.join(self._urlpath, label, str(chunk_size))
+        self._hashes_file = os.path.join(self.cache, HASHES_FILENAME)
+        self._zero_map_file = os.path.join(self.cache, ZERO_MAP_FILENAME)
+        self.store = os.path.join(get_cache_dir(), 'store')
+        # The shared tier mirrors the layout of the local one
+        if shared_cache is not None:
+            self.shared = os.path.join(shared_cache,
+                    os.path.relpath(self.cache,
+                    os.path.join(get_cache_dir(), 'chunks')))
+        else:
+            self.shared = None
 
     def get_recompressed_path(self, algorithm):
         return os.path.join(self._urlpath, self.label,
                 'recompressed.%s' % algorithm)
 
+    def prepare_cache(self):
+        # Write the chunk hashes and zero map for vmnetfs into the cache
+        # directory.  Returns the number of chunks reused from older
+        # versions of the package.
+        reused = 0
+        if self.hashes is not None:
+            ensure_dir(self.cache)
+            if not os.path.exists(self._hashes_file):
+                # First launch of this version of the package.  Reuse
+                # unchanged chunks from older versions.
+                reused = ChunkCache().seed(self._cache_url, self.cache,
+                        self.label, self.chunk_size, self.hashes.data)
+            with open(self._hashes_file, 'wb') as fh:
+                fh.write(self.hashes.data)
+        if self.zero_map is not None:
+            ensure_dir(self.cache)
+            # Replace atomically, since another vmnetfs may be reading it
+            with NamedTemporaryFile(dir=self.cache,
+                    prefix=ZERO_MAP_FILENAME + '.', delete=False) as fh:
+                fh.write(self.zero_map.data)
+            os.rename(fh.name, self._zero_map_file)
+        return reused
+
     # We must access Cookie._rest to perform case-insensitive lookup of
     # the HttpOnly attribute
     # pylint: disable=protected-access
@@ -138,18 +196,52 @@ class _Image(object):
                     c += '; HttpOnly'
                 cookies.append(e.cookie(c))
             origin.append(cookies)
-        return e.image(
+        fetch = e.fetch(
+            e.mode('stream' if self.stream else 'demand'),
+        )
+        if self.readahead:
+            fetch.append(e.readahead(str(self.readahead)))
+        if self.profile:
+            fetch.append(e.profile('true'))
+        if self.connections > 1:
+            fetch.append(e.connections(str(self.connections)))
+        if self.fill:
+            fetch.append(e.fill('true'))
+        if self.predict:
+            fetch.append(e.predict('true'))
+        cache = e.cache(
+            e.path(self.cache),
+            e('chunk-size', str(self.chunk_size)),
+            e.layout(self.cache_layout),
+        )
+        if self.compress:
+            cache.append(e.compress('true'))
+        if self.memory_cache:
+            cache.append(e('memory-cache', str(self.memory_cache)))
+        if self.hashes is not None:
+            cache.append(e.store(
+                e.path(self.store),
+                e.hashes(self._hashes_file),
+            ))
+        if self.shared is not None:
+            cache.append(e.shared(self.shared))
+        if self.zero_map is not None:
+            cache.append(e('zero-map', self._zero_map_file))
+        image = e.image(
             e.name(self.label),
             e.size(str(self.size)),
             origin,
-            e.cache(
-                e.path(self.cache),
-                e('chunk-size', str(self.chunk_size)),
-            ),
-            e.fetch(
-                e.mode('stream' if self.stream else 'demand'),
-            ),
+            cache,
+            fetch,
         )
+        if self.modified_memory or self.persist:
+            modified = e.modified()
+            if self.modified_memory:
+                modified.append(e.memory(str(self.modified_memory)))
+            if self.persist:
+                modified.append(e.persist('true'))
+            image.append(modified)
+        return image
     # pylint: enable=protected-access
 
 
@@ -314,6 +406,14 @@ class LocalController(Controller):
     STATS = ('bytes_read', 'bytes_written', 'chunk_dirties', 'chunk_fetches',
             'io_errors')
     RECOMPRESSION_ALGORITHM = 'lzop'
+    DISK_READAHEAD = 32  # chunks
+    MEMORY_CONNECTIONS = 4
+    DISK_BACKGROUND_FILL = True
+    CACHE_LAYOUT = 'pack'
+    # The memory image is already compressed
+    DISK_CACHE_COMPRESSION = True
+    DISK_MEMORY_CACHE = 64 << 20  # bytes
+    DISK_MODIFIED_MEMORY = 128 << 20  # bytes
     _environment_ready = False
 
     def __init__(self, url=None, package=None, viewer_password=None):
@@ -323,6 +423,7 @@ class LocalController(Controller):
         self._package = package
         self._have_memory = False
         self._memory_image_path = None
+        self._saved_memory_path = None
         self._fs = None
         self._conn = None
         self._conn_callbacks = []
@@ -353,11 +454,32 @@ class LocalController(Controller):
         # Create vmnetfs config
         e = ElementMaker(namespace=VMNETFS_NS, nsmap={None: VMNETFS_NS})
         vmnetfs_config = e.config()
-        vmnetfs_config.append(_Image('disk', package.disk,
-                username=self.username, password=self.password).vmnetfs_config)
+        shared_cache = ChunkCache().shared
+        resume = ChunkCache().resume
+        disk = _Image('disk', package.disk,
+                username=self.username, password=self.password,
+                readahead=self.DISK_READAHEAD, profile=True, predict=True,
+                fill=self.DISK_BACKGROUND_FILL,
+                cache_layout=self.CACHE_LAYOUT,
+                hashes=package.disk_hashes,
+                zero_map=package.disk_zero_map,
+                compress=self.DISK_CACHE_COMPRESSION,
+                memory_cache=self.DISK_MEMORY_CACHE,
+                modified_memory=self.DISK_MODIFIED_MEMORY,
+                shared_cache=shared_cache, persist=resume)
+        self._prepare_image_cache(disk)
+        vmnetfs_config.append(disk.vmnetfs_config)
+        if resume:
+            self._saved_memory_path = os.path.join(disk.cache,
+                    SAVED_MEMORY_FILENAME)
         if package.memory:
             image = _Image('memory', package.memory, username=self.username,
-                    password=self.password, stream=True)
+                    password=self.password, stream=True,
+                    connections=self.MEMORY_CONNECTIONS,
+                    cache_layout=self.CACHE_LAYOUT,
+                    hashes=package.memory_hashes,
+                    zero_map=package.memory_zero_map,
+                    shared_cache=shared_cache)
             # Use recompressed memory image if available
             recompressed_path = image.get_recompressed_path(
                     self.RECOMPRESSION_ALGORITHM)
@@ -368,6 +490,7 @@ class LocalController(Controller):
                 image = _Image('memory',
                         SourceRange(source_open(filename=recompressed_path)),
                         stream=True)
+            self._prepare_image_cache(image)
             vmnetfs_config.append(image.vmnetfs_config)
 
         # Start vmnetfs
@@ -386,6 +509,29 @@ class LocalController(Controller):
         else:
             memory_path = self._memory_image_path = None
 
+        # If another instance of the package holds the persistent disk
+        # changes, the saved session belongs to it; leave it alone
+        if (self._saved_memory_path is not None and
+                not self._read_disk_stat(disk_path, 'modified_persisted')):
+            self._saved_memory_path = None
+
+        # Resume the saved session only if vmnetfs resumed the disk image
+        # it was saved with
+        if self._saved_memory_path is not None:
+            if self._read_disk_stat(disk_path, 'modified_resumed'):
+                # The package's memory image doesn't match the resumed disk
+                memory_path = None
+                if os.path.exists(self._saved_memory_path):
+                    self._memory_image_path = self._saved_memory_path
+                else:
+                    self._memory_image_path = None
+            else:
+                self._discard_saved_memory()
+
+        # Trim chunk cache now that vmnetfs has locked our images
+        threading.Thread(name='vmnetx-trim-cache',
+                target=self._trim_cache).start()
+
         # Set up libvirt connection
         self._conn = libvirt.open('qemu:///session')
         cb = self._conn.domainEventRegisterAny(None,
@@ -402,18 +548,27 @@ class LocalController(Controller):
 
         # Get execution domain XML
         self._domain_xml = domain_xml.get_for_execution(self._domain_name,
-                emulator, disk_image_path, self.viewer_password).xml
+                emulator, disk_image_path, self.viewer_password,
+                discard=domain_xml.detect_discard(self._conn)).xml
 
-        # Write domain XML to memory image
+        # Write domain XML to memory image.  A saved session needs this
+        # too, since its domain had a different name and UUID.
         if self._memory_image_path is not None:
-            with open(self._memory_image_path, 'r+') as fh:
-                hdr = LibvirtQemuMemoryHeader(fh)
-                hdr.xml = self._domain_xml
-                hdr.write(fh)
+            try:
+                with open(self._memory_image_path, 'r+') as fh:
+                    hdr = LibvirtQemuMemoryHeader(fh)
+                    hdr.xml = self._domain_xml
+                    hdr.write(fh)
+            except (IOError, MemoryImageError):
+                if self._memory_image_path != self._saved_memory_path:
+                    raise
+                _log.warning("Couldn't update saved session; discarding it")
+                self._discard_saved_memory()
+                self._memory_image_path = None
 
         # Set configuration
         self.vm_name = package.name
-        self._have_memory = memory_path is not None
+        self._have_memory = self._memory_image_path is not None
         self.max_mouse_rate = domain_xml.max_mouse_rate
 
         # Set chunk size
@@ -430,7 +585,7 @@ class LocalController(Controller):
         log_monitor = LineStreamMonitor(log_path)
         log_monitor.connect('line-emitted', self._vmnetfs_log)
         self._monitors.append(log_monitor)
-        if self._have_memory:
+        if memory_path is not None:
             self._load_monitor = LoadProgressMonitor(memory_path)
             self._load_monitor.connect('progress', self._load_progress)
 
@@ -438,6 +593,30 @@ class LocalController(Controller):
         self.state = self.STATE_STOPPED
         gobject.idle_add(self.emit, 'vm-stopped')
 
+    @staticmethod
+    def _prepare_image_cache(image):
+        reused = image.prepare_cache()
+        if reused:
+            _log.info('Reused %d %s chunks from previous package version',
+                    reused, image.label)
+
+    @staticmethod
+    def _read_disk_stat(disk_path, name):
+        with open(os.path.join(disk_path, 'stats', name)) as fh:
+            return int(fh.readline().strip())
+
+    # We intentionally catch all exceptions
+    # pylint: disable=bare-except
+    def _trim_cache(self):
+        try:
+            freed = ChunkCache().trim()
+        except:
+            _log.exception('Trimming chunk cache failed')
+        else:
+            if freed:
+                _log.info('Trimmed %s from chunk cache', format_size(freed))
+    # pylint: enable=bare-except
+
     # Should be called before we open any windows, since we may re-exec
     # the whole program if we need to update the group list.
     @classmethod
@@ -504,7 +683,7 @@ class LocalController(Controller):
     def start_vm(self):
         self.state = self.STATE_STARTING
         self._startup_running = True
-        if self._have_memory:
+        if self._have_memory and self._load_monitor is not None:
             self.emit('startup-progress', 0, self._load_monitor.chunks)
         threading.Thread(name='vmnetx-startup', target=self._startup).start()
 
@@ -540,8 +719,12 @@ class LocalController(Controller):
             except libvirt.libvirtError, e:
                 raise MachineExecutionError(str(e))
             finally:
-                if have_memory:
+                if have_memory and self._load_monitor is not None:
                     gobject.idle_add(self._load_monitor.close)
+                if (have_memory and
+                        self._memory_image_path == self._saved_memory_path):
+                    # The session can only be resumed once
+                    self._discard_saved_memory()
         except:
             if self.state == self.STATE_STOPPING:
                 self.state = self.STATE_STOPPED
@@ -592,6 +775,20 @@ class LocalController(Controller):
                     target=self._stop_vm)
             self._stop_thread.start()
 
+    def _save_vm(self):
+        try:
+            self._conn.lookupByName(self._domain_name).save(
+                    self._saved_memory_path)
+        except libvirt.libvirtError, e:
+            _log.warning("Couldn't save session: %s", e)
+            self._discard_saved_memory()
+
+    def _discard_saved_memory(self):
+        try:
+            os.unlink(self._saved_memory_path)
+        except OSError:
+            pass
+
     def _stop_vm(self):
         # Thread function.
         try:
@@ -604,6 +801,10 @@ class LocalController(Controller):
         for monitor in self._monitors:
             monitor.close()
         self._monitors = []
+        if (self._saved_memory_path is not None and
+                self.state == self.STATE_RUNNING):
+            # vmnetfs saves the disk when it exits
+            self._save_vm()
         self.stop_vm()
         if self._stop_thread is not None:
             self._stop_thread.join()
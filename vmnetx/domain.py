@@ -173,8 +173,15 @@ class DomainXML(object):
         return self._get_emulator_for_domain(conn,
                 etree.fromstring(self.xml)).path
 
+    @staticmethod
+    def detect_discard(conn):
+        '''Return True if guest discards can be passed through to the disk
+        image.'''
+        # discard='unmap' needs libvirt >= 1.0.6 and qemu >= 1.5
+        return conn.getLibVersion() >= 1000006 and conn.getVersion() >= 1005000
+
     def get_for_execution(self, name, emulator, disk_image_path,
-            viewer_password):
+            viewer_password, discard=False):
         # Parse XML
         tree = etree.fromstring(self.xml)
 
@@ -190,6 +197,13 @@ class DomainXML(object):
                 '/domain/devices/disk[@device="disk"]/source').set('file',
                 disk_image_path)
 
+        # Pass guest TRIM through to the disk image, so vmnetfs can drop
+        # discarded chunks
+        if discard:
+            self._xpath_one(tree,
+                    '/domain/devices/disk[@device="disk"]/driver').set(
+                    'discard', 'unmap')
+
         # Remove graphics declarations
         # (legacy VMs may specify VNC graphics)
         devices_node = self._xpath_one(tree, '/domain/devices')
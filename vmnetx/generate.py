@@ -147,7 +147,8 @@ def copy_disk(in_path, type, out_path, raw=False):
         raise MachineGenerationError('qemu-img failed')
 
 
-def generate_machine(name, in_xml, out_file, compress=True):
+def generate_machine(name, in_xml, out_file, compress=True,
+        chunk_hashes=False, zero_map=False):
     # Parse domain XML
     try:
         with open(in_xml) as fh:
@@ -187,7 +188,8 @@ def generate_machine(name, in_xml, out_file, compress=True):
         print 'Writing package...'
         try:
             Package.create(out_file, name, domain_xml, temp_disk.name,
-                    temp_memory.name if temp_memory else None)
+                    temp_memory.name if temp_memory else None,
+                    chunk_hashes=chunk_hashes, zero_map=zero_map)
         except:
             if os.path.exists(out_file):
                 os.unlink(out_file)
@@ -242,7 +244,9 @@ def compress_machine(in_file, out_file, name=None):
         print 'Writing package...'
         try:
             Package.create(out_file, name or package.name, domain_xml,
-                    temp_disk.name, temp_memory.name if temp_memory else None)
+                    temp_disk.name, temp_memory.name if temp_memory else None,
+                    chunk_hashes=package.disk_hashes is not None,
+                    zero_map=package.disk_zero_map is not None)
         except:
             if os.path.exists(out_file):
                 os.unlink(out_file)
@@ -15,6 +15,7 @@
 # for more details.
 #
 
+from hashlib import sha256
 from lxml import etree
 from lxml.builder import ElementMaker
 import os
@@ -33,6 +34,11 @@ MANIFEST_FILENAME = 'vmnetx-package.xml'
 DOMAIN_FILENAME = 'domain.xml'
 DISK_FILENAME = 'disk.img'
 MEMORY_FILENAME = 'memory.img'
+DISK_HASHES_FILENAME = 'disk.hashes'
+MEMORY_HASHES_FILENAME = 'memory.hashes'
+DISK_ZERO_MAP_FILENAME = 'disk.zeromap'
+MEMORY_ZERO_MAP_FILENAME = 'memory.zeromap'
+HASH_CHUNK_SIZE = 131072
 
 
 # We want this to be a public attribute
@@ -72,6 +78,56 @@ class _PackageMember(SourceRange):
                 info.file_size, load_data)
 
 
+class _ChunkHashes(_PackageMember):
+    HASH_LEN = 32
+
+    def __init__(self, zip, element, image):
+        _PackageMember.__init__(self, zip, element.get('path'), True)
+        self.chunk_size = int(element.get('chunk-size'))
+        chunks = (image.length + self.chunk_size - 1) // self.chunk_size
+        if self.length != chunks * self.HASH_LEN:
+            raise BadPackageError('Member "%s" has wrong size' %
+                    element.get('path'))
+
+    @classmethod
+    def generate(cls, path, chunk_size=HASH_CHUNK_SIZE):
+        hashes = []
+        with open(path, 'rb') as fh:
+            while True:
+                buf = fh.read(chunk_size)
+                if not buf:
+                    break
+                hashes.append(sha256(buf).digest())
+        return ''.join(hashes)
+
+
+class _ZeroMap(_PackageMember):
+    def __init__(self, zip, element, image):
+        _PackageMember.__init__(self, zip, element.get('path'), True)
+        self.chunk_size = int(element.get('chunk-size'))
+        chunks = (image.length + self.chunk_size - 1) // self.chunk_size
+        if self.length != (chunks + 7) // 8:
+            raise BadPackageError('Member "%s" has wrong size' %
+                    element.get('path'))
+
+    @classmethod
+    def generate(cls, path, chunk_size=HASH_CHUNK_SIZE):
+        zero = '\0' * chunk_size
+        bits = bytearray()
+        chunk = 0
+        with open(path, 'rb') as fh:
+            while True:
+                buf = fh.read(chunk_size)
+                if not buf:
+                    break
+                if chunk % 8 == 0:
+                    bits.append(0)
+                if buf == zero[:len(buf)]:
+                    bits[-1] |= 1 << (chunk % 8)
+                chunk += 1
+        return str(bits)
+
+
 class Package(object):
     def __init__(self, source):
         self.url = source.url
@@ -89,29 +145,57 @@ class Package(object):
             self.name = tree.get('name')
             self.domain = _PackageMember(zip,
                     tree.find(NSP + 'domain').get('path'), True)
-            self.disk = _PackageMember(zip,
-                    tree.find(NSP + 'disk').get('path'))
+            self.disk, self.disk_hashes, self.disk_zero_map = \
+                    self._get_image(zip, tree.find(NSP + 'disk'))
             memory = tree.find(NSP + 'memory')
             if memory is not None:
-                self.memory = _PackageMember(zip, memory.get('path'))
+                self.memory, self.memory_hashes, self.memory_zero_map = \
+                        self._get_image(zip, memory)
             else:
-                self.memory = None
+                self.memory = self.memory_hashes = None
+                self.memory_zero_map = None
         except etree.XMLSyntaxError, e:
             raise BadPackageError('Manifest XML does not validate', str(e))
         except (zipfile.BadZipfile, SourceError), e:
             raise BadPackageError(str(e))
 
+    @staticmethod
+    def _get_image(zip, element):
+        image = _PackageMember(zip, element.get('path'))
+        hashes = element.find(NSP + 'chunk-hashes')
+        if hashes is not None:
+            hashes = _ChunkHashes(zip, hashes, image)
+        zero_map = element.find(NSP + 'zero-map')
+        if zero_map is not None:
+            zero_map = _ZeroMap(zip, zero_map, image)
+        return image, hashes, zero_map
+
     @classmethod
-    def create(cls, out, name, domain_xml, disk_path, memory_path=None):
+    def create(cls, out, name, domain_xml, disk_path, memory_path=None,
+            chunk_hashes=False, zero_map=False):
         # Generate manifest XML
         e = ElementMaker(namespace=NS, nsmap={None: NS})
+        disk = e.disk(path=DISK_FILENAME)
+        if chunk_hashes:
+            disk.append(e('chunk-hashes', path=DISK_HASHES_FILENAME,
+                    **{'chunk-size': str(HASH_CHUNK_SIZE)}))
+        if zero_map:
+            disk.append(e('zero-map', path=DISK_ZERO_MAP_FILENAME,
+                    **{'chunk-size': str(HASH_CHUNK_SIZE)}))
         tree = e.image(
             e.domain(path=DOMAIN_FILENAME),
-            e.disk(path=DISK_FILENAME),
+            disk,
             name=name,
         )
         if memory_path:
-            tree.append(e.memory(path=MEMORY_FILENAME))
+            memory = e.memory(path=MEMORY_FILENAME)
+            if chunk_hashes:
+                memory.append(e('chunk-hashes', path=MEMORY_HASHES_FILENAME,
+                        **{'chunk-size': str(HASH_CHUNK_SIZE)}))
+            if zero_map:
+                memory.append(e('zero-map', path=MEMORY_ZERO_MAP_FILENAME,
+                        **{'chunk-size': str(HASH_CHUNK_SIZE)}))
+            tree.append(memory)
         schema.assertValid(tree)
         xml = etree.tostring(tree, encoding='UTF-8', pretty_print=True,
                 xml_declaration=True)
@@ -121,6 +205,18 @@ class Package(object):
         zip.comment = 'VMNetX package'
         zip.writestr(MANIFEST_FILENAME, xml)
         zip.writestr(DOMAIN_FILENAME, domain_xml)
+        if chunk_hashes:
+            zip.writestr(DISK_HASHES_FILENAME,
+                    _ChunkHashes.generate(disk_path))
+            if memory_path is not None:
+                zip.writestr(MEMORY_HASHES_FILENAME,
+                        _ChunkHashes.generate(memory_path))
+        if zero_map:
+            zip.writestr(DISK_ZERO_MAP_FILENAME,
+                    _ZeroMap.generate(disk_path))
+            if memory_path is not None:
+                zip.writestr(MEMORY_ZERO_MAP_FILENAME,
+                        _ZeroMap.generate(memory_path))
         if memory_path is not None:
             zip.write(memory_path, MEMORY_FILENAME)
         zip.write(disk_path, DISK_FILENAME)